@@ -1,73 +1,245 @@
-from flask import Flask, request, render_template, jsonify, send_from_directory
-import pandas as pd
-from scipy.stats import hypergeom
-from statsmodels.stats.multitest import multipletests
-import matplotlib.pyplot as plt
-import seaborn as sns
+from flask import (
+    Flask,
+    Response,
+    abort,
+    g,
+    has_request_context,
+    request,
+    render_template,
+    jsonify,
+    send_file,
+    send_from_directory,
+    stream_with_context,
+)
+from werkzeug.middleware.proxy_fix import ProxyFix
+from werkzeug.security import safe_join
 import re
+import hashlib
 import numpy as np
 import json
+import csv
+import io
+import mimetypes
 import random
 import os
-import matplotlib.colors as mcolors  # Add this import
 import sqlite3
+import threading
+import time
+import multiprocessing
+import cProfile
+import pstats
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+from concurrent.futures.process import BrokenProcessPool
+from cache import LRUCache
+from downloads import (
+    build_bundle,
+    bundle_records,
+    bundle_version,
+    compressed_path,
+    current_record,
+    download_etag,
+    download_index,
+    negotiate,
+)
+from enrichment import (
+    SIMILARITY_MEASURES,
+    Background,
+    benjamini_hochberg,
+    collapse_terms,
+    enrichment_statistics,
+    gene_indices,
+    overlap_genes,
+    statistics_row,
+    top_k,
+)
+from gene_links import GeneLinks
+from gene_sets import (
+    ANALYSIS_TYPES,
+    ORGANISMS,
+    library_key,
+    load_example_pool,
+    registry as gene_set_registry,
+)
+from gene_symbols import registry as symbol_registry
+from gsea import gsea, leading_edge, ranked_list
+from hypergeometric import log_factorials
+from jobs import STATUSES as JOB_STATUSES, JobQueue, TooManyJobs
+from metrics import MetricsRegistry
+from usage import UsageCounter
+from plotting import PLOT_FORMATS, PLOT_KINDS, render_plot
 
 app = Flask(__name__, static_url_path="/static")
+# Number of reverse proxies in front of the server (one on Toolforge), whose
+# X-Forwarded-For entries are trusted for the client address; set it to 0
+# when the server is reached directly, or clients can choose their address
+PROXY_HOPS = int(os.environ.get("WIKIORA_PROXY_HOPS", 1))
+if PROXY_HOPS:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=PROXY_HOPS)
 __version__ = "0.7.0"
 
 DATABASE = "database.db"
 
 
+# Usage counts are kept in memory by each worker and written to the database
+# every WIKIORA_USAGE_FLUSH_INTERVAL seconds (0 writes them at once); reads
+# are cached for WIKIORA_USAGE_CACHE_TTL seconds.
+usage = UsageCounter(
+    DATABASE,
+    flush_interval=float(os.environ.get("WIKIORA_USAGE_FLUSH_INTERVAL", 10)),
+    cache_ttl=float(os.environ.get("WIKIORA_USAGE_CACHE_TTL", 5)),
+)
+
+
 def init_db():
-    with sqlite3.connect(DATABASE) as conn:
-        cursor = conn.cursor()
-        cursor.execute(
-            """
-            CREATE TABLE IF NOT EXISTS counter (
-                id INTEGER PRIMARY KEY,
-                count INTEGER NOT NULL
-            )
-        """
-        )
-        cursor.execute(
-            """
-            INSERT INTO counter (count) 
-            SELECT 0 WHERE NOT EXISTS (SELECT 1 FROM counter)
-        """
-        )
-        conn.commit()
-        # Debugging log
-        cursor.execute("SELECT count FROM counter")
-        count = cursor.fetchone()[0]
-        print(f"Database initialized with counter value: {count}")
+    usage.init_db()
+    # Debugging log
+    print(f"Database initialized with counter value: {usage.total()}")
+
+
+@app.route("/api/lists_enriched", methods=["GET"])
+def get_lists_enriched():
+    return jsonify({"lists_enriched": usage.total()})
 
 
-def increment_counter():
-    with sqlite3.connect(DATABASE) as conn:
-        cursor = conn.cursor()
-        cursor.execute("UPDATE counter SET count = count + 1")
-        conn.commit()
+# Lists enriched per organism and per library and endpoint, optionally
+# since a day (since=YYYY-MM-DD)
+@app.route("/api/usage", methods=["GET"])
+def get_usage():
+    since = request.args.get("since")
+    if since is not None and not re.fullmatch(r"\d{4}-\d{2}-\d{2}", since):
+        return jsonify({"error": "since must be a date (YYYY-MM-DD)"}), 400
+    return jsonify(usage.statistics(since))
 
 
-def get_counter():
-    with sqlite3.connect(DATABASE) as conn:
-        cursor = conn.cursor()
-        cursor.execute("SELECT count FROM counter")
-        count = cursor.fetchone()[0]
-        return count
+# Request and stage durations, exposed with cache and job gauges on
+# /metrics. Each worker process keeps its own metrics, so Prometheus should
+# scrape the workers separately (or the totals only cover one of them).
+metrics = MetricsRegistry()
+request_duration = metrics.histogram(
+    "wikiora_request_duration_seconds",
+    "Time to answer a request, by endpoint (streamed bodies excluded)",
+    ("endpoint",),
+)
+requests_total = metrics.counter(
+    "wikiora_requests_total",
+    "Requests answered, by endpoint and status",
+    ("endpoint", "status"),
+)
+stage_duration = metrics.histogram(
+    "wikiora_stage_duration_seconds",
+    "Time spent in each stage of the enrichment requests (endpoint job for jobs)",
+    ("endpoint", "stage"),
+)
 
 
-@app.route("/api/lists_enriched", methods=["GET"])
-def get_lists_enriched():
-    lists_count = get_counter()
-    print(lists_count)
-    return jsonify({"lists_enriched": lists_count})
+# Time a stage of a request: loading the library, resolving the symbols,
+# the statistics, building the result rows, serializing or rendering. The
+# durations of the stages of a request are summed per stage name and
+# returned in its Server-Timing header.
+@contextmanager
+def stage(name):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - start
+        if has_request_context():
+            stage_duration.observe(seconds, endpoint=request.endpoint, stage=name)
+            stages = g.setdefault("stages", {})
+            stages[name] = stages.get(name, 0.0) + seconds
+        else:
+            stage_duration.observe(seconds, endpoint="job", stage=name)
+
+
+# A request with profile=1 and an X-Profile-Token header matching
+# WIKIORA_PROFILE_TOKEN runs under cProfile and is answered with the
+# profile instead of its response:
+#   {"status", "total_ms", "stages": {stage: ms}, "functions": [{"function",
+#    "calls", "own_ms", "cumulative_ms"}, ...]}
+# with the PROFILE_FUNCTIONS functions of the largest cumulative time.
+PROFILE_FUNCTIONS = 40
+
+
+def profile_requested():
+    return request.values.get("profile", "0").lower() in ("1", "true")
+
+
+def profile_report(profiler, status, seconds):
+    stats = pstats.Stats(profiler)
+    functions = sorted(stats.stats.items(), key=lambda item: -item[1][3])
+    return {
+        "status": status,
+        "total_ms": round(seconds * 1000, 3),
+        "stages": {
+            name: round(value * 1000, 3) for name, value in g.get("stages", {}).items()
+        },
+        "functions": [
+            {
+                "function": f"{filename}:{line}({name})",
+                "calls": calls,
+                "own_ms": round(own * 1000, 3),
+                "cumulative_ms": round(cumulative * 1000, 3),
+            }
+            for (filename, line, name), (_, calls, own, cumulative, _) in functions[
+                :PROFILE_FUNCTIONS
+            ]
+        ],
+    }
+
+
+@app.before_request
+def start_request():
+    g.request_start = time.perf_counter()
+    if profile_requested():
+        token = os.environ.get("WIKIORA_PROFILE_TOKEN")
+        if not token or request.headers.get("X-Profile-Token") != token:
+            return jsonify({"error": "forbidden"}), 403
+        g.profiler = cProfile.Profile()
+        g.profiler.enable()
+
+
+@app.after_request
+def finish_request(response):
+    profiler = g.pop("profiler", None)
+    if profiler is not None:
+        # Streamed rows are produced while the profiler runs too
+        if response.is_streamed:
+            response.get_data()
+        profiler.disable()
+    seconds = time.perf_counter() - g.request_start
+    endpoint = request.endpoint or "none"
+    request_duration.observe(seconds, endpoint=endpoint)
+    requests_total.inc(endpoint=endpoint, status=str(response.status_code))
+    if profiler is not None:
+        response = jsonify(profile_report(profiler, response.status_code, seconds))
+    stages = g.get("stages")
+    if stages:
+        response.headers["Server-Timing"] = ", ".join(
+            f"{name};dur={value * 1000:.3f}" for name, value in stages.items()
+        )
+    return response
+
+
+# The data version is part of every result cache key, so it is read once
+# per process and again when the gene sets are reloaded
+_version = None
 
 
 def get_version():
-    with open("static/version.txt", "r") as f:
-        version = f.read().strip()
-    return version
+    global _version
+    if _version is None:
+        with open("static/version.txt", "r") as f:
+            _version = f.read().strip()
+    return _version
+
+
+def _clear_version(names):
+    global _version
+    _version = None
+
+
+gene_set_registry.add_reload_listener(_clear_version)
 
 
 @app.context_processor
@@ -81,40 +253,44 @@ def robots_txt():
     return send_from_directory(app.static_folder, "robots.txt")
 
 
-# Load GMT file into a dictionary
-def load_gmt(file_path):
-    gene_sets = {}
-    with open(file_path, "r") as f:
-        for line in f:
-            parts = line.strip().split("\t")
-            go_term = parts[0]
-            description = parts[1]
-            wikipedia_url = parts[2]
-            genes = parts[3:]
-            gene_sets[go_term] = {
-                "description": description,
-                "wikipedia_url": wikipedia_url,
-                "genes": set(genes),
-            }
-    return gene_sets
+_gene_links = None
+_gene_links_lock = threading.Lock()
+
+
+# Load the gene link index the first time an overlap is rendered, not at
+# import. It is memory-mapped, so workers share it.
+def get_gene_links():
+    global _gene_links
+    if _gene_links is None:
+        with _gene_links_lock:
+            if _gene_links is None:
+                _gene_links = GeneLinks.load()
+    return _gene_links
 
 
-# Load genes.json
-with open(os.path.join("static", "genes.json")) as f:
-    genes_data = json.load(f)
+# Example lists of each library, read once per process (see
+# gene_sets.load_example_pool) and dropped when the gene sets are reloaded
+_example_pools = {}
+_example_pools_lock = threading.Lock()
+gene_set_registry.add_reload_listener(lambda names: _example_pools.clear())
+# Most example lists the page can prefetch in one request
+MAX_EXAMPLES = 20
 
 
-# Load process information from JSON file
-def load_processes(file_path):
-    with open(file_path, "r") as f:
-        return json.load(f)
+def get_example_pool(organism, analysis_type):
+    key = library_key(organism, analysis_type)
+    pool = _example_pools.get(key)
+    if pool is None:
+        with _example_pools_lock:
+            pool = _example_pools.get(key)
+            if pool is None:
+                pool = _example_pools[key] = load_example_pool(*key)
+    return pool
 
 
-# Function to select a random process and get up to 50 genes
-def select_random_process(processes):
-    process = random.choice(processes)
-    genes = process["gene_symbol"][:50]
-    return genes
+# A random example list of a pool, with a random separator
+def random_example(pool):
+    return random.choice(pool).replace("\n", select_random_separator())
 
 
 def select_random_separator():
@@ -124,9 +300,289 @@ def select_random_separator():
     return separator
 
 
-# Function to perform hypergeometric test
-def hypergeometric_test(M, n, N, x):
-    return hypergeom.sf(x - 1, M, n, N)
+# Wikipedia link and page status for each gene of an overlap
+def overlap_info(genes):
+    return get_gene_links().lookup(genes)
+
+
+RESULT_COLUMNS = [
+    "Term",
+    "Description",
+    "Wikipedia URL",
+    "Overlap",
+    "Count",
+    "Gene Set Size",
+    "p-value",
+    "Odds Ratio",
+    "Combined Score",
+    "Gene Ratio",
+    "q-value",
+]
+
+# Columns of the result records that the plots need
+PLOT_COLUMNS = ["Description", "q-value", "Count", "Gene Ratio"]
+
+# Which rows of the ranked table are returned: by default the top 10 terms
+# with at least one gene in the overlap. collapse (a similarity measure)
+# groups redundant terms under the best ranked one.
+DEFAULT_VIEW = {
+    "limit": 10,
+    "offset": 0,
+    "min_count": 1,
+    "max_q": None,
+    "collapse": None,
+    "similarity_threshold": 0.5,
+}
+
+
+# Read limit/offset/min_count/max_q and collapse/similarity_threshold from
+# the request values (or a JSON payload). limit=all returns every row and
+# collapse=true uses the Jaccard similarity. Raises ValueError on bad input.
+def result_view(values):
+    view = dict(DEFAULT_VIEW)
+    limit = values.get("limit")
+    if limit is not None:
+        view["limit"] = None if str(limit).lower() == "all" else int(limit)
+    for name, convert in (
+        ("offset", int),
+        ("min_count", int),
+        ("max_q", float),
+        ("similarity_threshold", float),
+    ):
+        if values.get(name) is not None:
+            view[name] = convert(values.get(name))
+    if (view["limit"] is not None and view["limit"] < 0) or view["offset"] < 0:
+        raise ValueError("limit and offset must not be negative")
+    collapse = str(values.get("collapse", "false")).lower()
+    if collapse in ("1", "true"):
+        view["collapse"] = "jaccard"
+    elif collapse in SIMILARITY_MEASURES:
+        view["collapse"] = collapse
+    elif collapse not in ("0", "false", "none"):
+        raise ValueError(
+            f"collapse must be true, false, {' or '.join(SIMILARITY_MEASURES)}"
+        )
+    if not 0 < view["similarity_threshold"] <= 1:
+        raise ValueError("similarity_threshold must be in (0, 1]")
+    return view
+
+
+# Benjamini-Hochberg q-values of the terms that could be tested; terms
+# without genes in the background (if any) get 1
+def term_q_values(statistics):
+    tested = statistics["Gene Set Size"] > 0
+    q_values = np.ones(len(tested))
+    q_values[tested] = benjamini_hochberg(statistics["p-value"][tested])
+    return q_values
+
+
+# Turn the per-term statistics of one gene list into the records returned by
+# the API, ranked by p-value. Records are yielded one at a time and only the
+# returned rows are converted, including their overlap links.
+#
+# statistics may already hold q-values (and other per-term columns, which
+# are added to the records); max_q then applies to the q_column one. terms
+# restricts the ranking to a slice of the library's terms.
+#
+# With view["collapse"], the terms that pass the filters are grouped by gene
+# overlap (see enrichment.collapse_terms()) and only the representative of
+# each group is ranked, with the other terms of the group as its "Members".
+def iter_enrichment_results(
+    library,
+    genes,
+    statistics,
+    view=DEFAULT_VIEW,
+    background=None,
+    terms=None,
+    q_column="q-value",
+):
+    if not len(library):
+        return
+    if "q-value" in statistics:
+        q_values = statistics["q-value"]
+    else:
+        # Apply Benjamini-Hochberg correction considering the total number of gene sets
+        q_values = term_q_values(statistics)
+    # Filter to include only those sets with overlap >= min_count (and q <= max_q)
+    keep = (statistics["Gene Set Size"] > 0) & (
+        statistics["Count"] >= view["min_count"]
+    )
+    if view["max_q"] is not None:
+        keep &= statistics.get(q_column, q_values) <= view["max_q"]
+    if terms is not None:
+        in_terms = np.zeros(len(keep), dtype=bool)
+        in_terms[terms] = True
+        keep &= in_terms
+    candidates = np.flatnonzero(keep)
+    # Partial sort: only the rows up to the end of the requested page
+    offset = view["offset"]
+    end = None if view["limit"] is None else offset + view["limit"]
+    members = {}
+    if view["collapse"] is None:
+        rows = candidates[top_k(statistics["p-value"][candidates], end)[offset:end]]
+    else:
+        ranked = candidates[top_k(statistics["p-value"][candidates])]
+        clusters = collapse_terms(
+            library, ranked, view["collapse"], view["similarity_threshold"]
+        )[offset:end]
+        rows = [representative for representative, _, _ in clusters]
+        members = {
+            representative: [
+                {
+                    "Term": library.terms[k],
+                    "Description": library.descriptions[k],
+                    "p-value": statistics["p-value"][k].item(),
+                    "q-value": q_values[k].item(),
+                    "Similarity": similarity,
+                }
+                for k, similarity in zip(others.tolist(), similarities.tolist())
+            ]
+            for representative, others, similarities in clusters
+        }
+
+    query_indices = gene_indices(library, genes)
+    if background is not None:
+        query_indices = background.restrict(query_indices)
+    for j in rows:
+        record = {
+            "Term": library.terms[j],
+            "Description": library.descriptions[j],
+            "Wikipedia URL": library.wikipedia_urls[j],
+            "Overlap": overlap_info(overlap_genes(library, query_indices, j)),
+        }
+        for column, values in statistics.items():
+            record[column] = values[j].item()
+        record["q-value"] = q_values[j].item()
+        if j in members:
+            record["Members"] = members[j]
+        yield record
+
+
+def enrichment_results(library, genes, statistics, view=DEFAULT_VIEW, background=None):
+    return list(iter_enrichment_results(library, genes, statistics, view, background))
+
+
+# The analysis types of a request for several libraries: "all", or a
+# comma-separated list. None for a single analysis type.
+def requested_analysis_types(analysis_type):
+    if analysis_type == "all":
+        return list(ANALYSIS_TYPES)
+    if not analysis_type or "," not in analysis_type:
+        return None
+    types = [t.strip() for t in analysis_type.split(",") if t.strip()]
+    unknown = [t for t in types if t not in ANALYSIS_TYPES]
+    if unknown:
+        raise ValueError(f"unknown analysis_type: {', '.join(unknown)}")
+    return list(dict.fromkeys(types))
+
+
+def elapsed_ms(start):
+    return round((time.perf_counter() - start) * 1000, 3)
+
+
+# Results of one gene list against the libraries of a LibraryGroup, from a
+# single pass over their concatenated incidence matrix. Records have the
+# q-value of their own library and a "global q-value" over the terms of all
+# libraries; fdr ("library" or "global") selects the one max_q applies to.
+# Returns the results and timings of each library and the shared timings.
+def multi_library_results(group, genes, view, background=None, fdr="library"):
+    start = time.perf_counter()
+    with stage("statistics"):
+        statistics = enrichment_statistics(group, [genes], background)
+        statistics = statistics_row(statistics, 0)
+        statistics["q-value"] = np.ones(len(group))
+        statistics["global q-value"] = term_q_values(statistics)
+    timings = {"statistics": elapsed_ms(start)}
+
+    libraries = {}
+    for library, block in group.blocks():
+        start = time.perf_counter()
+        with stage("results"):
+            statistics["q-value"][block] = term_q_values(
+                {column: values[block] for column, values in statistics.items()}
+            )
+            results = list(
+                iter_enrichment_results(
+                    group,
+                    genes,
+                    statistics,
+                    view,
+                    background,
+                    terms=block,
+                    q_column="global q-value" if fdr == "global" else "q-value",
+                )
+            )
+        libraries[library.analysis_type] = {
+            "results": results,
+            "timing_ms": elapsed_ms(start),
+        }
+    return libraries, timings
+
+
+# Response of /api/enrich for several libraries, going through the result
+# cache. Cached responses keep the timings of the request that computed them.
+def multi_library_response(group, genes, view, background, fdr, report):
+    start = time.perf_counter()
+    key = result_cache_key(group, genes, view, background) + (fdr,)
+    cached = result_cache.get(key)
+    if cached is None:
+        libraries, timings = multi_library_results(group, genes, view, background, fdr)
+        timings["total"] = elapsed_ms(start)
+        result_cache.set(key, (libraries, timings))
+    else:
+        libraries, timings = cached
+    return {
+        "organism": group.libraries[0].organism,
+        "libraries": libraries,
+        "timing_ms": timings,
+        "cached": cached is not None,
+        "genes": report,
+    }
+
+
+# Results for one gene list, going through the result cache
+def cached_enrichment_results(library, genes, view=DEFAULT_VIEW, background=None):
+    key = result_cache_key(library, genes, view, background)
+    results = result_cache.get(key)
+    if results is None:
+        with stage("statistics"):
+            statistics = enrichment_statistics(library, [genes], background)
+        with stage("results"):
+            results = enrichment_results(
+                library, genes, statistics_row(statistics, 0), view, background
+            )
+        result_cache.set(key, results)
+    return results
+
+
+# Stream records as NDJSON (one JSON object per line) or CSV, serializing
+# each row only when the client is ready for it. CSV rows have the given
+# columns, with the overlap genes and the member terms comma-separated.
+def stream_results(records, output_format, columns=RESULT_COLUMNS):
+    if output_format == "ndjson":
+
+        def generate():
+            for record in records:
+                yield app.json.dumps(record) + "\n"
+
+        return Response(
+            stream_with_context(generate()), mimetype="application/x-ndjson"
+        )
+
+    def generate():
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(columns)
+        for record in records:
+            record["Overlap"] = ",".join(gene["gene"] for gene in record["Overlap"])
+            if "Members" in record:
+                record["Members"] = ",".join(m["Term"] for m in record["Members"])
+            writer.writerow([record.get(column, "") for column in columns])
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+
+    return Response(stream_with_context(generate()), mimetype="text/csv")
 
 
 # Function to parse gene list
@@ -135,148 +591,694 @@ def parse_gene_list(gene_list):
     return [gene for gene in genes if gene]
 
 
+# Resolve the symbols of a parsed gene list against the organism's symbol
+# index; returns the resolved list and the mapped/remapped/unrecognized
+# report (see gene_symbols.SymbolIndex.resolve).
+def resolve_genes(organism, genes):
+    return symbol_registry.get(organism).resolve(genes)
+
+
+# Enrichment results are cached per gene list, library and data version.
+# WIKIORA_RESULT_CACHE_SIZE=0 disables the cache; the TTL is in seconds and
+# 0 keeps entries until they are evicted.
+result_cache = LRUCache(
+    maxsize=int(os.environ.get("WIKIORA_RESULT_CACHE_SIZE", 1024)),
+    ttl=float(os.environ.get("WIKIORA_RESULT_CACHE_TTL", 3600)),
+)
+gene_set_registry.add_reload_listener(lambda names: result_cache.clear())
+
+# How often (in seconds) requests check the gene set manifest and reload the
+# libraries generate_gmt.py rebuilt; 0 only reloads through the API.
+gene_set_registry.poll_interval = float(
+    os.environ.get("WIKIORA_GENE_SET_POLL_INTERVAL", 60)
+)
+
+
+# The order and repetitions of the genes do not change the overlaps, but the
+# list length is N in the hypergeometric test, so it is part of the key.
+# Lists are keyed on their resolved symbols, so "cd4" and "CD4" share
+# cached results.
+def result_cache_key(library, genes, view=DEFAULT_VIEW, background=None):
+    return (
+        library.name,
+        library.fingerprint,
+        get_version(),
+        len(genes),
+        tuple(sorted(set(genes))),
+        tuple(sorted(view.items())),
+        None if background is None else background.digest,
+    )
+
+
+# A background (universe) is restricted to a library once and kept by the
+# hash of the submitted genes, so every list tested against the same
+# background reuses the recounted term sizes.
+background_cache = LRUCache(
+    maxsize=int(os.environ.get("WIKIORA_BACKGROUND_CACHE_SIZE", 64)),
+    ttl=float(os.environ.get("WIKIORA_RESULT_CACHE_TTL", 3600)),
+)
+gene_set_registry.add_reload_listener(lambda names: background_cache.clear())
+
+
+# The Background of a parsed list of background genes, None when the list
+# is empty. Raises ValueError when none of the genes is in the library. The
+# order and repetitions of the genes do not change the universe, so they
+# are not part of the key.
+def get_background(library, organism, genes):
+    if not genes:
+        return None
+    digest = hashlib.sha256("\n".join(sorted(set(genes))).encode("utf-8")).hexdigest()
+    key = (library.name, library.fingerprint, digest)
+    background = background_cache.get(key)
+    if background is None:
+        resolved, _ = resolve_genes(organism, genes)
+        background = Background(library, resolved, digest)
+        background_cache.set(key, background)
+    if not background.mask.any():
+        raise ValueError("none of the background genes is in the gene set library")
+    return background
+
+
 @app.route("/")
 def index():
     return render_template("index.html")
 
 
+# A random example list of the organism's analysis_type library, as text.
+# With count, up to MAX_EXAMPLES of them as {"examples": [...]}, so the page
+# can prefetch the next lists.
 @app.route("/example_genes", methods=["POST"])
 def example_genes():
-    organism = request.form["organism"]
-    analysis_type = request.form["analysis_type"]
-    if analysis_type == "biological_processes":
-        if organism == "human":
-            processes = load_processes(
-                "static/processes_human_biological_processes.json"
-            )
-        else:
-            processes = load_processes(
-                "static/processes_mouse_biological_processes.json"
+    pool = get_example_pool(request.form["organism"], request.form["analysis_type"])
+    count = request.form.get("count")
+    if count is None:
+        return random_example(pool)
+    try:
+        count = int(count)
+    except ValueError:
+        return jsonify({"error": "count must be an integer"}), 400
+    count = min(max(count, 1), MAX_EXAMPLES)
+    return jsonify({"examples": [random_example(pool) for _ in range(count)]})
+
+
+# Value of a request parameter, from the query string on GET and from the
+# form on POST
+def get_param(name, default=None):
+    values = request.args if request.method == "GET" else request.form
+    return values.get(name, default)
+
+
+# Parameters, besides organism, analysis_type and gene_list:
+#   limit, offset      page of the ranked table (limit=all for every row)
+#   min_count, max_q   only terms with at least min_count overlapping genes
+#                      and a q-value of at most max_q
+#   format             json (default), or ndjson/csv to stream the rows
+#   report             true to return {"results": [...], "genes": {...}},
+#                      with the inputs that were mapped, remapped to a
+#                      current symbol or not recognized
+#   background         genes measured in the experiment (same format as
+#                      gene_list); the universe and the term sizes are then
+#                      restricted to them instead of the library's genes
+#   collapse           true (or jaccard, or kappa) to group the terms that
+#                      pass the filters by gene overlap and return one
+#                      representative per group, with the others as its
+#                      "Members"; similarity_threshold (default 0.5) is the
+#                      similarity that puts two terms in one group
+#
+# analysis_type may also be "all" or a comma-separated list of analysis
+# types, which are evaluated together. The response is then
+#   {"organism": ..., "libraries": {analysis_type: {"results": [...],
+#    "timing_ms": ...}, ...}, "timing_ms": {...}, "genes": {...}}
+# where records also have a "global q-value", corrected over the terms of
+# all the libraries, and fdr=global makes max_q apply to it.
+@app.route("/api/enrich", methods=["GET", "POST"])
+def api_enrich():
+    organism = get_param("organism")
+    analysis_type = get_param("analysis_type")
+    gene_list = get_param("gene_list")
+    with stage("resolve"):
+        genes, report = resolve_genes(organism, parse_gene_list(gene_list))
+    output_format = get_param("format", "json")
+    try:
+        with stage("library"):
+            analysis_types = requested_analysis_types(analysis_type)
+            if analysis_types is None:
+                library = gene_set_registry.get(organism, analysis_type)
+            else:
+                library = gene_set_registry.group(organism, analysis_types)
+        view = result_view(request.args if request.method == "GET" else request.form)
+        with stage("background"):
+            background = get_background(
+                library, organism, parse_gene_list(get_param("background", ""))
             )
-    elif analysis_type == "molecular_functions":
-        if organism == "human":
-            processes = load_processes(
-                "static/processes_human_molecular_functions.json"
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    for tested in [library] if analysis_types is None else library.libraries:
+        usage.record(tested.organism, tested.analysis_type, "api")
+
+    if analysis_types is not None:
+        fdr = get_param("fdr", "library")
+        if fdr not in ("library", "global"):
+            return jsonify({"error": "fdr must be library or global"}), 400
+        if output_format != "json":
+            return (
+                jsonify({"error": "several libraries are only returned as json"}),
+                400,
             )
-        else:
-            processes = load_processes(
-                "static/processes_mouse_molecular_functions.json"
+        response = multi_library_response(library, genes, view, background, fdr, report)
+        with stage("serialize"):
+            return jsonify(response)
+
+    if output_format in ("ndjson", "csv"):
+        with stage("statistics"):
+            statistics = enrichment_statistics(library, [genes], background)
+        records = iter_enrichment_results(
+            library, genes, statistics_row(statistics, 0), view, background
+        )
+        columns = RESULT_COLUMNS + (["Members"] if view["collapse"] else [])
+        return stream_results(records, output_format, columns)
+    results = cached_enrichment_results(library, genes, view, background)
+    with stage("serialize"):
+        if get_param("report", "false").lower() in ("1", "true"):
+            return jsonify({"results": results, "genes": report})
+        return jsonify(results)
+
+
+# Figures are rendered in a small pool of worker processes, so matplotlib
+# never runs (or is even imported) in the web workers, and cached per result.
+PLOT_WORKERS = int(os.environ.get("WIKIORA_PLOT_WORKERS", 2))
+PLOT_TIMEOUT = float(os.environ.get("WIKIORA_PLOT_TIMEOUT", 30))
+plot_cache = LRUCache(
+    maxsize=int(os.environ.get("WIKIORA_PLOT_CACHE_SIZE", 128)),
+    ttl=float(os.environ.get("WIKIORA_RESULT_CACHE_TTL", 3600)),
+)
+gene_set_registry.add_reload_listener(lambda names: plot_cache.clear())
+_plot_pool = None
+_plot_pool_lock = threading.Lock()
+
+
+def get_plot_pool():
+    global _plot_pool
+    with _plot_pool_lock:
+        if _plot_pool is None:
+            _plot_pool = ProcessPoolExecutor(
+                max_workers=PLOT_WORKERS,
+                mp_context=multiprocessing.get_context("spawn"),
             )
-    elif analysis_type == "cellular_components":
-        if organism == "human":
-            processes = load_processes(
-                "static/processes_human_cellular_components.json"
+    return _plot_pool
+
+
+# Drop a pool whose worker died, so the next plot starts a fresh one (only
+# if it is still the current one, so a pool started since is kept)
+def reset_plot_pool(pool):
+    global _plot_pool
+    with _plot_pool_lock:
+        if _plot_pool is pool:
+            _plot_pool = None
+    pool.shutdown(wait=False)
+
+
+# Barplot and/or dotplot of the results of /api/enrich, as PNG or SVG.
+# Takes the same parameters as /api/enrich (for one library only), plus:
+#   kind     both (default), barplot or dotplot
+#   format   png (default) or svg
+# A render past WIKIORA_PLOT_TIMEOUT is answered with a 503, but matplotlib
+# cannot be interrupted: a render that has started runs to its end in its
+# worker, and only renders still queued are dropped.
+@app.route("/api/enrich/plot", methods=["GET", "POST"])
+def api_enrich_plot():
+    kind = get_param("kind", "both")
+    output_format = get_param("format", "png")
+    if kind not in PLOT_KINDS or output_format not in PLOT_FORMATS:
+        return jsonify({"error": "unsupported plot kind or format"}), 400
+    organism = get_param("organism")
+    genes, _ = resolve_genes(organism, parse_gene_list(get_param("gene_list")))
+    analysis_type = get_param("analysis_type")
+    try:
+        if requested_analysis_types(analysis_type) is not None:
+            raise ValueError("plots are of a single analysis_type")
+        library = gene_set_registry.get(organism, analysis_type)
+        view = result_view(request.args if request.method == "GET" else request.form)
+        background = get_background(
+            library, organism, parse_gene_list(get_param("background", ""))
+        )
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    key = (result_cache_key(library, genes, view, background), kind, output_format)
+    image = plot_cache.get(key)
+    if image is None:
+        results = cached_enrichment_results(library, genes, view, background)
+        if not results:
+            return jsonify({"error": "no enriched terms to plot"}), 404
+        rows = [{column: row[column] for column in PLOT_COLUMNS} for row in results]
+        pool = get_plot_pool()
+        try:
+            future = pool.submit(render_plot, rows, kind, output_format)
+            image = future.result(timeout=PLOT_TIMEOUT)
+        except TimeoutError:
+            future.cancel()
+            return jsonify({"error": "plot rendering timed out"}), 503
+        except BrokenProcessPool:
+            reset_plot_pool(pool)
+            return jsonify({"error": "plot renderer crashed, please retry"}), 503
+        plot_cache.set(key, image)
+    return Response(image, mimetype=PLOT_FORMATS[output_format])
+
+
+MAX_BATCH_SIZE = int(os.environ.get("WIKIORA_MAX_BATCH_SIZE", 1000))
+
+
+# Enrich many named gene lists against one library in a single request.
+# Expects a JSON body like
+#   {"organism": "human", "analysis_type": "cell_type_markers",
+#    "gene_lists": [{"name": "cluster_1", "genes": ["CD3E", "CD4"]}, ...]}
+# where "genes" may also be a string in the format accepted by /api/enrich.
+# An optional "background" (list or string) applies to every list.
+# Each entry of the response has the list name, its results and the symbol
+# resolution report of its genes.
+@app.route("/api/enrich/batch", methods=["POST"])
+def api_enrich_batch():
+    try:
+        batch = parse_batch(request.get_json(silent=True) or {})
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    return jsonify(batch_results(batch))
+
+
+# Check and parse the payload of a batch (see api_enrich_batch()). Raises
+# ValueError on bad input.
+def parse_batch(payload):
+    if not isinstance(payload, dict):
+        raise ValueError("the body must be a JSON object")
+    gene_lists = payload.get("gene_lists")
+    if not isinstance(gene_lists, list) or not gene_lists:
+        raise ValueError("gene_lists must be a non-empty array")
+    if len(gene_lists) > MAX_BATCH_SIZE:
+        raise ValueError(f"at most {MAX_BATCH_SIZE} gene lists per batch")
+
+    names = []
+    parsed = []
+    for i, entry in enumerate(gene_lists):
+        genes = entry.get("genes") if isinstance(entry, dict) else None
+        if isinstance(genes, str):
+            genes = parse_gene_list(genes)
+        if not isinstance(genes, list) or not all(isinstance(g, str) for g in genes):
+            raise ValueError(f"gene_lists[{i}].genes must be a list or string")
+        names.append(str(entry.get("name", i)))
+        parsed.append([gene for gene in genes if gene])
+
+    background_genes = payload.get("background") or []
+    if isinstance(background_genes, str):
+        background_genes = parse_gene_list(background_genes)
+    if not isinstance(background_genes, list) or not all(
+        isinstance(g, str) for g in background_genes
+    ):
+        raise ValueError("background must be a list or string")
+
+    organism = payload.get("organism")
+    library = gene_set_registry.get(organism, payload.get("analysis_type"))
+    view = result_view(payload)
+    background = get_background(
+        library, organism, [gene for gene in background_genes if gene]
+    )
+    parsed, reports = zip(*(resolve_genes(organism, genes) for genes in parsed))
+    return {
+        "library": library,
+        "view": view,
+        "background": background,
+        "names": names,
+        "gene_lists": parsed,
+        "reports": reports,
+    }
+
+
+# Results of a parsed batch. The lists missing from the result cache are
+# tested together, chunk lists at a time when a job is given, reporting its
+# progress after each chunk.
+def batch_results(batch, job=None, chunk=None):
+    library = batch["library"]
+    view = batch["view"]
+    background = batch["background"]
+    parsed = batch["gene_lists"]
+    usage.record(library.organism, library.analysis_type, "batch", len(parsed))
+    keys = [result_cache_key(library, genes, view, background) for genes in parsed]
+    results = [result_cache.get(key) for key in keys]
+    missing = [i for i, result in enumerate(results) if result is None]
+    chunk = chunk or len(missing)
+    for start in range(0, len(missing), chunk):
+        indices = missing[start : start + chunk]
+        with stage("statistics"):
+            statistics = enrichment_statistics(
+                library, [parsed[i] for i in indices], background
             )
-        else:
-            processes = load_processes(
-                "static/processes_mouse_cellular_components.json"
+        with stage("results"):
+            for row, i in enumerate(indices):
+                results[i] = enrichment_results(
+                    library,
+                    parsed[i],
+                    statistics_row(statistics, row),
+                    view,
+                    background,
+                )
+                result_cache.set(keys[i], results[i])
+        if job is not None:
+            job.progress(start + len(indices), len(missing))
+    return [
+        {"name": name, "results": result, "genes": report}
+        for name, result, report in zip(batch["names"], results, batch["reports"])
+    ]
+
+
+# Preranked GSEA permutations run in their own pool of worker processes,
+# in batches that each have a seed derived from the request seed, so the
+# results only depend on the seed. WIKIORA_GSEA_WORKERS=0 runs them in the
+# web worker.
+GSEA_WORKERS = int(os.environ.get("WIKIORA_GSEA_WORKERS", 2))
+GSEA_TIMEOUT = float(os.environ.get("WIKIORA_GSEA_TIMEOUT", 120))
+GSEA_MAX_PERMUTATIONS = int(os.environ.get("WIKIORA_GSEA_MAX_PERMUTATIONS", 10000))
+GSEA_PARAMETERS = (
+    ("permutations", int, 1000),
+    ("seed", int, 0),
+    ("weight", float, 1.0),
+    ("min_size", int, 15),
+    ("max_size", int, 500),
+)
+GSEA_COLUMNS = ["Gene Set Size", "ES", "NES", "p-value", "q-value"]
+_gsea_pool = None
+_gsea_pool_lock = threading.Lock()
+
+
+def get_gsea_pool():
+    global _gsea_pool
+    with _gsea_pool_lock:
+        if _gsea_pool is None:
+            _gsea_pool = ProcessPoolExecutor(
+                max_workers=GSEA_WORKERS,
+                mp_context=multiprocessing.get_context("spawn"),
             )
-    else:  # cell_type_markers is default
-        if organism == "human":
-            processes = load_processes("static/processes_human_cell_type.json")
-        else:
-            processes = load_processes("static/processes_mouse_cell_type.json")
+    return _gsea_pool
 
-    default_genes = select_random_process(processes)
-    separator = select_random_separator()
-    default_genes_str = separator.join(default_genes)
-    return default_genes_str
 
+# Drop a pool whose worker crashed (only if it is still the current one, so
+# a pool started since is kept)
+def reset_gsea_pool(pool):
+    global _gsea_pool
+    with _gsea_pool_lock:
+        if _gsea_pool is pool:
+            _gsea_pool = None
+    pool.shutdown(wait=False)
 
-@app.route("/api/enrich", methods=["GET", "POST"])
-def api_enrich():
-    organism = (
-        request.args.get("organism")
-        if request.method == "GET"
-        else request.form.get("organism")
-    )
-    analysis_type = (
-        request.args.get("analysis_type")
-        if request.method == "GET"
-        else request.form.get("analysis_type")
+
+# Map function over the permutation batches in the pool. Past the timeout
+# (from the call) the iteration raises TimeoutError and the batches of this
+# call that have not started are cancelled; the pool is shared, so the
+# batches already running (one per worker at most) run to their end.
+def gsea_map(function, *iterables, timeout=GSEA_TIMEOUT):
+    if GSEA_WORKERS <= 0:
+        return map(function, *iterables)
+    pool = get_gsea_pool()
+    try:
+        results = pool.map(function, *iterables, timeout=timeout)
+    except BrokenProcessPool:
+        reset_gsea_pool(pool)
+        raise
+    return _gsea_results(pool, results)
+
+
+def _gsea_results(pool, results):
+    try:
+        yield from results
+    except BrokenProcessPool:
+        reset_gsea_pool(pool)
+        raise
+
+
+# Parse a ranked list given as a {gene: score} object, a list of
+# [gene, score] pairs, or text with one "gene score" pair per line (tab,
+# space or comma separated, as in .rnk files; lines starting with # are
+# skipped). Returns the genes and scores. Raises ValueError on bad input.
+def parse_ranked_list(ranked):
+    if isinstance(ranked, dict):
+        pairs = list(ranked.items())
+    elif isinstance(ranked, list):
+        pairs = ranked
+    elif isinstance(ranked, str):
+        pairs = [
+            re.split(r"[\s,]+", line.strip(), maxsplit=1)
+            for line in ranked.splitlines()
+            if line.strip() and not line.startswith("#")
+        ]
+    else:
+        raise ValueError("ranked_list must be an object, a list of pairs or text")
+    genes = []
+    scores = []
+    for pair in pairs:
+        if not isinstance(pair, (list, tuple)) or len(pair) != 2:
+            raise ValueError(f"bad ranked_list entry: {pair!r}")
+        gene, score = pair
+        try:
+            score = float(score)
+        except (TypeError, ValueError):
+            raise ValueError(f"bad score for {gene}: {score!r}") from None
+        if not np.isfinite(score):
+            raise ValueError(f"bad score for {gene}: {score!r}")
+        genes.append(str(gene).strip())
+        scores.append(score)
+    if not genes:
+        raise ValueError("ranked_list is empty")
+    return genes, scores
+
+
+# GSEA statistics of a ranked list, going through the result cache. The
+# whole table is cached, so every page of it is served from one run.
+def cached_gsea(library, genes, scores, parameters, map_=gsea_map):
+    digest = hashlib.sha256(
+        json.dumps([genes, scores.tolist()]).encode("utf-8")
+    ).hexdigest()
+    key = (
+        "gsea",
+        library.name,
+        library.fingerprint,
+        get_version(),
+        digest,
+        tuple(sorted(parameters.items())),
     )
-    gene_list = (
-        request.args.get("gene_list")
-        if request.method == "GET"
-        else request.form.get("gene_list")
+    statistics = result_cache.get(key)
+    if statistics is None:
+        with stage("statistics"):
+            statistics = gsea(library, genes, scores, map=map_, **parameters)
+        tested = statistics["tested"]
+        statistics["q-value"] = np.ones(len(tested))
+        statistics["q-value"][tested] = benjamini_hochberg(
+            statistics["p-value"][tested]
+        )
+        result_cache.set(key, statistics)
+    return statistics
+
+
+# Records of the tested terms, ranked by p-value and then by |NES|
+def gsea_results(library, genes, statistics, view=DEFAULT_VIEW):
+    keep = statistics["tested"].copy()
+    if view["max_q"] is not None:
+        keep &= statistics["q-value"] <= view["max_q"]
+    candidates = np.flatnonzero(keep)
+    order = np.lexsort(
+        (-np.abs(statistics["NES"][candidates]), statistics["p-value"][candidates])
     )
-    genes = parse_gene_list(gene_list)
+    offset = view["offset"]
+    end = None if view["limit"] is None else offset + view["limit"]
     results = []
+    for j in candidates[order[offset:end]]:
+        record = {
+            "Term": library.terms[j],
+            "Description": library.descriptions[j],
+            "Wikipedia URL": library.wikipedia_urls[j],
+            "Leading Edge": overlap_info(leading_edge(library, genes, statistics, j)),
+        }
+        for column in GSEA_COLUMNS:
+            record[column] = statistics[column][j].item()
+        results.append(record)
+    return results
 
-    if analysis_type == "biological_processes":
-        if organism == "human":
-            gene_sets = load_gmt("static/gene_sets_human_biological_processes.gmt")
-        else:
-            gene_sets = load_gmt("static/gene_sets_mouse_biological_processes.gmt")
-    elif analysis_type == "molecular_functions":
-        if organism == "human":
-            gene_sets = load_gmt("static/gene_sets_human_molecular_functions.gmt")
-        else:
-            gene_sets = load_gmt("static/gene_sets_mouse_molecular_functions.gmt")
-    elif analysis_type == "cellular_components":
-        if organism == "human":
-            gene_sets = load_gmt("static/gene_sets_human_cellular_components.gmt")
-        else:
-            gene_sets = load_gmt("static/gene_sets_mouse_cellular_components.gmt")
-    else:  # cell_type_markers is default
-        if organism == "human":
-            gene_sets = load_gmt("static/gene_sets_human_cell_type.gmt")
-        else:
-            gene_sets = load_gmt("static/gene_sets_mouse_cell_type.gmt")
-
-    # Total number of genes in the background
-    unique_genes = set()
-    for details in gene_sets.values():
-        unique_genes.update(details["genes"])
-    M = len(unique_genes)
-    N = len(genes)
-    total_gene_sets = len(gene_sets)
-
-    all_results = []
-    for term, details in gene_sets.items():
-        overlap = set(genes).intersection(details["genes"])
-        x = len(overlap)
-        n = len(details["genes"])
-        p_value = hypergeometric_test(M, n, N, x)
-        odds_ratio = (1.0 * x * (M - n - N + x)) / max(1.0 * (n - x) * (N - x), 1)
-        combined_score = -np.log10(p_value) * odds_ratio
-        overlap_info = []
-        for gene in overlap:
-            gene_info = genes_data.get(gene, {})
-            gene_link = gene_info.get(
-                "wikipediaLink", f"https://en.wikipedia.org/wiki/{gene}"
-            )
-            gene_status = gene_info.get("pageStatus", "red")
-            overlap_info.append(
-                {"gene": gene, "link": gene_link, "status": gene_status}
-            )
-        all_results.append(
-            {
-                "Term": term,
-                "Description": details["description"],
-                "Wikipedia URL": details["wikipedia_url"],
-                "Overlap": overlap_info,
-                "Count": x,
-                "Gene Set Size": n,  # Include Gene Set Size in the results
-                "p-value": p_value,
-                "Odds Ratio": odds_ratio,
-                "Combined Score": combined_score,
-                "Gene Ratio": x / n,  # Add Gene Ratio metric
-            }
-        )
 
-    if all_results:
-        results_df = pd.DataFrame(all_results)
-        # Apply Benjamini-Hochberg correction considering the total number of gene sets
-        results_df["q-value"] = multipletests(results_df["p-value"], method="fdr_bh")[1]
-        # Filter to include only those sets with overlap >= 1
-        results_df = results_df[results_df["Count"] >= 1]
-        results_df = results_df.sort_values(by="p-value").head(
-            10
-        )  # Show only the top 10 enriched sets with lowest p-values
-        results = results_df.to_dict(orient="records")
+# Preranked gene set enrichment analysis of a list of genes with scores
+# (e.g. the fold changes or statistics of a differential expression
+# analysis) against one library. Takes a JSON body (or form fields) with
+# organism, analysis_type and ranked_list (see parse_ranked_list()), and
+# optionally:
+#   permutations       size of the null distribution (default 1000)
+#   seed               seed of the permutations (default 0)
+#   weight             exponent of the scores in the running sum (default 1)
+#   min_size, max_size only terms with this many genes in the ranked list
+#                      are tested (default 15 and 500)
+#   limit, offset, max_q, report as in /api/enrich
+# Records have the term, its leading edge genes, the number of its genes in
+# the ranked list, ES, NES, the permutation p-value and its
+# Benjamini-Hochberg q-value.
+@app.route("/api/gsea", methods=["POST"])
+def api_gsea():
+    payload = request.get_json(silent=True)
+    if payload is None:
+        payload = request.form
+    try:
+        analysis = parse_gsea(payload)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    try:
+        return jsonify(gsea_response(analysis))
+    except TimeoutError:
+        return jsonify({"error": "GSEA permutations timed out"}), 503
+    except BrokenProcessPool:
+        return jsonify({"error": "GSEA worker crashed, please retry"}), 503
+
 
-    return jsonify(results)
+# Check and parse the payload of a GSEA request (see api_gsea()). Raises
+# ValueError on bad input.
+def parse_gsea(payload):
+    if not isinstance(payload, dict):
+        raise ValueError("the body must be a JSON object")
+    organism = payload.get("organism")
+    library = gene_set_registry.get(organism, payload.get("analysis_type"))
+    genes, scores = parse_ranked_list(payload.get("ranked_list"))
+    view = result_view(payload)
+    try:
+        parameters = {
+            name: convert(payload.get(name, default))
+            for name, convert, default in GSEA_PARAMETERS
+        }
+    except TypeError as e:
+        raise ValueError(str(e)) from None
+    if not 1 <= parameters["permutations"] <= GSEA_MAX_PERMUTATIONS:
+        raise ValueError(f"permutations must be between 1 and {GSEA_MAX_PERMUTATIONS}")
+    genes, report = resolve_genes(organism, genes)
+    genes, scores = ranked_list(genes, scores)
+    return {
+        "library": library,
+        "genes": genes,
+        "scores": scores,
+        "view": view,
+        "parameters": parameters,
+        "report": str(payload.get("report", "false")).lower() in ("1", "true"),
+        "genes_report": report,
+    }
+
+
+# Response to a parsed GSEA request. With a job, the permutations have no
+# time limit and each finished batch of them is reported as progress.
+def gsea_response(analysis, job=None):
+    library = analysis["library"]
+    genes = analysis["genes"]
+    usage.record(library.organism, library.analysis_type, "gsea")
+    map_ = gsea_map
+    if job is not None:
+
+        def map_(function, *iterables):
+            total = len(iterables[0])
+            results = gsea_map(function, *iterables, timeout=None)
+            for done, result in enumerate(results, 1):
+                job.progress(done, total)
+                yield result
+
+    statistics = cached_gsea(
+        library, genes, analysis["scores"], analysis["parameters"], map_
+    )
+    results = gsea_results(library, genes, statistics, analysis["view"])
+    if analysis["report"]:
+        return {"results": results, "genes": analysis["genes_report"]}
+    return results
+
+
+# Large batches and GSEA runs can be submitted as jobs instead, which run in
+# a pool of WIKIORA_JOB_WORKERS threads while the client polls for them.
+# Results are kept WIKIORA_JOB_TTL seconds after the job ends and a client
+# (by IP address) can have WIKIORA_JOBS_PER_CLIENT unfinished jobs.
+job_queue = JobQueue(
+    DATABASE,
+    workers=int(os.environ.get("WIKIORA_JOB_WORKERS", 2)),
+    ttl=float(os.environ.get("WIKIORA_JOB_TTL", 3600)),
+    per_client=int(os.environ.get("WIKIORA_JOBS_PER_CLIENT", 2)),
+)
+# Lists of a batch job tested per progress report
+JOB_BATCH_CHUNK = 50
+JOB_TYPES = {
+    "batch": (
+        parse_batch,
+        lambda job, batch: batch_results(batch, job, JOB_BATCH_CHUNK),
+    ),
+    "gsea": (parse_gsea, lambda job, analysis: gsea_response(analysis, job)),
+}
+
+
+# The client address set by ProxyFix from the trusted proxies, never from
+# headers the client itself sent
+def job_client():
+    return request.remote_addr
+
+
+def job_status(job):
+    return dict(
+        job,
+        links={
+            "self": f"/api/jobs/{job['id']}",
+            "result": f"/api/jobs/{job['id']}/result",
+        },
+    )
+
+
+# Submit a job. Expects a JSON body with "type" ("batch" or "gsea") and the
+# payload of /api/enrich/batch or /api/gsea. Answers 202 with the job status:
+#   {"id", "kind", "status" (queued, running, done, failed or cancelled),
+#    "progress" (0 to 1), "cancel_requested", "error", "created_at",
+#    "started_at", "finished_at", "expires_at", "links"}
+# The payload is checked before the job is queued, so bad input gets a 400
+# right away; a client over its limit of unfinished jobs gets a 429.
+@app.route("/api/jobs", methods=["POST"])
+def api_submit_job():
+    payload = request.get_json(silent=True) or {}
+    if not isinstance(payload, dict):
+        return jsonify({"error": "the body must be a JSON object"}), 400
+    if payload.get("type") not in JOB_TYPES:
+        return jsonify({"error": f"type must be one of {', '.join(JOB_TYPES)}"}), 400
+    parse, run = JOB_TYPES[payload["type"]]
+    try:
+        job = job_queue.submit(job_client(), payload["type"], run, parse(payload))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except TooManyJobs as e:
+        return jsonify({"error": str(e)}), 429
+    response = jsonify(job_status(job))
+    response.headers["Location"] = f"/api/jobs/{job['id']}"
+    return response, 202
+
+
+@app.route("/api/jobs/<job_id>", methods=["GET"])
+def api_job(job_id):
+    job = job_queue.get(job_id)
+    if job is None:
+        return jsonify({"error": "unknown or expired job"}), 404
+    return jsonify(job_status(job))
+
+
+# The result of a finished job, in the format of the synchronous endpoint;
+# 409 with the job status while it is not done
+@app.route("/api/jobs/<job_id>/result", methods=["GET"])
+def api_job_result(job_id):
+    row = job_queue.result(job_id)
+    if row is None:
+        return jsonify({"error": "unknown or expired job"}), 404
+    status, result = row
+    if status != "done":
+        return jsonify(job_status(job_queue.get(job_id))), 409
+    return Response(result, mimetype="application/json")
+
+
+@app.route("/api/jobs/<job_id>", methods=["DELETE"])
+def api_cancel_job(job_id):
+    job = job_queue.cancel(job_id)
+    if job is None:
+        return jsonify({"error": "unknown or expired job"}), 404
+    return jsonify(job_status(job))
 
 
 @app.route("/enrich", methods=["GET", "POST"])
@@ -296,10 +1298,184 @@ def enrich():
         if request.method == "GET"
         else request.form.get("gene_list")
     )
-    response = api_enrich()
-    results = response.get_json()
-    increment_counter()
-    return render_template("results.html", results=results)
+    with stage("library"):
+        library = gene_set_registry.get(organism, analysis_type)
+    with stage("resolve"):
+        genes, report = resolve_genes(organism, parse_gene_list(gene_list))
+    results = cached_enrichment_results(library, genes)
+    usage.record(library.organism, library.analysis_type, "web", counted=True)
+    with stage("render"):
+        return render_template("results.html", results=results, genes=report)
+
+
+# Download records of the build manifest (see downloads.py), read once per
+# process and again after the gene sets are reloaded
+_download_index = None
+_download_index_lock = threading.Lock()
+
+
+def get_download_index():
+    global _download_index
+    if _download_index is None:
+        with _download_index_lock:
+            if _download_index is None:
+                _download_index = download_index()
+    return _download_index
+
+
+def _clear_download_index(names):
+    global _download_index
+    _download_index = None
+
+
+gene_set_registry.add_reload_listener(_clear_download_index)
+# Zipped bundles of each organism's files, by organism and version
+bundle_cache = LRUCache(maxsize=len(ORGANISMS) * 2)
+gene_set_registry.add_reload_listener(lambda names: bundle_cache.clear())
+# Seconds a client may keep a bundle requested by its version
+BUNDLE_MAX_AGE = 365 * 24 * 3600
+
+
+# The current version of an organism's bundle and its archive, zipped on
+# first use (preload() zips them in the gunicorn master)
+def get_bundle(organism):
+    records = bundle_records(organism, get_download_index())
+    version = bundle_version(records)
+    bundle = bundle_cache.get((organism, version))
+    if bundle is None:
+        bundle = build_bundle(organism, records)
+        bundle_cache.set((organism, version), bundle)
+    return version, bundle
+
+
+# The GMT and processes files of the manifest are served as the compressed
+# copy the client accepts, with their content hash as ETag, so conditional
+# requests get a 304 until the next build. Other static files are served
+# as before.
+@app.endpoint("static")
+def static(filename):
+    # Paths with .. segments or outside static/ are not found, before the
+    # manifest is looked at
+    path = safe_join(app.static_folder, filename)
+    if path is None or ".." in filename.split("/"):
+        abort(404)
+    record = current_record(get_download_index(), path, app.static_folder)
+    if record is None:
+        return app.send_static_file(filename)
+    encoding = negotiate(record, path, request.accept_encodings)
+    response = send_file(
+        compressed_path(path, encoding) if encoding else path,
+        mimetype=mimetypes.guess_type(filename)[0] or "application/octet-stream",
+        etag=download_etag(record, encoding),
+        max_age=0,
+        conditional=True,
+    )
+    if encoding:
+        response.headers["Content-Encoding"] = encoding
+    response.vary.add("Accept-Encoding")
+    return response
+
+
+# All the GMT and processes files of an organism in one zip archive, with a
+# manifest.json of their hashes. Its version is a hash of theirs: with
+# ?version= the archive of that version is served (404 once it has been
+# replaced) and may be cached for good.
+@app.route("/download/bundle/<organism>")
+def download_bundle(organism):
+    if organism not in ORGANISMS:
+        return (
+            jsonify({"error": f"organism must be one of {', '.join(ORGANISMS)}"}),
+            400,
+        )
+    version, bundle = get_bundle(organism)
+    requested = request.args.get("version")
+    if requested is not None and requested != version:
+        return (
+            jsonify(
+                {"error": "unknown or replaced bundle version", "version": version}
+            ),
+            404,
+        )
+    response = send_file(
+        io.BytesIO(bundle),
+        mimetype="application/zip",
+        as_attachment=True,
+        download_name=f"wikiora_{organism}_{version}.zip",
+        etag=version,
+        max_age=BUNDLE_MAX_AGE if requested else 0,
+        conditional=True,
+    )
+    if requested:
+        response.cache_control.immutable = True
+    response.headers["X-Bundle-Version"] = version
+    return response
+
+
+# Cache, job and library gauges, read when /metrics is scraped
+CACHES = {
+    "result": result_cache,
+    "background": background_cache,
+    "plot": plot_cache,
+    "bundle": bundle_cache,
+}
+for field, name, documentation, kind in (
+    ("size", "wikiora_cache_entries", "Entries in each cache", "gauge"),
+    ("hits", "wikiora_cache_hits_total", "Lookups found in each cache", "counter"),
+    (
+        "misses",
+        "wikiora_cache_misses_total",
+        "Lookups missing from each cache",
+        "counter",
+    ),
+):
+    metrics.gauge(
+        name,
+        documentation,
+        lambda field=field: {
+            (cache,): values.stats()[field] for cache, values in CACHES.items()
+        },
+        ("cache",),
+        kind,
+    )
+metrics.gauge(
+    "wikiora_jobs",
+    "Unexpired jobs by status",
+    lambda: {(status,): job_queue.counts().get(status, 0) for status in JOB_STATUSES},
+    ("status",),
+)
+metrics.gauge(
+    "wikiora_gene_set_libraries_loaded",
+    "Gene set libraries loaded by this process",
+    lambda: len(gene_set_registry.loaded()),
+)
+metrics.gauge(
+    "wikiora_usage_pending_lists",
+    "Enriched lists counted but not written to the database yet",
+    usage.pending,
+)
+
+
+@app.route("/metrics", methods=["GET"])
+def get_metrics():
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+
+@app.route("/api/cache_stats", methods=["GET"])
+def cache_stats():
+    return jsonify(result_cache.stats())
+
+
+# Re-read the libraries generate_gmt.py has rebuilt (according to the
+# manifest), or all of them with all=1, without restarting the server. Only
+# enabled when WIKIORA_RELOAD_TOKEN is set.
+@app.route("/api/reload_gene_sets", methods=["POST"])
+def reload_gene_sets():
+    token = os.environ.get("WIKIORA_RELOAD_TOKEN")
+    if not token or request.headers.get("X-Reload-Token") != token:
+        return jsonify({"error": "forbidden"}), 403
+    if get_param("all", "0") in ("1", "true"):
+        return jsonify({"reloaded": gene_set_registry.reload()})
+    return jsonify({"reloaded": gene_set_registry.reload_changed()})
 
 
 @app.route("/download")
@@ -312,85 +1488,35 @@ def about():
     return render_template("about.html")
 
 
-# Not currently in use. May be used in the future as an API for download.
-def plot_results(df):
-    # Calculate -logP for the barplot
-    df["-logP"] = -np.log10(df["q-value"])
-
-    # Cap the Count values at 30 for dot sizes
-    df["Count"] = np.minimum(df["Count"], 30)
-
-    # Sort by Gene Ratio for dotplot
-    df_sorted_by_gene_ratio = df.sort_values(by="Gene Ratio", ascending=False)
-    plt.figure(figsize=(12, 12))
-
-    cmap = plt.cm.Blues_r
-
-    # Plot barplot
-    plt.subplot(2, 1, 1)
-    colors_barplot = cmap(df["q-value"])
-    barplot = sns.barplot(x="-logP", y="Description", data=df, palette=colors_barplot)
-    plt.axvline(-np.log10(0.05), color="red", linestyle="--", linewidth=1)
-    plt.xlabel("-log(q-value)", fontsize=14)
-    plt.ylabel("")
-    plt.title("Top 10 Enriched Terms by q-value", fontsize=16)
-    plt.xticks(fontsize=12)
-    plt.yticks(fontsize=12)
-
-    # Adding colorbar legend to barplot
-    sm = plt.cm.ScalarMappable(cmap=cmap, norm=plt.Normalize(vmin=0.0, vmax=1.0))
-    sm.set_array([])
-    cbar = plt.colorbar(sm, ax=barplot, orientation="vertical", pad=0.01)
-    cbar.set_label("q-value", fontsize=12)
-
-    # Plot dotplot
-    plt.subplot(2, 1, 2)
-    colors_dotplot = cmap(df_sorted_by_gene_ratio["q-value"])
-    dotplot = plt.scatter(
-        df_sorted_by_gene_ratio["Gene Ratio"],
-        df_sorted_by_gene_ratio["Description"],
-        s=df_sorted_by_gene_ratio["Count"] ** 0.7 * 23,
-        c=colors_dotplot,
-        edgecolors="black",  # Set the border color to black
-        linewidth=0.8,
-    )
-
-    cbar = plt.colorbar(sm, ax=plt.gca(), orientation="vertical", pad=0.01)
-    cbar.set_label("q-value", fontsize=12)
-
-    plt.xlabel("Gene Ratio (overlap/set length)", fontsize=14)
-    plt.ylabel("")
-    plt.title("Top 10 Enriched Terms by Gene Ratio", fontsize=16)
-    plt.xticks(fontsize=12)
-    plt.yticks(fontsize=12)
-    plt.gca().invert_yaxis()  # Invert the y-axis
-
-    # Adding dot size legend
-    example_sizes = [2, 10, 30]
-    for size in example_sizes:
-        plt.scatter(
-            [],
-            [],
-            c="k",
-            alpha=0.5,
-            s=size**0.7 * 23,
-            label=f'{size}{"+" if size == 30 else ""}',
-        )
+# Load what the requests share: the database tables, the gene set libraries,
+# their combined group and term overlap indexes, the symbol indexes, the gene
+# links, the example lists, the download bundles and the log factorials of
+# the hypergeometric test. wsgi.py calls it in the gunicorn master, so the
+# forked workers share all of it copy-on-write instead of each loading its
+# own copy on its first requests.
+def preload():
+    init_db()
+    gene_set_registry.load_all()
+    log_factorials(max(library.M for library in gene_set_registry.loaded()))
+    for organism in ORGANISMS:
+        symbol_registry.get(organism)
+        gene_set_registry.group(organism, list(ANALYSIS_TYPES))
+        for analysis_type in ANALYSIS_TYPES:
+            gene_set_registry.get(organism, analysis_type).term_overlaps()
+            get_example_pool(organism, analysis_type)
+        get_bundle(organism)
+    get_gene_links()
 
-    plt.legend(
-        scatterpoints=1,
-        frameon=True,
-        labelspacing=1,
-        title="Count",
-        loc="lower right",
-        fontsize=12,
-    )
 
-    plt.tight_layout()
-    plt.savefig("static/enrichment_plot.png", dpi=300)
+# Reload the libraries generate_gmt.py rebuilt and preload them again; the
+# gunicorn master does so on SIGHUP, before it forks the new workers
+def reload_data():
+    reloaded = gene_set_registry.reload_changed()
+    preload()
+    return reloaded
 
 
 if __name__ == "__main__":
-    init_db()
+    preload()
     debug_mode = os.environ.get("FLASK_DEBUG", "False").lower() in ["true", "1", "t"]
     app.run()
@@ -0,0 +1,301 @@
+"""Benchmark the enrichment path against the real gene set libraries.
+
+Runs, for both organisms and all four analysis types:
+
+- /api/enrich with lists of 10 to 10,000 genes, with a cold result cache
+  (cleared before every request) and a warm one (the same request again)
+- /api/enrich/batch with batches of 1 to 100 lists of 100 genes
+- load_gmt() + compilation and the memory-mapped binary load of each
+  library, and parse_gene_list() on the largest list
+
+and reports the p50/p95 latency, the throughput and the peak memory
+allocated (tracemalloc, in a separate untimed run) of each scenario.
+Gene lists are drawn from the organisms' genes with a fixed seed, so runs
+of different commits see the same requests.
+
+    python benchmark.py [--quick] [--output results.json]
+                        [--compare baseline.json --threshold 0.2]
+
+With --compare, exits with status 1 when the p50 of a scenario is more
+than threshold (a fraction) slower than in the baseline.
+"""
+
+import argparse
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+
+import numpy as np
+
+HERE = Path(__file__).parent.resolve()
+ORGANISMS = ("human", "mouse")
+LIST_SIZES = (10, 100, 1000, 10000)
+BATCH_SIZES = (1, 10, 100)
+BATCH_LIST_SIZE = 100
+# Differences below this many milliseconds are noise, whatever their ratio
+MIN_REGRESSION_MS = 0.5
+
+
+def percentile(times, q):
+    return float(np.percentile(times, q)) * 1000
+
+
+def summarize(times, lists=1):
+    total = sum(times)
+    return {
+        "runs": len(times),
+        "p50_ms": round(percentile(times, 50), 3),
+        "p95_ms": round(percentile(times, 95), 3),
+        "mean_ms": round(total / len(times) * 1000, 3),
+        "throughput_per_s": round(len(times) / total, 2),
+        "lists_per_s": round(len(times) * lists / total, 2),
+    }
+
+
+# Peak memory allocated by one call of run, in KiB
+def peak_memory_kb(run):
+    tracemalloc.start()
+    try:
+        run()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return round(peak / 1024, 1)
+
+
+# Time repeat calls of run, calling before (untimed) ahead of each. A first
+# untimed call takes the one-off costs (lazy imports, library loading) out
+# of the figures; startup_report.py measures those.
+def measure(run, repeat, before=None, lists=1):
+    if before is not None:
+        before()
+    run()
+    times = []
+    for _ in range(repeat):
+        if before is not None:
+            before()
+        start = time.perf_counter()
+        run()
+        times.append(time.perf_counter() - start)
+    result = summarize(times, lists)
+    if before is not None:
+        before()
+    result["peak_kb"] = peak_memory_kb(run)
+    return result
+
+
+class Benchmark:
+    def __init__(self, repeat, seed, list_sizes, batch_sizes):
+        self.repeat = repeat
+        self.list_sizes = list_sizes
+        self.batch_sizes = batch_sizes
+        self.rng = np.random.default_rng(seed)
+        self.results = {}
+        self._genes = {}
+
+        os.chdir(HERE)
+        sys.path.insert(0, str(HERE))
+        import app
+
+        self.app = app
+        self.client = app.app.test_client()
+        # Usage counts of the benchmark requests go to a scratch database
+        self._scratch = tempfile.TemporaryDirectory()
+        app.usage.database = os.path.join(self._scratch.name, "benchmark.db")
+        app.usage.flush_interval = 0
+
+    def clear_caches(self):
+        self.app.result_cache.clear()
+        self.app.background_cache.clear()
+
+    # Random lists of the genes of an organism's libraries
+    def gene_lists(self, organism, size, count=1):
+        genes = self._genes.get(organism)
+        if genes is None:
+            registry = self.app.gene_set_registry
+            genes = sorted(
+                set().union(
+                    *(registry.get(organism, t).genes for t in self.app.ANALYSIS_TYPES)
+                )
+            )
+            self._genes[organism] = genes
+        return [
+            list(self.rng.choice(genes, size, replace=size > len(genes)))
+            for _ in range(count)
+        ]
+
+    def post(self, path, **kwargs):
+        response = self.client.post(path, **kwargs)
+        if response.status_code != 200:
+            raise RuntimeError(f"{path} answered {response.status_code}")
+
+    def record(self, name, result):
+        self.results[name] = result
+        print(
+            f"{name:55s} p50 {result['p50_ms']:9.2f} ms  p95 {result['p95_ms']:9.2f} ms"
+            f"  {result['peak_kb'] / 1024:7.1f} MB",
+            file=sys.stderr,
+        )
+
+    def run_loading(self):
+        from gene_sets import GeneSetLibrary
+
+        for organism in ORGANISMS:
+            for analysis_type in self.app.ANALYSIS_TYPES:
+                for source, load in (
+                    ("gmt", GeneSetLibrary.from_gmt),
+                    ("binary", GeneSetLibrary.from_binary),
+                ):
+                    self.record(
+                        f"load/{source}/{organism}/{analysis_type}",
+                        measure(lambda: load(organism, analysis_type), self.repeat),
+                    )
+        genes = ", ".join(self.gene_lists("human", max(self.list_sizes))[0])
+        self.record(
+            f"parse_gene_list/n={max(self.list_sizes)}",
+            measure(lambda: self.app.parse_gene_list(genes), self.repeat),
+        )
+
+    def run_enrich(self):
+        for organism in ORGANISMS:
+            for analysis_type in self.app.ANALYSIS_TYPES:
+                for size in self.list_sizes:
+                    data = {
+                        "organism": organism,
+                        "analysis_type": analysis_type,
+                        "gene_list": ", ".join(self.gene_lists(organism, size)[0]),
+                    }
+                    run = lambda: self.post("/api/enrich", data=data)
+                    name = f"enrich/{organism}/{analysis_type}/n={size}"
+                    self.record(
+                        f"{name}/cold", measure(run, self.repeat, self.clear_caches)
+                    )
+                    run()
+                    self.record(f"{name}/warm", measure(run, self.repeat))
+
+    def run_batch(self):
+        for organism in ORGANISMS:
+            for analysis_type in self.app.ANALYSIS_TYPES:
+                for count in self.batch_sizes:
+                    payload = {
+                        "organism": organism,
+                        "analysis_type": analysis_type,
+                        "gene_lists": [
+                            {"name": str(i), "genes": genes}
+                            for i, genes in enumerate(
+                                self.gene_lists(organism, BATCH_LIST_SIZE, count)
+                            )
+                        ],
+                    }
+                    run = lambda: self.post("/api/enrich/batch", json=payload)
+                    self.record(
+                        f"batch/{organism}/{analysis_type}/lists={count}/cold",
+                        measure(run, self.repeat, self.clear_caches, lists=count),
+                    )
+
+    def run(self):
+        self.run_loading()
+        self.run_enrich()
+        self.run_batch()
+        return self.results
+
+
+def metadata(args):
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=HERE,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        "commit": commit,
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "machine": platform.machine(),
+        "repeat": args.repeat,
+        "seed": args.seed,
+    }
+
+
+# Scenarios whose p50 grew by more than threshold (and MIN_REGRESSION_MS)
+def regressions(results, baseline, threshold):
+    found = []
+    for name, result in results.items():
+        before = baseline.get(name)
+        if before is None:
+            continue
+        ratio = result["p50_ms"] / before["p50_ms"] if before["p50_ms"] else 1.0
+        slower = result["p50_ms"] - before["p50_ms"]
+        if ratio > 1 + threshold and slower > MIN_REGRESSION_MS:
+            found.append((name, before["p50_ms"], result["p50_ms"], ratio))
+    return found
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--repeat", type=int, default=20, help="runs per scenario")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--quick", action="store_true", help="5 runs, lists of 10 and 1,000 genes"
+    )
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    parser.add_argument("--compare", help="JSON results of a baseline run")
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.2,
+        help="allowed p50 slowdown against the baseline (default 0.2 = 20%%)",
+    )
+    args = parser.parse_args()
+    list_sizes = LIST_SIZES
+    batch_sizes = BATCH_SIZES
+    if args.quick:
+        args.repeat = 5
+        list_sizes = (10, 1000)
+        batch_sizes = (10,)
+
+    benchmark = Benchmark(args.repeat, args.seed, list_sizes, batch_sizes)
+    report = {
+        "meta": metadata(args),
+        "results": benchmark.run(),
+        "max_rss_mb": round(
+            resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1
+        ),
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        found = regressions(report["results"], baseline["results"], args.threshold)
+        print(
+            f"compared with {baseline['meta'].get('commit')}: "
+            f"{len(found)} regressions over {args.threshold:.0%}",
+            file=sys.stderr,
+        )
+        for name, before, after, ratio in found:
+            print(
+                f"REGRESSION {name}: {before:.2f} -> {after:.2f} ms ({ratio:.2f}x)",
+                file=sys.stderr,
+            )
+        sys.exit(1 if found else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,177 @@
+"""Precompressed, content-addressed downloads of the gene set files.
+
+generate_gmt.py writes a gzip copy (and a brotli copy when the brotli
+package is installed) next to the GMT and processes file of every library,
+and records the SHA-256 and size of each file and copy in the build
+manifest. The server serves the copy a client accepts, with the hash as
+its ETag, and zips the files of an organism into one bundle whose version
+is a hash of theirs.
+"""
+
+import gzip
+import hashlib
+import io
+import json
+import zipfile
+from pathlib import Path
+
+from gene_sets import (
+    ANALYSIS_TYPES,
+    STATIC,
+    atomic_write,
+    gmt_path,
+    matches_record,
+    processes_path,
+    read_manifest,
+)
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Suffix of the copy in each content coding, in order of preference
+ENCODINGS = {"br": ".br", "gzip": ".gz"}
+# Date of every file in a bundle, so the same files always give the same
+# archive (zip cannot store dates before 1980)
+BUNDLE_DATE = (1980, 1, 1, 0, 0, 0)
+
+
+# The content codings this installation can write
+def available_encodings():
+    return [encoding for encoding in ENCODINGS if encoding != "br" or brotli]
+
+
+def compressed_path(path, encoding):
+    path = Path(path)
+    return path.with_name(path.name + ENCODINGS[encoding])
+
+
+def _compress(data, encoding):
+    if encoding == "gzip":
+        # Without a timestamp, unchanged files give unchanged copies
+        return gzip.compress(data, compresslevel=9, mtime=0)
+    return brotli.compress(data, quality=11)
+
+
+# The files of a library offered for download
+def download_paths(organism, analysis_type, static_dir=STATIC):
+    return [
+        gmt_path(organism, analysis_type, static_dir),
+        processes_path(organism, analysis_type, static_dir),
+    ]
+
+
+# Write the compressed copies of a file and return its manifest record:
+# {"sha256", "size", "mtime_ns", "encodings": {encoding: size of the copy}}.
+# Copies in codings this installation cannot write are removed, so none
+# goes stale.
+def compress_download(path):
+    path = Path(path)
+    data = path.read_bytes()
+    record = {
+        "sha256": hashlib.sha256(data).hexdigest(),
+        "size": len(data),
+        "mtime_ns": path.stat().st_mtime_ns,
+        "encodings": {},
+    }
+    for encoding in ENCODINGS:
+        if encoding not in available_encodings():
+            compressed_path(path, encoding).unlink(missing_ok=True)
+            continue
+        compressed = _compress(data, encoding)
+        with atomic_write(compressed_path(path, encoding), "wb") as f:
+            f.write(compressed)
+        record["encodings"][encoding] = len(compressed)
+    return record
+
+
+# Download records of the manifest by file name ({} without a manifest)
+def download_index(static_dir=STATIC):
+    index = {}
+    for entry in read_manifest(static_dir).values():
+        index.update(entry.get("downloads", {}))
+    return index
+
+
+# The record of a file if it still matches it on disk (see
+# matches_record()): a file replaced by hand after the build falls back to
+# plain static serving. Records are by file name, so only files directly in
+# static_dir match them.
+def current_record(index, path, static_dir=STATIC):
+    path = Path(path)
+    record = index.get(path.name)
+    if record is None or path.parent.resolve() != Path(static_dir).resolve():
+        return None
+    if not matches_record(path, record):
+        return None
+    return record
+
+
+# The coding of the best copy the client accepts (None for the file
+# itself). accept is the request's Accept-Encoding header, parsed by
+# werkzeug; copies missing or of another size than recorded are skipped.
+def negotiate(record, path, accept):
+    best, best_quality = None, 0
+    for encoding, size in record["encodings"].items():
+        quality = accept.quality(encoding)
+        if quality <= best_quality:
+            continue
+        try:
+            if compressed_path(path, encoding).stat().st_size != size:
+                continue
+        except FileNotFoundError:
+            continue
+        best, best_quality = encoding, quality
+    return best
+
+
+# Strong ETag of a file, or of its copy in an encoding
+def download_etag(record, encoding=None):
+    if encoding is None:
+        return record["sha256"]
+    return f"{record['sha256']}-{ENCODINGS[encoding][1:]}"
+
+
+# Records of the files of an organism's bundle, by file name, from the
+# manifest or, for files it does not describe, hashed on the spot
+def bundle_records(organism, index, static_dir=STATIC):
+    records = {}
+    for analysis_type in ANALYSIS_TYPES:
+        for path in download_paths(organism, analysis_type, static_dir):
+            record = current_record(index, path, static_dir)
+            if record is None:
+                data = path.read_bytes()
+                record = {
+                    "sha256": hashlib.sha256(data).hexdigest(),
+                    "size": len(data),
+                }
+            records[path.name] = {"sha256": record["sha256"], "size": record["size"]}
+    return records
+
+
+# Version of a bundle: a hash of the names and hashes of its files
+def bundle_version(records):
+    digest = hashlib.sha256()
+    for name, record in sorted(records.items()):
+        digest.update(f"{name}\t{record['sha256']}\n".encode("utf-8"))
+    return digest.hexdigest()[:16]
+
+
+# Zip archive of the files of an organism's bundle, with a manifest.json of
+# their hashes and sizes
+def build_bundle(organism, records, static_dir=STATIC):
+    version = bundle_version(records)
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w", zipfile.ZIP_DEFLATED, compresslevel=9) as zf:
+        manifest = {"organism": organism, "version": version, "files": records}
+        members = [("manifest.json", json.dumps(manifest, indent=2).encode("utf-8"))]
+        members += [
+            (name, Path(static_dir).joinpath(name).read_bytes()) for name in records
+        ]
+        for name, data in members:
+            info = zipfile.ZipInfo(name, date_time=BUNDLE_DATE)
+            info.compress_type = zipfile.ZIP_DEFLATED
+            info.external_attr = 0o644 << 16
+            zf.writestr(info, data, compresslevel=9)
+    return buffer.getvalue()
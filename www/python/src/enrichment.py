@@ -0,0 +1,215 @@
+import numpy as np
+from scipy import sparse
+
+import hypergeometric
+
+
+# Sorted, unique library indices of the genes of a list that are part of the
+# library background. Genes outside the background never overlap a term, so
+# they are simply left out.
+def gene_indices(library, genes):
+    gene_index = library.gene_index
+    return np.unique(
+        np.fromiter((gene_index[g] for g in genes if g in gene_index), dtype=np.int32)
+    )
+
+
+class Background:
+    """A user-supplied universe of genes, restricted to a library.
+
+    mask flags the library genes that are in the universe. M and
+    term_sizes are the size of the universe (per term for a LibraryGroup)
+    and of every term within it, recounted once from the incidence matrix,
+    so lists tested against the same background only pay for a mask lookup.
+    digest identifies the submitted genes in cache keys.
+    """
+
+    def __init__(self, library, genes, digest=None):
+        self.digest = digest
+        self.mask = np.zeros(len(library.genes), dtype=bool)
+        self.mask[gene_indices(library, genes)] = True
+        self.mask.setflags(write=False)
+        self.M = library.universe_size(self.mask)
+        self.term_sizes = library.incidence.T @ self.mask.astype(np.int64)
+        self.term_sizes.setflags(write=False)
+
+    # The gene indices (as returned by gene_indices()) in the universe
+    def restrict(self, indices):
+        return indices[self.mask[indices]]
+
+
+# Sparse (lists x genes) indicator matrix of the gene lists, leaving out
+# genes outside the background when there is one
+def query_matrix(library, gene_lists, background=None):
+    rows = []
+    cols = []
+    for i, genes in enumerate(gene_lists):
+        indices = gene_indices(library, genes)
+        if background is not None:
+            indices = background.restrict(indices)
+        rows.extend([i] * len(indices))
+        cols.extend(indices)
+    return sparse.csr_matrix(
+        (np.ones(len(rows), dtype=np.int32), (rows, cols)),
+        shape=(len(gene_lists), len(library.genes)),
+    )
+
+
+# Overlap counts of every list with every term, as a dense (lists x terms)
+# array, from a single sparse product with the library incidence matrix.
+def overlap_counts(library, queries):
+    return np.asarray((queries @ library.incidence).toarray(), dtype=np.int64)
+
+
+def enrichment_statistics(library, gene_lists, background=None):
+    """Over-representation statistics of each gene list against every term.
+
+    Returns a dict of (lists x terms) arrays with the same values the
+    original per-term loop produced: "Count", "Gene Set Size", "p-value",
+    "Odds Ratio", "Combined Score" and "Gene Ratio". As before, N is the
+    length of the submitted list, duplicates and unknown genes included.
+
+    With a Background, the universe M, the term sizes n and the lists are
+    all restricted to it, and N is the number of distinct list genes in it.
+    library may also be a LibraryGroup, whose M (and N, with a Background)
+    differ between the terms of its libraries.
+    """
+    queries = query_matrix(library, gene_lists, background)
+    x = overlap_counts(library, queries)
+    if background is None:
+        M = library.M
+        n = np.broadcast_to(library.term_sizes, x.shape)
+        N = np.array([len(genes) for genes in gene_lists], dtype=np.int64)[:, None]
+    else:
+        M = background.M
+        n = np.broadcast_to(background.term_sizes, x.shape)
+        N = library.list_sizes(queries)
+
+    # P(X >= 0) is exactly 1, so tails are only computed for the terms that
+    # overlap the list, which are usually a small fraction of the library.
+    # The combined score takes the log of the tail, which stays finite
+    # where the p-value underflows to 0.
+    log_p_value = np.zeros(x.shape)
+    hits = x > 0
+    log_p_value[hits] = hypergeometric.log_sf(
+        x[hits],
+        np.broadcast_to(M, x.shape)[hits],
+        n[hits],
+        np.broadcast_to(N, x.shape)[hits],
+    )
+    p_value = np.exp(log_p_value)
+    odds_ratio = (1.0 * x * (M - n - N + x)) / np.maximum(1.0 * (n - x) * (N - x), 1)
+    combined_score = -log_p_value / np.log(10) * odds_ratio
+    return {
+        "Count": x,
+        "Gene Set Size": n,
+        "p-value": p_value,
+        "Odds Ratio": odds_ratio,
+        "Combined Score": combined_score,
+        # Terms without genes in the background have no ratio to report
+        "Gene Ratio": np.divide(x, n, out=np.zeros(x.shape), where=n > 0),
+    }
+
+
+# Benjamini-Hochberg step-up adjusted p-values (q-values), computed the same
+# way as statsmodels' multipletests(method="fdr_bh")
+def benjamini_hochberg(p_values):
+    p_values = np.asarray(p_values, dtype=float)
+    n = len(p_values)
+    order = np.argsort(p_values)
+    q_sorted = p_values[order] / (np.arange(1, n + 1) / float(n))
+    q_sorted = np.minimum.accumulate(q_sorted[::-1])[::-1]
+    q_sorted[q_sorted > 1] = 1
+    q_values = np.empty_like(q_sorted)
+    q_values[order] = q_sorted
+    return q_values
+
+
+# Positions of the k smallest values (all of them when k is None), ordered
+# by value and then by position. Only the candidates that can make it into
+# the top k are sorted; ties at the cut-off are resolved by position, so
+# consecutive pages of the same ranking never overlap or skip a term.
+def top_k(values, k=None):
+    if k is None or k >= len(values):
+        return np.argsort(values, kind="stable")
+    if k <= 0:
+        return np.array([], dtype=np.intp)
+    threshold = np.partition(values, k - 1)[k - 1]
+    candidates = np.flatnonzero(values <= threshold)
+    return candidates[np.argsort(values[candidates], kind="stable")][:k]
+
+
+# Statistics of the i-th list, as returned by enrichment_statistics()
+def statistics_row(statistics, i):
+    return {column: values[i] for column, values in statistics.items()}
+
+
+# Genes of the list (given as gene_indices()) that are in the j-th term,
+# alphabetically sorted
+def overlap_genes(library, query_indices, j):
+    overlap = np.intersect1d(
+        library.term_gene_indices(j), query_indices, assume_unique=True
+    )
+    return [library.genes[i] for i in overlap]
+
+
+SIMILARITY_MEASURES = ("jaccard", "kappa")
+
+
+def term_similarity(library, terms, measure="jaccard"):
+    """Sparse (terms x terms) gene overlap similarity of the given terms.
+
+    Read from the library's term overlap index, so only pairs that share
+    genes are visited. "jaccard" is the shared genes over the genes of
+    either term; "kappa" is Cohen's kappa of the two terms' membership over
+    the library genes, as in DAVID's functional annotation clustering.
+    Pairs that share no genes are left out (their kappa is at most 0).
+    """
+    terms = np.asarray(terms, dtype=np.intp)
+    overlaps = library.term_overlaps()[terms][:, terms].tocoo()
+    a = overlaps.data.astype(float)
+    n_i = library.term_sizes[terms][overlaps.row].astype(float)
+    n_j = library.term_sizes[terms][overlaps.col].astype(float)
+    if measure == "jaccard":
+        similarity = a / (n_i + n_j - a)
+    elif measure == "kappa":
+        M = np.broadcast_to(library.M, len(library))[terms][overlaps.row] * 1.0
+        observed = (M - n_i - n_j + 2 * a) / M
+        expected = (n_i * n_j + (M - n_i) * (M - n_j)) / M**2
+        with np.errstate(divide="ignore", invalid="ignore"):
+            similarity = np.where(
+                expected < 1, (observed - expected) / (1 - expected), 1.0
+            )
+    else:
+        raise ValueError(f"unknown similarity measure: {measure}")
+    return sparse.csr_matrix(
+        (similarity, (overlaps.row, overlaps.col)), shape=(len(terms), len(terms))
+    )
+
+
+def collapse_terms(library, terms, measure="jaccard", threshold=0.5):
+    """Group redundant terms around representatives.
+
+    terms are ranked best first. Going down the ranking, each term not yet
+    grouped becomes the representative of a cluster made of the remaining
+    terms at least threshold similar to it. Returns (representative,
+    members, similarities) tuples in ranking order, with the members (and
+    their similarity to the representative) also in ranking order. The work
+    is proportional to the similar pairs, not to all pairs of terms.
+    """
+    terms = np.asarray(terms, dtype=np.intp)
+    similarity = term_similarity(library, terms, measure)
+    similarity.sort_indices()
+    grouped = np.zeros(len(terms), dtype=bool)
+    clusters = []
+    for i in range(len(terms)):
+        if grouped[i]:
+            continue
+        grouped[i] = True
+        start, end = similarity.indptr[i : i + 2]
+        others = similarity.indices[start:end]
+        values = similarity.data[start:end]
+        members = ~grouped[others] & (values >= threshold)
+        grouped[others[members]] = True
+        clusters.append((terms[i], terms[others[members]], values[members]))
+    return clusters
@@ -1,12 +1,18 @@
+import argparse
+import re
 import requests
-import json
 import time
 from pathlib import Path
+from gene_links import gene_links_path, records_from_json, write_gene_links
 
 HERE = Path(__file__).parent.resolve()
 STATIC = HERE.joinpath("static").resolve()
 
 SPARQL_ENDPOINT = "https://query.wikidata.org/sparql"
+# Seconds to connect, and to wait for the next bytes of the response
+TIMEOUT = (30, 300)
+# Seconds between attempts
+RETRY_DELAY = 5
 SPARQL_QUERY = """
 SELECT ?gene ?geneLabel (IF(BOUND(?wikipediaPage), "blue", "red") AS ?pageStatus) 
   (IF(!BOUND(?wikipediaPage), URI(CONCAT("https://en.wikipedia.org/wiki/", ?geneLabel)), ?wikipediaPage) AS ?wikipediaLink)
@@ -35,46 +41,93 @@ WHERE {
 """
 
 
-def fetch_sparql_results(endpoint, query, retries=3):
+# Escapes allowed inside literals of SPARQL TSV results
+TSV_ESCAPES = {"t": "\t", "n": "\n", "r": "\r"}
+
+
+# Value of a TSV result term: <iri>, "literal" (optionally followed by a
+# language tag or datatype), or empty when unbound
+def parse_term(term):
+    if term.startswith("<") and term.endswith(">"):
+        return term[1:-1]
+    if term.startswith('"'):
+        value = term[1 : term.rindex('"')]
+        return re.sub(r"\\(.)", lambda m: TSV_ESCAPES.get(m[1], m[1]), value)
+    return term
+
+
+# Yield the result rows as dicts while the response is downloaded. The
+# results are requested as TSV, one row per line, so neither the response
+# nor a parsed JSON document has to be held in memory. After a dropped
+# connection (or a stalled one, after TIMEOUT) the query starts over, so rows
+# can be yielded twice.
+def stream_sparql_rows(endpoint, query, retries=3, timeout=TIMEOUT):
     headers = {
-        "Accept": "application/sparql-results+json",
+        "Accept": "text/tab-separated-values",
         "User-Agent": "Mozilla/5.0 (compatible; myscript/1.0; +https://example.com/bot)",
     }
     for _ in range(retries):
         try:
-            response = requests.get(endpoint, headers=headers, params={"query": query})
-            response.raise_for_status()
-            return response.json()
+            with requests.get(
+                endpoint,
+                headers=headers,
+                params={"query": query},
+                stream=True,
+                timeout=timeout,
+            ) as response:
+                response.raise_for_status()
+                lines = response.iter_lines()
+                variables = [
+                    name.lstrip("?") for name in next(lines).decode().split("\t")
+                ]
+                for line in lines:
+                    if line:
+                        terms = line.decode("utf-8").split("\t")
+                        yield dict(zip(variables, map(parse_term, terms)))
+                return
         except requests.exceptions.HTTPError as e:
             if response.status_code == 403:
                 print(f"Access denied: {e}. Retrying...")
             else:
                 print(f"HTTP error occurred: {e}")
-            time.sleep(5)  # Wait before retrying
+            time.sleep(RETRY_DELAY)  # Wait before retrying
+        except (
+            requests.exceptions.ConnectionError,
+            requests.exceptions.ChunkedEncodingError,
+            requests.exceptions.Timeout,
+            StopIteration,
+        ) as e:
+            print(f"Connection error occurred: {e}. Retrying...")
+            time.sleep(RETRY_DELAY)
     raise requests.exceptions.HTTPError(
         f"Failed to fetch data after {retries} attempts"
     )
 
 
-def process_results(results):
-    genes = {}
-    for result in results["results"]["bindings"]:
-        gene_label = result["geneLabel"]["value"]
-        gene_info = {
-            "gene": result["gene"]["value"],
-            "pageStatus": result["pageStatus"]["value"],
-            "wikipediaLink": result["wikipediaLink"]["value"],
-        }
-        genes[gene_label] = gene_info
-    return genes
+# (symbol, page status, link) records of the result rows
+def process_results(rows):
+    for row in rows:
+        yield row["geneLabel"], row["pageStatus"], row["wikipediaLink"]
 
 
-def main():
-    results = fetch_sparql_results(SPARQL_ENDPOINT, SPARQL_QUERY)
-    genes = process_results(results)
-    with open(STATIC / "genes.json", "w") as f:
-        json.dump(genes, f, indent=4, sort_keys=True)
+def main(endpoint=SPARQL_ENDPOINT, output_file=None):
+    rows = stream_sparql_rows(endpoint, SPARQL_QUERY)
+    write_gene_links(output_file or gene_links_path(STATIC), process_results(rows))
 
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser(
+        description="Build the gene link index used by the results pages."
+    )
+    parser.add_argument("--endpoint", default=SPARQL_ENDPOINT)
+    parser.add_argument("--output", type=Path, default=gene_links_path(STATIC))
+    parser.add_argument(
+        "--from-json",
+        type=Path,
+        help="convert a genes.json file of older versions instead of querying",
+    )
+    args = parser.parse_args()
+    if args.from_json:
+        write_gene_links(args.output, records_from_json(args.from_json))
+    else:
+        main(args.endpoint, args.output)
@@ -0,0 +1,144 @@
+import json
+from pathlib import Path
+
+import numpy as np
+
+from gene_sets import STATIC, StringTable, read_arrays, write_arrays
+
+# Wikipedia link and page status ("blue" when the article exists, "red"
+# otherwise) of every gene symbol, as written by fetch_wikipedia_genes.py.
+# Stored in the binary layout of gene_sets.py:
+#
+# - symbols: the UTF-8 symbols, sorted, as one fixed-width bytes array that
+#   np.searchsorted can look up directly
+# - blue: the page status of each symbol, one bit per symbol
+# - url_index, urls_data, urls_offsets: the links that are not the default
+#   https://en.wikipedia.org/wiki/{symbol}, for the symbols listed in the
+#   sorted url_index
+GENE_LINKS_MAGIC = b"WIKIGLK\x01"
+DEFAULT_URL = "https://en.wikipedia.org/wiki/{}"
+
+
+def gene_links_path(static_dir=STATIC):
+    return Path(static_dir).joinpath("gene_links.bin")
+
+
+# Arrays of the binary file from (symbol, page status, link) records. As in
+# the old genes.json, the last record of a symbol wins.
+def compile_gene_links(records):
+    genes = {}
+    for symbol, status, link in records:
+        genes[symbol.encode("utf-8")] = (status == "blue", link)
+    symbols = sorted(genes)
+    width = max((len(symbol) for symbol in symbols), default=1)
+
+    blue = np.array([genes[s][0] for s in symbols], dtype=bool)
+    exceptions = [
+        (i, genes[s][1])
+        for i, s in enumerate(symbols)
+        if genes[s][1] != DEFAULT_URL.format(s.decode("utf-8"))
+    ]
+    urls = StringTable.encode([link for _, link in exceptions])
+    return {
+        "symbols": np.array(symbols, dtype=f"S{width}"),
+        "blue": np.packbits(blue),
+        "url_index": np.array([i for i, _ in exceptions], dtype="<i4"),
+        "urls_data": urls.data,
+        "urls_offsets": urls.offsets,
+    }
+
+
+def write_gene_links(path, records):
+    write_arrays(path, compile_gene_links(records), GENE_LINKS_MAGIC)
+
+
+class GeneLinks:
+    """Read-only lookup of the Wikipedia link and page status of genes.
+
+    Symbols missing from the table get the default link and a red status,
+    the same fallback the results pages always used.
+    """
+
+    def __init__(self, arrays):
+        self.symbols = arrays["symbols"]
+        self.blue = arrays["blue"]
+        self.url_index = arrays["url_index"]
+        self.urls = StringTable(arrays["urls_data"], arrays["urls_offsets"])
+
+    @classmethod
+    def from_binary(cls, path):
+        return cls(read_arrays(path, GENE_LINKS_MAGIC, "gene link index"))
+
+    @classmethod
+    def from_records(cls, records):
+        return cls(compile_gene_links(records))
+
+    # The gene links file, or genes.json as written by older versions of
+    # fetch_wikipedia_genes.py, or an empty table when there is neither
+    @classmethod
+    def load(cls, static_dir=STATIC):
+        path = gene_links_path(static_dir)
+        if path.exists():
+            return cls.from_binary(path)
+        json_path = Path(static_dir).joinpath("genes.json")
+        if json_path.exists():
+            return cls.from_records(records_from_json(json_path))
+        print(f"{path} not found, gene links will use defaults")
+        return cls.from_records([])
+
+    def __len__(self):
+        return len(self.symbols)
+
+    # Positions of the symbols in the table, -1 for unknown symbols
+    def find(self, genes):
+        encoded = [gene.encode("utf-8") for gene in genes]
+        positions = np.full(len(encoded), -1, dtype=np.intp)
+        if not len(self.symbols):
+            return positions
+        # Longer symbols cannot be in the table and would be truncated
+        width = self.symbols.dtype.itemsize
+        fits = [len(symbol) <= width for symbol in encoded]
+        keys = np.array(
+            [symbol if fit else b"" for symbol, fit in zip(encoded, fits)],
+            dtype=self.symbols.dtype,
+        )
+        found = np.minimum(np.searchsorted(self.symbols, keys), len(self.symbols) - 1)
+        matches = (self.symbols[found] == keys) & np.array(fits, dtype=bool)
+        positions[matches] = found[matches]
+        return positions
+
+    # {"gene", "link", "status"} of each gene, in order
+    def lookup(self, genes):
+        positions = self.find(genes)
+        known = positions >= 0
+        i = positions[known]
+        is_blue = np.zeros(len(positions), dtype=bool)
+        is_blue[known] = self.blue[i >> 3] >> (7 - (i & 7)) & 1
+        # Position of each known gene's link among the non-default ones
+        url = np.full(len(positions), -1, dtype=np.intp)
+        k = np.searchsorted(self.url_index, i)
+        listed = k < len(self.url_index)
+        listed[listed] = self.url_index[k[listed]] == i[listed]
+        url[np.flatnonzero(known)[listed]] = k[listed]
+        return [
+            {
+                "gene": gene,
+                "link": self.urls[k] if k >= 0 else DEFAULT_URL.format(gene),
+                "status": "blue" if blue else "red",
+            }
+            for gene, blue, k in zip(genes, is_blue.tolist(), url.tolist())
+        ]
+
+
+# (symbol, page status, link) records of a genes.json file
+def records_from_json(path):
+    with open(path) as f:
+        genes = json.load(f)
+    return [
+        (
+            symbol,
+            info.get("pageStatus", "red"),
+            info.get("wikipediaLink", DEFAULT_URL.format(symbol)),
+        )
+        for symbol, info in genes.items()
+    ]
@@ -0,0 +1,686 @@
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from types import MappingProxyType
+
+import numpy as np
+from scipy import sparse
+
+HERE = Path(__file__).parent.resolve()
+STATIC = HERE.joinpath("static").resolve()
+
+ORGANISMS = ("human", "mouse")
+
+# analysis_type values sent by the forms, mapped to the GMT file name suffix
+ANALYSIS_TYPES = {
+    "cell_type_markers": "cell_type",
+    "biological_processes": "biological_processes",
+    "molecular_functions": "molecular_functions",
+    "cellular_components": "cellular_components",
+}
+
+
+# Same fallbacks api_enrich() always had: anything but "human" is mouse and
+# unknown analysis types mean cell type markers.
+def library_key(organism, analysis_type):
+    organism = "human" if organism == "human" else "mouse"
+    if analysis_type not in ANALYSIS_TYPES:
+        analysis_type = "cell_type_markers"
+    return organism, analysis_type
+
+
+def library_name(organism, analysis_type):
+    return f"{organism}_{analysis_type}"
+
+
+def gmt_path(organism, analysis_type, static_dir=STATIC):
+    suffix = ANALYSIS_TYPES[analysis_type]
+    return Path(static_dir).joinpath(f"gene_sets_{organism}_{suffix}.gmt")
+
+
+def processes_path(organism, analysis_type, static_dir=STATIC):
+    suffix = ANALYSIS_TYPES[analysis_type]
+    return Path(static_dir).joinpath(f"processes_{organism}_{suffix}.json")
+
+
+# Example gene lists behind the "Randomize" button: the first EXAMPLE_GENES
+# genes of each process, pre-joined with newlines, as a JSON array
+# generate_gmt.py writes next to the processes file.
+EXAMPLE_GENES = 50
+
+
+def examples_path(organism, analysis_type, static_dir=STATIC):
+    suffix = ANALYSIS_TYPES[analysis_type]
+    return Path(static_dir).joinpath(f"examples_{organism}_{suffix}.json")
+
+
+# Candidate example lists from processes ([{"itemLabel", "gene_symbol"}])
+def example_pool(processes):
+    return [
+        "\n".join(process["gene_symbol"][:EXAMPLE_GENES])
+        for process in processes
+        if process["gene_symbol"]
+    ]
+
+
+def write_example_pool(path, pool):
+    with atomic_write(path) as f:
+        json.dump(pool, f, separators=(",", ":"))
+
+
+# Example lists of a library, from its examples file, or built from its
+# processes file when generate_gmt.py has not written one yet
+def load_example_pool(organism, analysis_type, static_dir=STATIC):
+    try:
+        with open(examples_path(organism, analysis_type, static_dir)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        with open(processes_path(organism, analysis_type, static_dir)) as f:
+            return example_pool(json.load(f))
+
+
+# Write a file under a temporary name in the same directory and rename it
+# over path once it is complete, so a reader sees either the old or the new
+# file, never a partial one.
+@contextmanager
+def atomic_write(path, mode="w"):
+    path = Path(path)
+    fd, tmp_path = tempfile.mkstemp(dir=path.parent, prefix=f".{path.name}.")
+    try:
+        with os.fdopen(fd, mode) as f:
+            yield f
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+# generate_gmt.py records the content hash, size and build time of every
+# library (and symbol index) it writes in this manifest, next to the GMT
+# files. The server compares the hashes to reload only the libraries that
+# changed.
+MANIFEST_NAME = "gene_sets_manifest.json"
+
+
+def manifest_path(static_dir=STATIC):
+    return Path(static_dir).joinpath(MANIFEST_NAME)
+
+
+# The manifest's entries by library or index name ({} without a manifest)
+def read_manifest(static_dir=STATIC):
+    try:
+        with open(manifest_path(static_dir)) as f:
+            return json.load(f).get("libraries", {})
+    except FileNotFoundError:
+        return {}
+
+
+# Load GMT file into a dictionary
+def load_gmt(file_path):
+    gene_sets = {}
+    with open(file_path, "r") as f:
+        for line in f:
+            parts = line.strip().split("\t")
+            go_term = parts[0]
+            description = parts[1]
+            wikipedia_url = parts[2]
+            genes = parts[3:]
+            gene_sets[go_term] = {
+                "description": description,
+                "wikipedia_url": wikipedia_url,
+                "genes": set(genes),
+            }
+    return gene_sets
+
+
+# Binary libraries written by generate_gmt.py next to each GMT file. Layout:
+# the magic bytes, a little-endian uint32 with the length of a JSON header,
+# the header itself, then 8-byte aligned arrays at the offsets (relative to
+# the end of the header) listed in it.
+BINARY_MAGIC = b"WIKIORA\x01"
+BINARY_ALIGNMENT = 8
+
+
+def binary_path(organism, analysis_type, static_dir=STATIC):
+    return gmt_path(organism, analysis_type, static_dir).with_suffix(".bin")
+
+
+def _align(offset):
+    return -(-offset // BINARY_ALIGNMENT) * BINARY_ALIGNMENT
+
+
+def _fingerprint(path):
+    stat = path.stat()
+    return f"{stat.st_mtime_ns}:{stat.st_size}"
+
+
+# SHA-256 of a file, hashed again only when its size or mtime changes
+_sha256s = {}
+
+
+def file_sha256(path, stat=None):
+    path = Path(path)
+    stat = stat or path.stat()
+    key = (str(path), stat.st_size, stat.st_mtime_ns)
+    if key not in _sha256s:
+        _sha256s[key] = hashlib.sha256(path.read_bytes()).hexdigest()
+    return _sha256s[key]
+
+
+# Whether a file is still the one a manifest download record (see
+# downloads.py) describes. A file whose mtime is not the recorded one
+# (edited, or checked out or copied since the build) is hashed to tell.
+def matches_record(path, record):
+    path = Path(path)
+    try:
+        stat = path.stat()
+    except FileNotFoundError:
+        return False
+    if stat.st_size != record["size"]:
+        return False
+    if stat.st_mtime_ns == record.get("mtime_ns"):
+        return True
+    return file_sha256(path, stat) == record["sha256"]
+
+
+def _read_only(array):
+    array.setflags(write=False)
+    return array
+
+
+class StringTable:
+    """Read-only sequence of strings stored as UTF-8 bytes plus offsets.
+
+    Strings are only decoded when accessed, so tables backed by a
+    memory-mapped file cost no memory of their own.
+    """
+
+    def __init__(self, data, offsets):
+        self.data = data
+        self.offsets = offsets
+
+    @classmethod
+    def encode(cls, strings):
+        encoded = [string.encode("utf-8") for string in strings]
+        offsets = np.zeros(len(encoded) + 1, dtype="<i4")
+        np.cumsum([len(b) for b in encoded], out=offsets[1:])
+        data = np.frombuffer(b"".join(encoded), dtype=np.uint8)
+        return cls(data, offsets)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        start, end = self.offsets[i], self.offsets[i + 1]
+        return self.data[start:end].tobytes().decode("utf-8")
+
+    def __iter__(self):
+        data = self.data.tobytes()
+        offsets = self.offsets.tolist()
+        for start, end in zip(offsets, offsets[1:]):
+            yield data[start:end].decode("utf-8")
+
+
+# Flat arrays describing a library, as stored in the binary format: string
+# tables for gene symbols and term IDs, descriptions and Wikipedia URLs, and
+# the term -> gene and gene -> term CSR indices. Gene symbols are sorted and
+# deduplicated, so gene indices are comparable across calls.
+def compile_library_arrays(gene_sets):
+    terms = list(gene_sets)
+    genes = sorted(set().union(*(d["genes"] for d in gene_sets.values())))
+    gene_index = {gene: i for i, gene in enumerate(genes)}
+
+    members = [
+        sorted(gene_index[g] for g in set(d["genes"])) for d in gene_sets.values()
+    ]
+    term_indptr = np.zeros(len(terms) + 1, dtype="<i4")
+    np.cumsum([len(m) for m in members], out=term_indptr[1:])
+    term_indices = np.array([i for m in members for i in m], dtype="<i4")
+
+    # Transpose: entries sorted by gene (stable, so terms stay in order)
+    entry_terms = np.repeat(np.arange(len(terms), dtype="<i4"), np.diff(term_indptr))
+    order = np.argsort(term_indices, kind="stable")
+    gene_indices = entry_terms[order]
+    gene_indptr = np.zeros(len(genes) + 1, dtype="<i4")
+    np.cumsum(np.bincount(term_indices, minlength=len(genes)), out=gene_indptr[1:])
+
+    arrays = {"term_indptr": term_indptr, "term_indices": term_indices}
+    arrays["gene_indptr"] = gene_indptr
+    arrays["gene_indices"] = gene_indices.astype("<i4")
+    tables = {
+        "gene_symbols": genes,
+        "term_ids": terms,
+        "descriptions": [d["description"] for d in gene_sets.values()],
+        "wikipedia_urls": [d["wikipedia_url"] for d in gene_sets.values()],
+    }
+    for name, strings in tables.items():
+        table = StringTable.encode(strings)
+        arrays[f"{name}_data"] = table.data
+        arrays[f"{name}_offsets"] = table.offsets
+    return arrays
+
+
+# Write named arrays in the layout described above, with the given magic
+def write_arrays(path, arrays, magic=BINARY_MAGIC):
+    layout = {}
+    offset = 0
+    for name, array in arrays.items():
+        layout[name] = {"dtype": array.dtype.str, "offset": offset, "count": array.size}
+        offset = _align(offset + array.nbytes)
+    header = json.dumps({"arrays": layout}).encode("utf-8")
+    header_end = len(magic) + 4 + len(header)
+
+    with atomic_write(path, "wb") as f:
+        f.write(magic)
+        f.write(len(header).to_bytes(4, "little"))
+        f.write(header)
+        f.write(b"\0" * (_align(header_end) - header_end))
+        for name, array in arrays.items():
+            f.write(array.tobytes())
+            f.write(b"\0" * (_align(array.nbytes) - array.nbytes))
+
+
+# Memory-map a file written by write_arrays(). The arrays are read-only
+# views on the mapping, so every worker process shares the same pages.
+def read_arrays(path, magic=BINARY_MAGIC, kind="gene set library"):
+    mapped = np.memmap(path, dtype=np.uint8, mode="r")
+    magic_end = len(magic)
+    if mapped[:magic_end].tobytes() != magic:
+        raise ValueError(f"{path} is not a WikiORA {kind}")
+    header_length = int.from_bytes(
+        mapped[magic_end : magic_end + 4].tobytes(), "little"
+    )
+    header_end = magic_end + 4 + header_length
+    header = json.loads(mapped[magic_end + 4 : header_end].tobytes())
+    data_start = _align(header_end)
+    return {
+        name: np.frombuffer(
+            mapped,
+            dtype=spec["dtype"],
+            count=spec["count"],
+            offset=data_start + spec["offset"],
+        )
+        for name, spec in header["arrays"].items()
+    }
+
+
+def write_library_binary(path, gene_sets):
+    write_arrays(path, compile_library_arrays(gene_sets))
+
+
+def read_library_binary(path):
+    return read_arrays(path)
+
+
+# Sparse (terms x terms) matrix of the number of genes shared by each pair of
+# terms, with the term sizes on the diagonal. Only pairs of terms that share
+# genes are stored, which is a small fraction of all pairs even for the GO
+# libraries, so it is computed in a few milliseconds from the incidence
+# matrix and term similarities never need a pass over the genes.
+def term_overlap_index(incidence):
+    overlaps = (incidence.T @ incidence).tocsr()
+    overlaps.sort_indices()
+    for array in (overlaps.data, overlaps.indices, overlaps.indptr):
+        _read_only(array)
+    return overlaps
+
+
+class GeneSetLibrary:
+    """One gene set library with its background size M and set sizes n.
+
+    The library is held as flat arrays (see compile_library_arrays()),
+    either memory-mapped from the binary file or compiled from the GMT, and
+    exposes a gene x term CSR incidence matrix (rows follow the sorted
+    background genes in gene_index) for the vectorized engine in
+    enrichment.py. Everything is read-only, so a library can be shared
+    between requests and threads without copying.
+    """
+
+    def __init__(self, organism, analysis_type, arrays, source=None, fingerprint=None):
+        self.organism = organism
+        self.analysis_type = analysis_type
+        self.source = source
+        # Identifies the file contents the library was built from; result
+        # caches include it in their keys.
+        self.fingerprint = fingerprint
+        self.genes = StringTable(
+            arrays["gene_symbols_data"], arrays["gene_symbols_offsets"]
+        )
+        self.terms = StringTable(arrays["term_ids_data"], arrays["term_ids_offsets"])
+        self.descriptions = StringTable(
+            arrays["descriptions_data"], arrays["descriptions_offsets"]
+        )
+        self.wikipedia_urls = StringTable(
+            arrays["wikipedia_urls_data"], arrays["wikipedia_urls_offsets"]
+        )
+        self.term_indptr = arrays["term_indptr"]
+        self.term_indices = arrays["term_indices"]
+        for array in arrays.values():
+            if array.flags.writeable:
+                _read_only(array)
+
+        self.M = len(self.genes)
+        self.term_sizes = _read_only(np.diff(self.term_indptr).astype(np.int64))
+        self.gene_index = MappingProxyType(
+            {gene: i for i, gene in enumerate(self.genes)}
+        )
+        self.incidence = sparse.csr_matrix(
+            (
+                _read_only(np.ones(len(arrays["gene_indices"]), dtype=np.int32)),
+                arrays["gene_indices"],
+                arrays["gene_indptr"],
+            ),
+            shape=(self.M, len(self.terms)),
+        )
+        self._term_overlaps = None
+
+    @classmethod
+    def from_gmt(cls, organism, analysis_type, static_dir=STATIC):
+        path = gmt_path(organism, analysis_type, static_dir)
+        arrays = compile_library_arrays(load_gmt(path))
+        return cls(organism, analysis_type, arrays, path, _fingerprint(path))
+
+    @classmethod
+    def from_binary(cls, organism, analysis_type, static_dir=STATIC):
+        path = binary_path(organism, analysis_type, static_dir)
+        arrays = read_library_binary(path)
+        return cls(organism, analysis_type, arrays, path, _fingerprint(path))
+
+    # Prefer the memory-mapped binary, which the build writes with the GMT
+    # file, as long as the GMT is still the one the manifest records. A GMT
+    # edited or replaced by hand, or one without a manifest entry, is
+    # compiled instead. File dates alone do not tell, since checkouts and
+    # copies do not keep them.
+    @classmethod
+    def load(cls, organism, analysis_type, static_dir=STATIC):
+        binary = binary_path(organism, analysis_type, static_dir)
+        gmt = gmt_path(organism, analysis_type, static_dir)
+        entry = read_manifest(static_dir).get(library_name(organism, analysis_type))
+        record = (entry or {}).get("downloads", {}).get(gmt.name)
+        if binary.exists() and record and matches_record(gmt, record):
+            return cls.from_binary(organism, analysis_type, static_dir)
+        return cls.from_gmt(organism, analysis_type, static_dir)
+
+    # Indices (into genes) of the members of the j-th term, sorted
+    def term_gene_indices(self, j):
+        return self.term_indices[self.term_indptr[j] : self.term_indptr[j + 1]]
+
+    def term_genes(self, j):
+        return [self.genes[i] for i in self.term_gene_indices(j)]
+
+    # Number of genes shared by every pair of terms (see term_overlap_index()),
+    # computed on first use and kept with the library
+    def term_overlaps(self):
+        if self._term_overlaps is None:
+            self._term_overlaps = term_overlap_index(self.incidence)
+        return self._term_overlaps
+
+    # GMT lines with the same content the library was built from
+    def iter_gmt_lines(self):
+        for j, term in enumerate(self.terms):
+            fields = [term, self.descriptions[j], self.wikipedia_urls[j]]
+            yield "\t".join(fields + self.term_genes(j)) + "\n"
+
+    @property
+    def name(self):
+        return library_name(self.organism, self.analysis_type)
+
+    # Size of the universe made of the library genes flagged in mask
+    def universe_size(self, mask):
+        return int(np.count_nonzero(mask))
+
+    # Number of distinct genes of each row of a (lists x genes) indicator
+    # matrix, as a (lists x 1) array
+    def list_sizes(self, queries):
+        return np.diff(queries.indptr).astype(np.int64)[:, None]
+
+    def __len__(self):
+        return len(self.terms)
+
+    def __repr__(self):
+        return f"<GeneSetLibrary {self.name}: {len(self)} terms, M={self.M}>"
+
+
+class LibraryGroup:
+    """Several libraries of one organism, evaluated as a single library.
+
+    Genes are the sorted union of the libraries' genes and the incidence
+    matrix has the terms of every library side by side, so one sparse
+    product gives the overlaps of a list with all of them. M is per term:
+    each term keeps the background of its own library, so the statistics
+    of every term are those of its library alone. blocks() tells which
+    terms come from which library.
+    """
+
+    def __init__(self, libraries):
+        self.libraries = list(libraries)
+        self.genes = sorted(set().union(*(lib.gene_index for lib in self.libraries)))
+        self.gene_index = MappingProxyType(
+            {gene: i for i, gene in enumerate(self.genes)}
+        )
+        # Union index of every gene of each library
+        self.gene_maps = [
+            _read_only(np.fromiter((self.gene_index[g] for g in lib.genes), np.int32))
+            for lib in self.libraries
+        ]
+        self.offsets = np.cumsum([0] + [len(lib) for lib in self.libraries])
+        # (genes x libraries) indicator of the genes of each library
+        self._membership = sparse.csr_matrix(
+            (
+                np.ones(sum(len(m) for m in self.gene_maps), dtype=np.int64),
+                (
+                    np.concatenate(self.gene_maps),
+                    np.repeat(
+                        np.arange(len(self.libraries)), [len(m) for m in self.gene_maps]
+                    ),
+                ),
+            ),
+            shape=(len(self.genes), len(self.libraries)),
+        )
+
+        blocks = []
+        for lib, gene_map in zip(self.libraries, self.gene_maps):
+            incidence = lib.incidence.tocoo()
+            blocks.append(
+                sparse.csr_matrix(
+                    (incidence.data, (gene_map[incidence.row], incidence.col)),
+                    shape=(len(self.genes), len(lib)),
+                )
+            )
+        self.incidence = sparse.hstack(blocks, format="csr")
+        self._term_incidence = self.incidence.tocsc()
+        self.M = _read_only(
+            np.repeat([lib.M for lib in self.libraries], np.diff(self.offsets))
+        )
+        self.term_sizes = _read_only(
+            np.concatenate([lib.term_sizes for lib in self.libraries])
+        )
+        self.terms = [t for lib in self.libraries for t in lib.terms]
+        self.descriptions = [d for lib in self.libraries for d in lib.descriptions]
+        self.wikipedia_urls = [u for lib in self.libraries for u in lib.wikipedia_urls]
+
+    # (library, slice of its terms) pairs
+    def blocks(self):
+        for k, lib in enumerate(self.libraries):
+            yield lib, slice(self.offsets[k], self.offsets[k + 1])
+
+    # Per-term universe sizes when only the genes flagged in mask (over the
+    # union of genes) are kept
+    def universe_size(self, mask):
+        sizes = [np.count_nonzero(mask[gene_map]) for gene_map in self.gene_maps]
+        return np.repeat(sizes, np.diff(self.offsets))
+
+    # Number of genes of each row of a (lists x genes) indicator matrix that
+    # are in the library of each term, as a (lists x terms) array
+    def list_sizes(self, queries):
+        sizes = np.asarray((queries @ self._membership).toarray(), dtype=np.int64)
+        return np.repeat(sizes, np.diff(self.offsets), axis=1)
+
+    def term_gene_indices(self, j):
+        start, end = self._term_incidence.indptr[j : j + 2]
+        return self._term_incidence.indices[start:end]
+
+    # Term overlaps within each library; terms of different libraries are
+    # never compared
+    def term_overlaps(self):
+        return sparse.block_diag(
+            [lib.term_overlaps() for lib in self.libraries], format="csr"
+        )
+
+    @property
+    def name(self):
+        return "+".join(lib.name for lib in self.libraries)
+
+    @property
+    def fingerprint(self):
+        return tuple(lib.fingerprint for lib in self.libraries)
+
+    def __len__(self):
+        return len(self.terms)
+
+    def __repr__(self):
+        return f"<LibraryGroup {self.name}: {len(self)} terms>"
+
+
+class GeneSetRegistry:
+    """Process-wide cache of the eight organism/analysis_type libraries.
+
+    Libraries are parsed lazily on first use (or all at once with
+    load_all()) and kept until they are reloaded. reload_changed() re-reads
+    only the libraries whose hash in the build manifest differs from the one
+    they were loaded with; with poll_interval set (in seconds), get() checks
+    the manifest that often and does so by itself after generate_gmt.py has
+    rewritten some of the files.
+    """
+
+    def __init__(self, static_dir=STATIC, poll_interval=0):
+        self.static_dir = Path(static_dir)
+        self.poll_interval = poll_interval
+        self._libraries = {}
+        # Manifest hash of each library when it was loaded
+        self._hashes = {}
+        self._groups = {}
+        self._lock = threading.Lock()
+        self._reload_listeners = []
+        self._poll_lock = threading.Lock()
+        self._next_poll = 0.0
+        self._manifest_stamp = self._stat_manifest()
+
+    def _stat_manifest(self):
+        try:
+            stat = manifest_path(self.static_dir).stat()
+        except FileNotFoundError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    # The manifest is read before the files, so a build finishing in between
+    # at worst makes the next check reload the library once more.
+    def _load(self, key):
+        entry = read_manifest(self.static_dir).get(library_name(*key), {})
+        library = GeneSetLibrary.load(*key, self.static_dir)
+        return library, entry.get("input_hash")
+
+    def get(self, organism, analysis_type):
+        if self.poll_interval:
+            self.poll()
+        key = library_key(organism, analysis_type)
+        library = self._libraries.get(key)
+        if library is None:
+            with self._lock:
+                library = self._libraries.get(key)
+                if library is None:
+                    library, self._hashes[key] = self._load(key)
+                    self._libraries[key] = library
+        return library
+
+    # The LibraryGroup of several analysis types of one organism, built once
+    # and kept until one of its libraries is reloaded
+    def group(self, organism, analysis_types):
+        keys = tuple(library_key(organism, t) for t in analysis_types)
+        group = self._groups.get(keys)
+        if group is None:
+            libraries = [self.get(*key) for key in keys]
+            group = LibraryGroup(libraries)
+            with self._lock:
+                if all(
+                    self._libraries.get(key) is lib for key, lib in zip(keys, libraries)
+                ):
+                    self._groups[keys] = group
+        return group
+
+    def load_all(self):
+        for organism in ORGANISMS:
+            for analysis_type in ANALYSIS_TYPES:
+                self.get(organism, analysis_type)
+        return self
+
+    # Re-read one library, or every library already loaded when called
+    # without arguments. The new objects replace the old ones atomically, so
+    # requests in flight keep working with the library they started with.
+    def reload(self, organism=None, analysis_type=None):
+        if organism is None and analysis_type is None:
+            keys = list(self._libraries)
+        else:
+            keys = [library_key(organism, analysis_type)]
+        return self._reload(keys)
+
+    # Re-read the loaded libraries whose manifest hash changed
+    def reload_changed(self):
+        manifest = read_manifest(self.static_dir)
+        keys = [
+            key
+            for key in list(self._libraries)
+            if manifest.get(library_name(*key), {}).get("input_hash")
+            != self._hashes.get(key)
+        ]
+        return self._reload(keys) if keys else []
+
+    # Call reload_changed() when the manifest file changed since the last
+    # check, at most once every poll_interval seconds. Concurrent callers do
+    # not wait for a check in progress.
+    def poll(self):
+        now = time.monotonic()
+        if now < self._next_poll or not self._poll_lock.acquire(blocking=False):
+            return []
+        try:
+            self._next_poll = now + self.poll_interval
+            stamp = self._stat_manifest()
+            if stamp == self._manifest_stamp:
+                return []
+            self._manifest_stamp = stamp
+            return self.reload_changed()
+        finally:
+            self._poll_lock.release()
+
+    def _reload(self, keys):
+        reloaded = {key: self._load(key) for key in keys}
+        with self._lock:
+            for key, (library, input_hash) in reloaded.items():
+                self._libraries[key] = library
+                self._hashes[key] = input_hash
+            self._groups.clear()
+        names = [library.name for library, _ in reloaded.values()]
+        for listener in self._reload_listeners:
+            listener(names)
+        return names
+
+    # Register a callable that receives the names of the reloaded libraries,
+    # e.g. to drop cached results computed from the old files.
+    def add_reload_listener(self, listener):
+        self._reload_listeners.append(listener)
+
+    def loaded(self):
+        return list(self._libraries.values())
+
+
+registry = GeneSetRegistry()
@@ -0,0 +1,154 @@
+import json
+import threading
+from pathlib import Path
+
+from gene_sets import (
+    ANALYSIS_TYPES,
+    STATIC,
+    atomic_write,
+    library_key,
+    registry as gene_set_registry,
+)
+
+
+def symbol_index_path(organism, static_dir=STATIC):
+    return Path(static_dir).joinpath(f"gene_symbols_{organism}.json")
+
+
+# Symbol index of one organism from (symbol, alias) rows, as written by
+# generate_gmt.py: the current symbols, and the aliases (previous symbols,
+# names) by case-folded alias. Aliases that match a current symbol up to
+# case, or that belong to several genes, are left out.
+def compile_symbol_index(rows):
+    symbols = set()
+    targets = {}
+    for symbol, alias in rows:
+        symbols.add(symbol)
+        if alias:
+            targets.setdefault(alias.casefold(), set()).add(symbol)
+    folded = {symbol.casefold() for symbol in symbols}
+    aliases = {
+        alias: next(iter(genes))
+        for alias, genes in targets.items()
+        if len(genes) == 1 and alias not in folded
+    }
+    return {"symbols": sorted(symbols), "aliases": dict(sorted(aliases.items()))}
+
+
+def write_symbol_index(path, index):
+    with atomic_write(path) as f:
+        json.dump(index, f, separators=(",", ":"))
+
+
+class SymbolIndex:
+    """Resolution of submitted gene symbols to the symbols of one organism.
+
+    Each input is looked up as given, then case-folded (so "cd4" and "Cd4"
+    find "CD4" in human and "Cd4" in mouse), then among the aliases. Only
+    unambiguous case-folded matches are used.
+    """
+
+    def __init__(self, symbols, aliases=None):
+        self.symbols = frozenset(symbols)
+        folded = {}
+        for symbol in self.symbols:
+            folded.setdefault(symbol.casefold(), []).append(symbol)
+        self.casefolded = {k: v[0] for k, v in folded.items() if len(v) == 1}
+        self.aliases = aliases or {}
+
+    @classmethod
+    def from_file(cls, path):
+        with open(path) as f:
+            index = json.load(f)
+        return cls(index["symbols"], index["aliases"])
+
+    def __len__(self):
+        return len(self.symbols)
+
+    def resolve(self, genes):
+        """Resolve a parsed gene list.
+
+        Returns the list with every recognized input replaced by its
+        current symbol (unrecognized ones are kept as given, so the list
+        length is unchanged) and a report of the distinct inputs:
+        "mapped" (already current symbols), "remapped" (input, symbol and
+        whether the match was by "case" or "alias") and "unrecognized".
+        """
+        resolved = []
+        seen = {}
+        mapped = []
+        remapped = []
+        unrecognized = []
+        for gene in genes:
+            symbol = seen.get(gene)
+            if symbol is None:
+                if gene in self.symbols:
+                    symbol = gene
+                    mapped.append(gene)
+                else:
+                    folded = gene.casefold()
+                    if folded in self.casefolded:
+                        symbol = self.casefolded[folded]
+                        remapped.append(
+                            {"input": gene, "symbol": symbol, "match": "case"}
+                        )
+                    elif folded in self.aliases:
+                        symbol = self.aliases[folded]
+                        remapped.append(
+                            {"input": gene, "symbol": symbol, "match": "alias"}
+                        )
+                    else:
+                        symbol = gene
+                        unrecognized.append(gene)
+                seen[gene] = symbol
+            resolved.append(symbol)
+        report = {
+            "mapped": mapped,
+            "remapped": remapped,
+            "unrecognized": unrecognized,
+        }
+        return resolved, report
+
+
+class SymbolIndexRegistry:
+    """Symbol index of each organism, loaded on first use.
+
+    Without the index file written by generate_gmt.py, the index is built
+    from the genes of the organism's gene set libraries: inputs are then
+    resolved as given or by case only.
+    """
+
+    def __init__(self, static_dir=STATIC, libraries=gene_set_registry):
+        self.static_dir = Path(static_dir)
+        self.libraries = libraries
+        self._indexes = {}
+        self._lock = threading.Lock()
+
+    def get(self, organism):
+        organism, _ = library_key(organism, None)
+        index = self._indexes.get(organism)
+        if index is None:
+            with self._lock:
+                index = self._indexes.get(organism)
+                if index is None:
+                    index = self._load(organism)
+                    self._indexes[organism] = index
+        return index
+
+    def _load(self, organism):
+        path = symbol_index_path(organism, self.static_dir)
+        if path.exists():
+            return SymbolIndex.from_file(path)
+        symbols = set()
+        for analysis_type in ANALYSIS_TYPES:
+            symbols.update(self.libraries.get(organism, analysis_type).genes)
+        return SymbolIndex(symbols)
+
+    def clear(self):
+        with self._lock:
+            self._indexes.clear()
+
+
+registry = SymbolIndexRegistry()
+# Indexes built from the libraries, or written with them, follow their reloads
+gene_set_registry.add_reload_listener(lambda names: registry.clear())
@@ -1,12 +1,60 @@
+import argparse
+import hashlib
+import json
 import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, timezone
 import pandas as pd
-from SPARQLWrapper import SPARQLWrapper, JSON
+import requests
 from jinja2 import Template
 from pathlib import Path
+from gene_sets import (
+    ANALYSIS_TYPES,
+    ORGANISMS,
+    atomic_write,
+    binary_path,
+    example_pool,
+    examples_path,
+    gmt_path,
+    library_name,
+    load_gmt,
+    manifest_path,
+    processes_path,
+    read_manifest,
+    write_example_pool,
+    write_library_binary,
+)
+from downloads import available_encodings, compress_download, compressed_path
+from gene_symbols import compile_symbol_index, symbol_index_path, write_symbol_index
 
 HERE = Path(__file__).parent.resolve()
 STATIC = HERE.joinpath("static").resolve()
 
+SPARQL_ENDPOINT = os.environ.get(
+    "WIKIDATA_SPARQL_ENDPOINT", "https://query.wikidata.org/sparql"
+)
+USER_AGENT = "WikiORA gene set builder (https://github.com/lubianat/wikiora)"
+# Raw bindings of finished queries, so an interrupted run only redoes the rest
+CHECKPOINTS = HERE.joinpath("sparql_checkpoints")
+# Checkpoints older than this many seconds are from an earlier, abandoned
+# refresh and are queried again rather than resumed
+CHECKPOINT_MAX_AGE = 24 * 3600
+# Part of every library's input hash; bump it when the way the outputs are
+# derived from the query results changes, so the next run rebuilds them all
+BUILD_VERSION = 1
+
+ORGANISM_IDS = {
+    "human": {"id": "Q15978631", "gene_symbol": "P353"},
+    "mouse": {"id": "Q83310", "gene_symbol": "P2394"},
+}
+
+GO_PROPERTIES = {
+    "biological_processes": "P682",
+    "cellular_components": "P681",
+}
+
 # Template SPARQL query for GO terms using Jinja2
 go_query_template = """
 SELECT DISTINCT
@@ -123,12 +171,168 @@ WHERE
 """
 
 
-def fetch_data(query):
-    sparql = SPARQLWrapper("https://query.wikidata.org/sparql")
-    sparql.setQuery(query)
-    sparql.setReturnFormat(JSON)
-    results = sparql.query().convert()
-    return results["results"]["bindings"]
+# SPARQL query for the symbols of every gene of an organism, with their
+# aliases (previous symbols and names), for the symbol resolution index
+gene_aliases_query_template = """
+SELECT DISTINCT
+  ?gene_symbol ?alias
+WHERE
+{
+  ?gene wdt:{{ gene_symbol }} ?gene_symbol .
+  ?gene wdt:P703 wd:{{ organism }} .
+
+  OPTIONAL {
+    ?gene skos:altLabel ?alias .
+    FILTER (LANG (?alias) = "en")
+  }
+}
+"""
+
+
+class SPARQLError(Exception):
+    pass
+
+
+# Space out the start of consecutive queries to the endpoint
+class RateLimiter:
+    def __init__(self, min_interval):
+        self.min_interval = min_interval
+        self._next = 0.0
+        self._lock = threading.Lock()
+
+    def wait(self):
+        with self._lock:
+            now = time.monotonic()
+            delay = max(0.0, self._next - now)
+            self._next = max(now, self._next) + self.min_interval
+        if delay:
+            time.sleep(delay)
+
+
+# Run a query, retrying timeouts, connection errors, 429 and 5xx answers with
+# exponential backoff (or the server's Retry-After)
+def fetch_data(
+    query, endpoint=SPARQL_ENDPOINT, timeout=300, retries=4, rate_limiter=None
+):
+    headers = {"Accept": "application/sparql-results+json", "User-Agent": USER_AGENT}
+    for attempt in range(retries + 1):
+        if rate_limiter is not None:
+            rate_limiter.wait()
+        delay = 5 * 2**attempt
+        try:
+            response = requests.post(
+                endpoint, data={"query": query}, headers=headers, timeout=timeout
+            )
+            if response.status_code == 429 or response.status_code >= 500:
+                retry_after = response.headers.get("Retry-After", "")
+                if retry_after.isdigit():
+                    delay = int(retry_after)
+                error = f"HTTP {response.status_code}"
+            else:
+                response.raise_for_status()
+                return response.json()["results"]["bindings"]
+        except (requests.ConnectionError, requests.Timeout) as e:
+            error = str(e)
+        if attempt < retries:
+            print(f"Query failed ({error}), retrying in {delay} s")
+            time.sleep(delay)
+    raise SPARQLError(f"Query failed after {retries + 1} attempts: {error}")
+
+
+# Every query of a full refresh, by job name
+def build_jobs():
+    jobs = {}
+    template = Template(go_query_template)
+    for organism, details in ORGANISM_IDS.items():
+        for category, prop in GO_PROPERTIES.items():
+            jobs[f"{organism}_{category}"] = template.render(
+                property=prop,
+                organism=details["id"],
+                gene_symbol=details["gene_symbol"],
+            )
+    jobs["human_cell_type"] = human_cell_type_query
+    jobs["mouse_cell_type"] = mouse_cell_type_query
+    # The Wikipedia links of molecular functions do not depend on the organism
+    jobs["molecular_functions_wikipedia"] = Template(
+        molecular_function_wikipedia_query_template
+    ).render()
+    for organism, details in ORGANISM_IDS.items():
+        jobs[f"{organism}_molecular_functions_genes"] = Template(
+            molecular_function_gene_query_template
+        ).render(organism=details["id"], gene_symbol=details["gene_symbol"])
+    for organism, details in ORGANISM_IDS.items():
+        jobs[f"{organism}_gene_aliases"] = Template(gene_aliases_query_template).render(
+            organism=details["id"], gene_symbol=details["gene_symbol"]
+        )
+    return jobs
+
+
+def _checkpoint_path(checkpoint_dir, name, query):
+    digest = hashlib.sha256(query.encode("utf-8")).hexdigest()[:16]
+    return Path(checkpoint_dir).joinpath(f"{name}-{digest}.json")
+
+
+def run_jobs(
+    jobs,
+    endpoint=SPARQL_ENDPOINT,
+    checkpoint_dir=CHECKPOINTS,
+    max_workers=3,
+    min_interval=1.0,
+    timeout=300,
+    retries=4,
+    max_age=CHECKPOINT_MAX_AGE,
+):
+    """Run the queries of build_jobs() concurrently and return their bindings.
+
+    At most max_workers queries are in flight and consecutive queries start
+    at least min_interval seconds apart. Each finished job is checkpointed
+    in checkpoint_dir (keyed by a hash of its query), and jobs checkpointed
+    less than max_age seconds ago are not queried again, so rerunning after
+    a failure only redoes the jobs that failed. Raises SPARQLError naming
+    the failed jobs.
+    """
+    Path(checkpoint_dir).mkdir(parents=True, exist_ok=True)
+    results = {}
+    pending = {}
+    for name, query in jobs.items():
+        path = _checkpoint_path(checkpoint_dir, name, query)
+        if path.exists() and time.time() - path.stat().st_mtime < max_age:
+            with open(path) as f:
+                results[name] = json.load(f)
+            print(f"{name}: resumed from {path.name}")
+        else:
+            pending[name] = (query, path)
+
+    rate_limiter = RateLimiter(min_interval)
+
+    def run(name, query, path):
+        bindings = fetch_data(query, endpoint, timeout, retries, rate_limiter)
+        with atomic_write(path) as f:
+            json.dump(bindings, f)
+        return bindings
+
+    failed = []
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {
+            executor.submit(run, name, query, path): name
+            for name, (query, path) in pending.items()
+        }
+        for future in as_completed(futures):
+            name = futures[future]
+            try:
+                results[name] = future.result()
+                print(f"{name}: {len(results[name])} bindings")
+            except Exception as e:
+                print(f"{name}: failed ({e})")
+                failed.append(name)
+    if failed:
+        raise SPARQLError(f"Failed jobs (rerun to resume): {', '.join(sorted(failed))}")
+    return results
+
+
+def clear_checkpoints(checkpoint_dir=CHECKPOINTS):
+    for path in Path(checkpoint_dir).glob("*.json"):
+        path.unlink()
 
 
 def process_data(results, include_go=True):
@@ -152,102 +356,292 @@ def process_data(results, include_go=True):
     return pd.DataFrame(data)
 
 
+# Group the query results into gene sets, in the format returned by load_gmt()
+def gene_sets_from_df(df, use_item_label=False):
+    gene_sets = {}
+    group_col = "itemLabel" if use_item_label else "go"
+    for term, group in df.groupby(group_col):
+        gene_sets[term] = {
+            "description": group["itemLabel"].iloc[0],
+            "wikipedia_url": group["sitelink"].iloc[0],
+            "genes": sorted(group["gene_symbol"].tolist()),  # Sort alphabetically
+        }
+    return gene_sets
+
+
+# Write the GMT file and, next to it, the binary library the server
+# memory-maps. Both are written from the same gene sets, each to a temporary
+# file renamed into place, and the gene sets are returned.
 def generate_gmt(df, output_file, use_item_label=False):
-    with open(output_file, "w") as f:
-        group_col = "itemLabel" if use_item_label else "go"
-        for term, group in df.groupby(group_col):
-            genes = sorted(
-                group["gene_symbol"].tolist()
-            )  # Sort the genes alphabetically
+    gene_sets = gene_sets_from_df(df, use_item_label=use_item_label)
+    with atomic_write(output_file) as f:
+        for term, details in gene_sets.items():
             line = (
-                f"{term}\t{group['itemLabel'].iloc[0]}\t{group['sitelink'].iloc[0]}\t"
-                + "\t".join(genes)
+                f"{term}\t{details['description']}\t{details['wikipedia_url']}\t"
+                + "\t".join(details["genes"])
                 + "\n"
             )
             f.write(line)
+    write_library_binary(Path(output_file).with_suffix(".bin"), gene_sets)
+    return gene_sets
 
 
+# Write the processes file and return its records
 def save_processes(df, output_file):
     processes = df.groupby("itemLabel")["gene_symbol"].apply(list).reset_index()
-    processes.to_json(output_file, orient="records")
+    with atomic_write(output_file) as f:
+        processes.to_json(f, orient="records")
+    return processes.to_dict(orient="records")
 
 
-def main():
-    organisms = {
-        "human": {"id": "Q15978631", "gene_symbol": "P353"},
-        "mouse": {"id": "Q83310", "gene_symbol": "P2394"},
-    }
+# The jobs each library is built from, by (organism, analysis_type)
+def library_jobs():
+    libraries = {}
+    for organism in ORGANISM_IDS:
+        for category in GO_PROPERTIES:
+            libraries[organism, category] = [f"{organism}_{category}"]
+        libraries[organism, "cell_type_markers"] = [f"{organism}_cell_type"]
+        libraries[organism, "molecular_functions"] = [
+            f"{organism}_molecular_functions_genes",
+            "molecular_functions_wikipedia",
+        ]
+    return libraries
 
-    go_properties = {
-        "biological_processes": "P682",
-        "cellular_components": "P681",
-    }
 
-    template = Template(go_query_template)
+# Content hash of the query results a library is built from. Wikidata
+# returns rows in no particular order, so they are hashed sorted: a
+# reordered but otherwise identical result does not rebuild the library.
+def input_hash(results, job_names):
+    digest = hashlib.sha256(f"build {BUILD_VERSION}\n".encode("utf-8"))
+    for name in job_names:
+        digest.update(f"{name}\n".encode("utf-8"))
+        for row in sorted(json.dumps(row, sort_keys=True) for row in results[name]):
+            digest.update(f"{row}\n".encode("utf-8"))
+    return digest.hexdigest()
 
-    for organism, details in organisms.items():
-        for category, prop in go_properties.items():
-            query = template.render(
-                property=prop,
-                organism=details["id"],
-                gene_symbol=details["gene_symbol"],
-            )
-            results = fetch_data(query)
-            df = process_data(results)
-            output_file = STATIC.joinpath(f"gene_sets_{organism}_{category}.gmt")
-            generate_gmt(df, output_file)
-            save_processes(df, STATIC.joinpath(f"processes_{organism}_{category}.json"))
-
-    # Human cell type markers
-    human_cell_type_results = fetch_data(human_cell_type_query)
-    human_cell_type_df = process_data(human_cell_type_results)
-    generate_gmt(
-        human_cell_type_df,
-        STATIC.joinpath("gene_sets_human_cell_type.gmt"),
-        use_item_label=True,
-    )
-    save_processes(
-        human_cell_type_df, STATIC.joinpath("processes_human_cell_type.json")
-    )
 
-    # Mouse cell type markers
-    mouse_cell_type_results = fetch_data(mouse_cell_type_query)
-    mouse_cell_type_df = process_data(mouse_cell_type_results)
-    generate_gmt(
-        mouse_cell_type_df,
-        STATIC.joinpath("gene_sets_mouse_cell_type.gmt"),
-        use_item_label=True,
-    )
-    save_processes(
-        mouse_cell_type_df, STATIC.joinpath("processes_mouse_cell_type.json")
+# Query results of one library as a data frame
+def library_df(results, organism, analysis_type):
+    if analysis_type != "molecular_functions":
+        (job,) = library_jobs()[organism, analysis_type]
+        return process_data(results[job])
+
+    # Molecular functions take their Wikipedia links from a separate query
+    df_wikipedia = process_data(
+        results["molecular_functions_wikipedia"], include_go=False
     )
+    df_gene = process_data(results[f"{organism}_molecular_functions_genes"])
+    combined_df = pd.merge(df_gene, df_wikipedia, on="item", suffixes=("", "_wiki"))
+    combined_df["sitelink"] = combined_df["sitelink_wiki"]
+    return combined_df.drop(columns=["sitelink_wiki", "itemLabel_wiki"])
+
+
+# The files of a library: GMT, binary, processes and examples, followed by
+# the compressed copies of the GMT and processes files (see downloads.py)
+def output_paths(organism, analysis_type, output_dir):
+    paths = [
+        gmt_path(organism, analysis_type, output_dir),
+        binary_path(organism, analysis_type, output_dir),
+        processes_path(organism, analysis_type, output_dir),
+        examples_path(organism, analysis_type, output_dir),
+    ]
+    return paths + [
+        compressed_path(path, encoding)
+        for path in (paths[0], paths[2])
+        for encoding in available_encodings()
+    ]
+
+
+# Compressed copies of the downloadable files of a library, and their
+# records for the manifest
+def compress_downloads(paths):
+    return {path.name: compress_download(path) for path in (paths[0], paths[2])}
+
+
+def _now():
+    return datetime.now(timezone.utc).isoformat(timespec="seconds")
+
 
-    # Custom handling for molecular functions
-    for organism, details in organisms.items():
-        wikipedia_query = Template(molecular_function_wikipedia_query_template).render(
-            organism=details["id"]
+def manifest_entry(gene_sets, digest, paths, downloads):
+    return {
+        "input_hash": digest,
+        "downloads": downloads,
+        "terms": len(gene_sets),
+        "genes": len(set().union(*(d["genes"] for d in gene_sets.values()))),
+        "built_at": _now(),
+        "files": [path.name for path in paths],
+    }
+
+
+# A library is rebuilt when its input hash differs from the manifest or one
+# of its files is missing
+def is_up_to_date(entry, digest, paths):
+    return entry.get("input_hash") == digest and all(p.exists() for p in paths)
+
+
+# The manifest is replaced last, once every changed library has been
+# written, so a server reloading from it never sees a hash before its files
+def write_manifest(libraries, output_dir):
+    with atomic_write(manifest_path(output_dir)) as f:
+        json.dump(
+            {"built_at": _now(), "libraries": libraries}, f, indent=2, sort_keys=True
         )
-        gene_query = Template(molecular_function_gene_query_template).render(
-            organism=details["id"], gene_symbol=details["gene_symbol"]
+        f.write("\n")
+
+
+# Write the GMT, binary and processes files of the libraries, and the symbol
+# indexes, whose query results changed since the last build, and update the
+# manifest. Returns the names of the rebuilt outputs.
+def build_outputs(results, output_dir=STATIC, force=False):
+    output_dir = Path(output_dir)
+    manifest = read_manifest(output_dir)
+    rebuilt = []
+    for (organism, analysis_type), job_names in library_jobs().items():
+        name = library_name(organism, analysis_type)
+        digest = input_hash(results, job_names)
+        paths = output_paths(organism, analysis_type, output_dir)
+        if not force and is_up_to_date(manifest.get(name, {}), digest, paths):
+            print(f"{name}: unchanged")
+            continue
+        df = library_df(results, organism, analysis_type)
+        gene_sets = generate_gmt(
+            df, paths[0], use_item_label=analysis_type == "cell_type_markers"
         )
+        processes = save_processes(df, paths[2])
+        write_example_pool(paths[3], example_pool(processes))
+        downloads = compress_downloads(paths)
+        manifest[name] = manifest_entry(gene_sets, digest, paths, downloads)
+        rebuilt.append(name)
+        print(f"{name}: rebuilt ({len(gene_sets)} terms)")
 
-        wikipedia_results = fetch_data(wikipedia_query)
-        gene_results = fetch_data(gene_query)
+    # Symbol resolution index of each organism
+    for organism in ORGANISM_IDS:
+        name = f"{organism}_gene_symbols"
+        job = f"{organism}_gene_aliases"
+        digest = input_hash(results, [job])
+        paths = [symbol_index_path(organism, output_dir)]
+        if not force and is_up_to_date(manifest.get(name, {}), digest, paths):
+            print(f"{name}: unchanged")
+            continue
+        index = compile_symbol_index(
+            (row["gene_symbol"]["value"], row.get("alias", {}).get("value"))
+            for row in results[job]
+        )
+        write_symbol_index(paths[0], index)
+        manifest[name] = {
+            "input_hash": digest,
+            "genes": len(index["symbols"]),
+            "aliases": len(index["aliases"]),
+            "built_at": _now(),
+            "files": [paths[0].name],
+        }
+        rebuilt.append(name)
+        print(f"{name}: rebuilt ({len(index['aliases'])} aliases)")
+    if rebuilt:
+        write_manifest(manifest, output_dir)
+    return rebuilt
 
-        df_wikipedia = process_data(wikipedia_results, include_go=False)
-        df_gene = process_data(gene_results)
 
-        combined_df = pd.merge(df_gene, df_wikipedia, on="item", suffixes=("", "_wiki"))
-        combined_df["sitelink"] = combined_df["sitelink_wiki"]
-        combined_df = combined_df.drop(columns=["sitelink_wiki", "itemLabel_wiki"])
+# Rebuild the binary libraries, the example lists and the compressed copies
+# from the GMT and processes files already in static/, without querying Wikidata. Here the
+# input hash is that of the GMT file.
+def binaries_from_gmt(output_dir=STATIC, force=False):
+    output_dir = Path(output_dir)
+    manifest = read_manifest(output_dir)
+    rebuilt = []
+    for organism in ORGANISMS:
+        for analysis_type in ANALYSIS_TYPES:
+            name = library_name(organism, analysis_type)
+            paths = output_paths(organism, analysis_type, output_dir)
+            digest = hashlib.sha256(paths[0].read_bytes()).hexdigest()
+            if not force and is_up_to_date(manifest.get(name, {}), digest, paths):
+                continue
+            gene_sets = load_gmt(paths[0])
+            write_library_binary(paths[1], gene_sets)
+            with open(paths[2]) as f:
+                write_example_pool(paths[3], example_pool(json.load(f)))
+            downloads = compress_downloads(paths)
+            manifest[name] = manifest_entry(gene_sets, digest, paths, downloads)
+            rebuilt.append(name)
+    if rebuilt:
+        write_manifest(manifest, output_dir)
+    return rebuilt
 
-        output_file = STATIC.joinpath(f"gene_sets_{organism}_molecular_functions.gmt")
-        generate_gmt(combined_df, output_file)
-        save_processes(
-            combined_df,
-            STATIC.joinpath(f"processes_{organism}_molecular_functions.json"),
-        )
+
+def main(
+    endpoint=SPARQL_ENDPOINT,
+    output_dir=STATIC,
+    checkpoint_dir=CHECKPOINTS,
+    max_workers=3,
+    min_interval=1.0,
+    keep_checkpoints=False,
+    force=False,
+    fresh=False,
+):
+    if fresh:
+        clear_checkpoints(checkpoint_dir)
+    results = run_jobs(
+        build_jobs(),
+        endpoint=endpoint,
+        checkpoint_dir=checkpoint_dir,
+        max_workers=max_workers,
+        min_interval=min_interval,
+    )
+    build_outputs(results, output_dir, force=force)
+    # Checkpoints only serve to resume this refresh; the next one must query
+    # Wikidata again
+    if not keep_checkpoints:
+        clear_checkpoints(checkpoint_dir)
 
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser(description="Build the WikiORA gene sets.")
+    parser.add_argument(
+        "--from-gmt",
+        action="store_true",
+        help="only rebuild the binary libraries, example lists and compressed "
+        "downloads from the existing GMT and processes files",
+    )
+    parser.add_argument("--endpoint", default=SPARQL_ENDPOINT)
+    parser.add_argument("--output-dir", type=Path, default=STATIC)
+    parser.add_argument("--checkpoint-dir", type=Path, default=CHECKPOINTS)
+    parser.add_argument(
+        "--workers", type=int, default=3, help="concurrent queries (default: 3)"
+    )
+    parser.add_argument(
+        "--min-interval",
+        type=float,
+        default=1.0,
+        help="minimum seconds between the start of two queries (default: 1)",
+    )
+    parser.add_argument(
+        "--keep-checkpoints",
+        action="store_true",
+        help="keep the raw query results after a successful run",
+    )
+    parser.add_argument(
+        "--force",
+        action="store_true",
+        help="rewrite every library, even those whose inputs did not change",
+    )
+    parser.add_argument(
+        "--fresh",
+        action="store_true",
+        help="query every job again instead of resuming from the checkpoints "
+        "of a failed run (by default, checkpoints less than a day old are "
+        "resumed)",
+    )
+    args = parser.parse_args()
+    if args.from_gmt:
+        binaries_from_gmt(args.output_dir, force=args.force)
+    else:
+        main(
+            endpoint=args.endpoint,
+            output_dir=args.output_dir,
+            checkpoint_dir=args.checkpoint_dir,
+            max_workers=args.workers,
+            min_interval=args.min_interval,
+            keep_checkpoints=args.keep_checkpoints,
+            force=args.force,
+            fresh=args.fresh,
+        )
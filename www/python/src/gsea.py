@@ -0,0 +1,195 @@
+# Preranked gene set enrichment analysis (GSEA, Subramanian et al. 2005):
+# running-sum enrichment scores of the terms of a gene set library along a
+# list of genes ranked by a score, with a permutation null distribution.
+# Only numpy is imported, so the permutations can run in worker processes
+# that load nothing else.
+import numpy as np
+
+# Permutations are drawn and scored in batches of this many; each batch has
+# its own seed derived from the request seed, so the results do not depend
+# on how the batches are spread over processes.
+PERMUTATION_BATCH = 100
+
+
+# Sort a ranked list by decreasing score, keeping the score with the largest
+# absolute value for genes given more than once. Ties keep the input order.
+def ranked_list(genes, scores):
+    scores = np.asarray(scores, dtype=float)
+    best = {}
+    for i, gene in enumerate(genes):
+        j = best.get(gene)
+        if j is None or abs(scores[i]) > abs(scores[j]):
+            best[gene] = i
+    kept = np.fromiter(sorted(best.values()), dtype=np.intp, count=len(best))
+    order = kept[np.argsort(-scores[kept], kind="stable")]
+    return [genes[i] for i in order], scores[order]
+
+
+def enrichment_scores(positions, weights, n_genes):
+    """Enrichment scores of gene sets of the same size.
+
+    positions is a (sets x k) array of the sorted ranks of the genes of
+    each set in a list of n_genes genes, and weights the |score|**p of
+    every rank. The running sum steps up by the normalized weight at each
+    hit and down by 1 / (n_genes - k) at each miss; its extremes are
+    right after a hit (maximum) or right before one (minimum), so only the
+    k hits of each set are visited. Returns the scores (the extreme
+    furthest from 0) and the rank of the hit where each is reached.
+    """
+    k = positions.shape[1]
+    hit_weights = weights[positions]
+    totals = hit_weights.sum(axis=1, keepdims=True)
+    # Sets whose genes all have a null score step up evenly
+    flat = totals[:, 0] == 0
+    hit_weights[flat] = 1.0
+    totals[flat] = k
+    after = np.cumsum(hit_weights, axis=1) / totals
+    misses = (positions - np.arange(k)) / max(n_genes - k, 1)
+    after -= misses
+    before = after - hit_weights / totals
+    peak_up = after.argmax(axis=1)
+    peak_down = before.argmin(axis=1)
+    rows = np.arange(len(positions))
+    up = after[rows, peak_up]
+    down = before[rows, peak_down]
+    positive = up >= -down
+    scores = np.where(positive, up, down)
+    peaks = positions[rows, np.where(positive, peak_up, peak_down)]
+    return scores, peaks
+
+
+def null_distribution(weights, sizes, permutations, seed):
+    """Enrichment scores of random gene sets of each of the given sizes.
+
+    Each permutation draws one random ordered sample of max(sizes) ranks;
+    its first k ranks are a uniform random set of size k, so the sets of
+    every size come from the same draws. Returns a (sizes x permutations)
+    array.
+    """
+    rng = np.random.default_rng(seed)
+    n_genes = len(weights)
+    samples = np.array(
+        [rng.choice(n_genes, max(sizes), replace=False) for _ in range(permutations)]
+    )
+    null = np.empty((len(sizes), permutations))
+    for i, k in enumerate(sizes):
+        positions = np.sort(samples[:, :k], axis=1)
+        null[i], _ = enrichment_scores(positions, weights, n_genes)
+    return null
+
+
+# Run the permutations in batches with map (the builtin map, or the map of
+# a process pool), each with a seed spawned from seed
+def permutation_null(weights, sizes, permutations, seed, map=map):
+    batches = -(-permutations // PERMUTATION_BATCH)
+    counts = [
+        min(PERMUTATION_BATCH, permutations - b * PERMUTATION_BATCH)
+        for b in range(batches)
+    ]
+    seeds = np.random.SeedSequence(seed).spawn(batches)
+    n = len(counts)
+    nulls = map(null_distribution, [weights] * n, [sizes] * n, counts, seeds)
+    return np.concatenate(list(nulls), axis=1)
+
+
+# Normalized enrichment scores and nominal p-values of scores against the
+# null scores of the same set size (one row of null per score). Scores are
+# divided by the mean null score of their sign, and the p-value is the
+# fraction of null scores of the same sign that are at least as extreme.
+def normalize(scores, null):
+    positive = scores[:, None] >= 0
+    same_sign = (null >= 0) == positive
+    magnitude = np.abs(null)
+    counts = same_sign.sum(axis=1)
+    means = np.divide(
+        (magnitude * same_sign).sum(axis=1),
+        counts,
+        out=np.full(len(scores), np.nan),
+        where=counts > 0,
+    )
+    with np.errstate(divide="ignore", invalid="ignore"):
+        nes = scores / means
+    extreme = (same_sign & (magnitude >= np.abs(scores)[:, None])).sum(axis=1)
+    p_value = (extreme + 1) / (counts + 1)
+    return nes, p_value
+
+
+def gsea(
+    library,
+    genes,
+    scores,
+    permutations=1000,
+    seed=0,
+    weight=1.0,
+    min_size=15,
+    max_size=500,
+    map=map,
+):
+    """Preranked GSEA of a ranked list against every term of a library.
+
+    genes and scores are the ranked list (see ranked_list()); genes outside
+    the library still count as misses. Terms are restricted to the genes of
+    the list and tested when that leaves between min_size and max_size
+    genes. Returns a dict of per-term arrays: "Gene Set Size" (genes in the
+    list), "ES", "NES", "p-value" (nan for untested terms) and "peak", the
+    rank where the running sum reaches the ES, plus "tested".
+    """
+    n_genes = len(genes)
+    weights = np.abs(np.asarray(scores, dtype=float)) ** weight
+    gene_index = library.gene_index
+    known = np.array(
+        [i for i, gene in enumerate(genes) if gene in gene_index], dtype=np.intp
+    )
+    rows = np.array([gene_index[genes[i]] for i in known], dtype=np.intp)
+    # Ranks of the genes of each term in the list, sorted, term by term
+    hits = library.incidence[rows].tocsc() if len(rows) else None
+    if hits is None:
+        sizes = np.zeros(len(library), dtype=np.int64)
+    else:
+        hits.sort_indices()
+        sizes = np.diff(hits.indptr)
+    tested = (sizes >= max(min_size, 1)) & (sizes <= max_size)
+
+    statistics = {
+        "Gene Set Size": sizes,
+        "ES": np.full(len(library), np.nan),
+        "NES": np.full(len(library), np.nan),
+        "p-value": np.full(len(library), np.nan),
+        "peak": np.full(len(library), -1, dtype=np.int64),
+        "tested": tested,
+    }
+    test_sizes = np.unique(sizes[tested])
+    if not len(test_sizes):
+        return statistics
+    hit_ranks = known[hits.indices]
+    for k in test_sizes:
+        terms = np.flatnonzero(tested & (sizes == k))
+        positions = hit_ranks[hits.indptr[terms][:, None] + np.arange(k)]
+        es, peaks = enrichment_scores(positions, weights, n_genes)
+        statistics["ES"][terms] = es
+        statistics["peak"][terms] = peaks
+
+    null = permutation_null(weights, test_sizes.tolist(), permutations, seed, map)
+    terms = np.flatnonzero(tested)
+    nes, p_value = normalize(
+        statistics["ES"][terms], null[np.searchsorted(test_sizes, sizes[terms])]
+    )
+    statistics["NES"][terms] = nes
+    statistics["p-value"][terms] = p_value
+    return statistics
+
+
+# Genes of the j-th term at or before the peak of a positive ES (at or
+# after it for a negative one), in rank order: the leading edge
+def leading_edge(library, genes, statistics, j):
+    peak = statistics["peak"][j]
+    gene_index = library.gene_index
+    members = set(library.term_gene_indices(j).tolist())
+    ranks = [
+        rank
+        for rank, gene in enumerate(genes)
+        if gene in gene_index and gene_index[gene] in members
+    ]
+    if statistics["ES"][j] >= 0:
+        return [genes[rank] for rank in ranks if rank <= peak]
+    return [genes[rank] for rank in ranks if rank >= peak]
@@ -0,0 +1,32 @@
+# Settings of the production server:
+#
+#     gunicorn -c gunicorn.conf.py wsgi:application
+#
+# The app is loaded once in the master (preload_app), which then forks
+# WIKIORA_WORKERS worker processes (default: one per CPU) of WIKIORA_THREADS
+# threads each, so the workers share the gene set libraries and indexes
+# copy-on-write. After generate_gmt.py rebuilt some gene sets,
+# `kill -HUP <master pid>` reloads them in the master and replaces the
+# workers gracefully: the old ones finish the requests they started.
+import multiprocessing
+import os
+
+bind = os.environ.get("WIKIORA_BIND", "0.0.0.0:5000")
+workers = int(os.environ.get("WIKIORA_WORKERS", multiprocessing.cpu_count()))
+threads = int(os.environ.get("WIKIORA_THREADS", 4))
+worker_class = "gthread"
+preload_app = True
+timeout = int(os.environ.get("WIKIORA_WORKER_TIMEOUT", 120))
+graceful_timeout = int(os.environ.get("WIKIORA_GRACEFUL_TIMEOUT", 60))
+accesslog = "-"
+
+# A library reloaded by a worker is private to it, so the workers leave
+# reloading to the master unless WIKIORA_GENE_SET_POLL_INTERVAL is set
+os.environ.setdefault("WIKIORA_GENE_SET_POLL_INTERVAL", "0")
+
+
+def on_reload(server):
+    import app
+
+    reloaded = app.reload_data()
+    server.log.info("Reloaded gene sets: %s", ", ".join(reloaded) or "none")
@@ -0,0 +1,129 @@
+"""Upper tail probabilities of the hypergeometric distribution.
+
+P(X >= x) for X the overlap of a list of N genes with a term of n genes in
+a universe of M genes, for whole arrays of (M, n, N, x) at once, from a
+table of log factorials shared by all requests. The tails are summed in
+log space, so extreme tails keep their logarithm (log_sf) where the
+p-value itself underflows to 0. tests/test_hypergeometric.py checks the
+results against SciPy and against exact integer arithmetic.
+"""
+
+import math
+import threading
+
+import numpy as np
+
+# The terms of a tail decrease away from the mode; they are summed over at
+# most TAIL_SDS standard deviations plus TAIL_PAD terms, past which they are
+# below double precision relative to the first one.
+TAIL_SDS = 12
+TAIL_PAD = 30
+# Most terms evaluated at once, bounding the memory of large batches
+BLOCK_SIZE = 1 << 20
+
+_log_factorials = np.zeros(1)
+_log_factorials_lock = threading.Lock()
+
+
+# Table of log(k!) for k = 0..m (at least), extended when a larger universe
+# comes along. The gene set libraries fill it up to their largest M when
+# they are preloaded.
+def log_factorials(m):
+    global _log_factorials
+    table = _log_factorials
+    if len(table) > m:
+        return table
+    with _log_factorials_lock:
+        table = _log_factorials
+        if len(table) <= m:
+            size = max(m + 1, 2 * len(table))
+            table = np.array([math.lgamma(k + 1) for k in range(size)])
+            _log_factorials = table
+    return table
+
+
+# log C(n, k) + log C(M - n, N - k) of each k, given the per-row constant
+# log(n!) + log((M - n)!)
+def _log_terms(k, M, n, N, constant, table):
+    return constant - table[k] - table[n - k] - table[N - k] - table[M - n - N + k]
+
+
+def _log_tail(start, stop, M, n, N, table):
+    """log of the sum of the probabilities of k from start to stop.
+
+    The probabilities must decrease from start towards stop (start is on
+    the far side of the mode), so the sum is the first term times a sum of
+    ratios of at most 1, and stops after the terms become negligible.
+    """
+    step = np.where(stop >= start, 1, -1)
+    length = np.abs(stop - start) + 1
+    variance = N * (n / M) * ((M - n) / M) * ((M - N) / np.maximum(M - 1, 1))
+    width = np.minimum(
+        length, np.ceil(TAIL_SDS * np.sqrt(variance)).astype(np.int64) + TAIL_PAD
+    )
+    constant = table[n] + table[M - n]
+    log_total = table[M] - table[N] - table[M - N]
+
+    result = np.empty(len(start))
+    order = np.argsort(width, kind="stable")
+    widths = width[order]
+    i = 0
+    while i < len(order):
+        # Rows of similar width together, at most BLOCK_SIZE terms at once
+        j = min(len(order), i + max(1, BLOCK_SIZE // widths[i]))
+        while j > i + 1 and (j - i) * widths[j - 1] > BLOCK_SIZE:
+            j = i + max(1, BLOCK_SIZE // widths[j - 1])
+        rows = order[i:j]
+        offsets = np.arange(widths[j - 1])
+        inside = offsets < width[rows, None]
+        k = start[rows, None] + np.where(inside, step[rows, None] * offsets, 0)
+        terms = _log_terms(
+            k, M[rows, None], n[rows, None], N[rows, None], constant[rows, None], table
+        )
+        first = terms[:, 0]
+        ratios = np.where(inside, np.exp(terms - first[:, None]), 0.0)
+        result[rows] = first + np.log(ratios.sum(axis=1)) - log_total[rows]
+        i = j
+    return result
+
+
+def log_sf(x, M, n, N):
+    """log P(X >= x) of the hypergeometric distribution, elementwise.
+
+    Arguments are integer arrays (or scalars) that broadcast together. x
+    at or below the smallest possible overlap gives exactly 0 (P = 1), x
+    above the largest one -inf (P = 0); invalid parameters (e.g. N > M) give
+    nan, as in SciPy.
+    """
+    x, M, n, N = np.broadcast_arrays(
+        *(np.asarray(value, dtype=np.int64) for value in (x, M, n, N))
+    )
+    shape = x.shape
+    x, M, n, N = (value.ravel() for value in (x, M, n, N))
+    result = np.full(len(x), np.nan)
+    valid = (n >= 0) & (n <= M) & (N >= 0) & (N <= M)
+    low = np.maximum(0, N + n - M)
+    high = np.minimum(n, N)
+    result[valid & (x <= low)] = 0.0
+    result[valid & (x > high)] = -np.inf
+    tail = valid & (x > low) & (x <= high)
+    if tail.any():
+        table = log_factorials(M[tail].max())
+        mode = (n + 1) * (N + 1) // (M + 2)
+        # Past the mode, the tail itself is summed; below it, its
+        # complement, which is then at most 1 - P(X = mode)
+        upper = tail & (x > mode)
+        result[upper] = _log_tail(
+            x[upper], high[upper], M[upper], n[upper], N[upper], table
+        )
+        lower = tail & (x <= mode)
+        cdf = np.exp(
+            _log_tail(x[lower] - 1, low[lower], M[lower], n[lower], N[lower], table)
+        )
+        result[lower] = np.log1p(-np.minimum(cdf, 1.0))
+    return result.reshape(shape)
+
+
+# P(X >= x); underflows to 0 in the extreme tails, where log_sf does not
+def sf(x, M, n, N):
+    return np.exp(log_sf(x, M, n, N))
@@ -0,0 +1,347 @@
+# Background jobs for workloads that take longer than a request should:
+# large batches and GSEA permutations. Jobs are rows of a table in the app's
+# SQLite database, so any web worker process can report on them, and run in
+# a small thread pool of the process that accepted them.
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing
+
+STATUSES = ("queued", "running", "done", "failed", "cancelled")
+# Jobs that have not finished yet; a client can only have so many of them
+ACTIVE = ("queued", "running")
+# Seconds an unfinished job is kept without word from the process running
+# it, which renews the lease of its jobs every LEASE / 3 seconds. A job whose
+# process died (e.g. a worker killed on timeout) fails when its lease ends.
+LEASE = 60
+ABANDONED_ERROR = "the server process running it stopped"
+
+
+class JobCancelled(Exception):
+    pass
+
+
+class TooManyJobs(Exception):
+    pass
+
+
+class Job:
+    """Handle given to a running job function.
+
+    progress() records how far the job got and raises JobCancelled once
+    the job has been cancelled, so functions call it between chunks of
+    work and stop there.
+    """
+
+    def __init__(self, queue, job_id):
+        self.queue = queue
+        self.id = job_id
+
+    def progress(self, done, total):
+        with closing(self.queue._connect()) as conn, conn:
+            conn.execute(
+                "UPDATE jobs SET progress = ? WHERE id = ?",
+                (done / total if total else 1.0, self.id),
+            )
+            row = conn.execute(
+                "SELECT cancel_requested FROM jobs WHERE id = ?", (self.id,)
+            ).fetchone()
+        if row is None or row[0]:
+            raise JobCancelled()
+
+
+class JobQueue:
+    """Job table in a SQLite database and the pool that runs the jobs.
+
+    submit() stores a job and queues function(job, *args), whose return
+    value (anything JSON serializable) becomes the job result. Results are
+    kept for ttl seconds after the job ends; at most per_client jobs of a
+    client can be queued or running at once. The expires_at of a queued or
+    running job is the end of its lease (see LEASE).
+    """
+
+    def __init__(self, database, workers=2, ttl=3600, per_client=2, lease=LEASE):
+        self.database = database
+        self.workers = workers
+        self.ttl = ttl
+        self.per_client = per_client
+        self.lease = lease
+        self._executor = None
+        self._lock = threading.Lock()
+        self._ready = False
+        # Unfinished jobs of this process, whose leases it renews
+        self._owned = set()
+
+    def _connect(self):
+        return sqlite3.connect(self.database, timeout=30)
+
+    # Create the table on first use
+    def _ensure_table(self):
+        if self._ready:
+            return
+        with self._lock:
+            if self._ready:
+                return
+            with closing(self._connect()) as conn, conn:
+                conn.execute("""
+                    CREATE TABLE IF NOT EXISTS jobs (
+                        id TEXT PRIMARY KEY,
+                        client TEXT NOT NULL,
+                        kind TEXT NOT NULL,
+                        status TEXT NOT NULL,
+                        progress REAL NOT NULL DEFAULT 0,
+                        cancel_requested INTEGER NOT NULL DEFAULT 0,
+                        error TEXT,
+                        result TEXT,
+                        owner INTEGER NOT NULL,
+                        created_at REAL NOT NULL,
+                        started_at REAL,
+                        finished_at REAL,
+                        expires_at REAL
+                    )
+                """)
+                conn.execute(
+                    "CREATE INDEX IF NOT EXISTS jobs_client ON jobs (client, status)"
+                )
+            self._ready = True
+
+    # Fail the unfinished jobs of processes that are gone (a restarted server,
+    # a replaced or killed worker) or that stopped renewing their lease, so
+    # they stop counting against their client's limit and expire. Jobs past
+    # their lease fail at its end, as readers already see them (see _seen()).
+    # Only runs in the write transactions of submit() and cancel().
+    def _fail_abandoned(self, conn):
+        now = time.time()
+        owners = conn.execute(
+            """SELECT owner, MIN(COALESCE(expires_at, 0)) FROM jobs
+            WHERE status IN (?, ?) GROUP BY owner""",
+            ACTIVE,
+        ).fetchall()
+        for owner, lease_end in owners:
+            dead = not _process_alive(owner)
+            if dead or lease_end <= now:
+                conn.execute(
+                    """UPDATE jobs SET status = 'failed', error = ?,
+                    finished_at = MIN(?, COALESCE(expires_at, 0)),
+                    expires_at = MIN(?, COALESCE(expires_at, 0)) + ?
+                    WHERE owner = ? AND status IN (?, ?)
+                    AND (? OR COALESCE(expires_at, 0) <= ?)""",
+                    (ABANDONED_ERROR, now, now, self.ttl, owner, *ACTIVE, dead, now),
+                )
+
+    # (status, expires_at) of a job as readers see it: an unfinished job past
+    # its lease failed at the end of the lease, whether or not a submission
+    # has recorded it yet, so reads never write
+    def _seen(self, status, expires_at, now):
+        expires_at = expires_at or 0
+        if status in ACTIVE and expires_at <= now:
+            return "failed", expires_at + self.ttl
+        return status, expires_at
+
+    # Renew the leases of this process's unfinished jobs until it exits
+    def _heartbeat(self):
+        while True:
+            time.sleep(self.lease / 3)
+            with self._lock:
+                owned = list(self._owned)
+            if not owned:
+                continue
+            try:
+                with closing(self._connect()) as conn, conn:
+                    conn.executemany(
+                        """UPDATE jobs SET expires_at = ?
+                        WHERE id = ? AND status IN (?, ?)""",
+                        [
+                            (time.time() + self.lease, job_id, *ACTIVE)
+                            for job_id in owned
+                        ],
+                    )
+            except sqlite3.Error:
+                pass
+
+    # The pool and the lease renewal are started on the first job, so they
+    # are never inherited by worker processes forked from a preloaded app
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(
+                    max_workers=self.workers, thread_name_prefix="job"
+                )
+                threading.Thread(
+                    target=self._heartbeat, name="job-lease", daemon=True
+                ).start()
+        return self._executor
+
+    def submit(self, client, kind, function, *args):
+        self._ensure_table()
+        self.purge_expired()
+        job_id = uuid.uuid4().hex
+        with closing(self._connect()) as conn:
+            conn.isolation_level = None
+            # Count and insert in one write transaction, so concurrent
+            # submissions of a client cannot both pass the limit
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._fail_abandoned(conn)
+                (active,) = conn.execute(
+                    "SELECT COUNT(*) FROM jobs WHERE client = ? AND status IN (?, ?)",
+                    (client, *ACTIVE),
+                ).fetchone()
+                if active >= self.per_client:
+                    raise TooManyJobs(
+                        f"at most {self.per_client} unfinished jobs per client"
+                    )
+                now = time.time()
+                conn.execute(
+                    """INSERT INTO jobs (id, client, kind, status, owner,
+                    created_at, expires_at) VALUES (?, ?, ?, 'queued', ?, ?, ?)""",
+                    (job_id, client, kind, os.getpid(), now, now + self.lease),
+                )
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+        executor = self._get_executor()
+        with self._lock:
+            self._owned.add(job_id)
+        executor.submit(self._run, job_id, function, args)
+        return self.get(job_id)
+
+    def _run(self, job_id, function, args):
+        try:
+            self._run_owned(job_id, function, args)
+        finally:
+            with self._lock:
+                self._owned.discard(job_id)
+
+    def _run_owned(self, job_id, function, args):
+        now = time.time()
+        with closing(self._connect()) as conn, conn:
+            started = conn.execute(
+                """UPDATE jobs SET status = 'running', started_at = ?,
+                expires_at = ? WHERE id = ? AND status = 'queued'""",
+                (now, now + self.lease, job_id),
+            ).rowcount
+        # Cancelled (or failed) while it was queued
+        if not started:
+            return
+        status, error, result = "done", None, None
+        try:
+            result = json.dumps(function(Job(self, job_id), *args))
+        except JobCancelled:
+            status = "cancelled"
+        except Exception as e:
+            status, error = "failed", f"{type(e).__name__}: {e}"
+        now = time.time()
+        with closing(self._connect()) as conn, conn:
+            conn.execute(
+                """UPDATE jobs SET status = ?, error = ?, result = ?,
+                progress = CASE WHEN ? = 'done' THEN 1 ELSE progress END,
+                finished_at = ?, expires_at = ? WHERE id = ? AND status = 'running'""",
+                (status, error, result, status, now, now + self.ttl, job_id),
+            )
+
+    # Public description of a job, None when it does not exist (anymore)
+    def get(self, job_id):
+        self._ensure_table()
+        with closing(self._connect()) as conn:
+            conn.row_factory = sqlite3.Row
+            row = conn.execute(
+                """SELECT id, kind, status, progress, cancel_requested, error,
+                created_at, started_at, finished_at, expires_at FROM jobs
+                WHERE id = ?""",
+                (job_id,),
+            ).fetchone()
+        if row is None:
+            return None
+        job = dict(row, cancel_requested=bool(row["cancel_requested"]))
+        now = time.time()
+        status, expires_at = self._seen(job["status"], job["expires_at"], now)
+        if expires_at <= now:
+            return None
+        if status != job["status"]:
+            job.update(
+                status=status,
+                error=ABANDONED_ERROR,
+                finished_at=job["expires_at"],
+                expires_at=expires_at,
+            )
+        return job
+
+    # (status, JSON text of the result) of a job, None when it does not
+    # exist; the result is None unless the job is done
+    def result(self, job_id):
+        self._ensure_table()
+        with closing(self._connect()) as conn:
+            row = conn.execute(
+                "SELECT status, result, expires_at FROM jobs WHERE id = ?",
+                (job_id,),
+            ).fetchone()
+        if row is None:
+            return None
+        now = time.time()
+        status, expires_at = self._seen(row[0], row[2], now)
+        if expires_at <= now:
+            return None
+        return status, row[1]
+
+    # Queued jobs are cancelled right away; running ones stop at their next
+    # progress() call
+    def cancel(self, job_id):
+        self._ensure_table()
+        now = time.time()
+        with closing(self._connect()) as conn, conn:
+            self._fail_abandoned(conn)
+            conn.execute(
+                """UPDATE jobs SET status = 'cancelled', finished_at = ?,
+                expires_at = ? WHERE id = ? AND status = 'queued'""",
+                (now, now + self.ttl, job_id),
+            )
+            conn.execute(
+                "UPDATE jobs SET cancel_requested = 1 WHERE id = ? AND status = ?",
+                (job_id, "running"),
+            )
+        return self.get(job_id)
+
+    # Number of unexpired jobs by status
+    def counts(self):
+        self._ensure_table()
+        now = time.time()
+        with closing(self._connect()) as conn:
+            rows = conn.execute(
+                """SELECT status, expires_at FROM jobs
+                WHERE expires_at > ? OR status IN (?, ?)""",
+                (now - self.ttl, *ACTIVE),
+            ).fetchall()
+        counts = {}
+        for row in rows:
+            status, expires_at = self._seen(*row, now)
+            if expires_at > now:
+                counts[status] = counts.get(status, 0) + 1
+        return counts
+
+    # Delete the finished jobs past their ttl. Unfinished ones past their
+    # lease are failed (and kept for ttl) instead, so clients can see why.
+    def purge_expired(self):
+        self._ensure_table()
+        with closing(self._connect()) as conn, conn:
+            conn.execute(
+                "DELETE FROM jobs WHERE expires_at <= ? AND status NOT IN (?, ?)",
+                (time.time(), *ACTIVE),
+            )
+
+
+def _process_alive(pid):
+    if pid == os.getpid():
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
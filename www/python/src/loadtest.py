@@ -0,0 +1,176 @@
+"""Load test a running WikiORA server.
+
+Sends /api/enrich requests from a number of concurrent clients for a fixed
+time, at each of the given concurrency levels, and reports the throughput
+and the p50/p95 latency of each level. Every request has a different random
+gene list (drawn with a fixed seed from the example lists in static/) and
+a random library, so the result cache does not answer them.
+
+    gunicorn -c gunicorn.conf.py wsgi:application &
+    python loadtest.py [--url http://127.0.0.1:5000] [--concurrency 1,2,4,8]
+                       [--duration 20] [--genes 200] [--output results.json]
+
+Comparing runs with WIKIORA_WORKERS=1, 2, 4... on the same machine shows
+how the throughput scales with the worker processes (and cores).
+"""
+
+import argparse
+import http.client
+import json
+import sys
+import threading
+import time
+import urllib.parse
+from pathlib import Path
+
+import numpy as np
+
+HERE = Path(__file__).parent.resolve()
+ORGANISMS = ("human", "mouse")
+ANALYSIS_TYPES = (
+    "cell_type_markers",
+    "biological_processes",
+    "molecular_functions",
+    "cellular_components",
+)
+
+
+# Genes of the example lists of each organism
+def organism_genes():
+    genes = {}
+    for organism in ORGANISMS:
+        symbols = set()
+        for path in HERE.joinpath("static").glob(f"examples_{organism}_*.json"):
+            with open(path) as f:
+                for example in json.load(f):
+                    symbols.update(example.split("\n"))
+        genes[organism] = sorted(symbols)
+    return genes
+
+
+class Client(threading.Thread):
+    """Sends requests over one keep-alive connection until the deadline.
+
+    Each request is a random list of size genes against a random library,
+    drawn from the client's own seed.
+    """
+
+    def __init__(self, url, genes, size, seed, deadline):
+        super().__init__(daemon=True)
+        self.url = urllib.parse.urlsplit(url)
+        self.genes = genes
+        self.size = size
+        self.rng = np.random.default_rng(seed)
+        self.deadline = deadline
+        self.times = []
+        self.errors = 0
+
+    def body(self):
+        organism = ORGANISMS[self.rng.integers(len(ORGANISMS))]
+        return urllib.parse.urlencode(
+            {
+                "organism": organism,
+                "analysis_type": ANALYSIS_TYPES[self.rng.integers(len(ANALYSIS_TYPES))],
+                "gene_list": ", ".join(
+                    self.rng.choice(self.genes[organism], self.size)
+                ),
+            }
+        )
+
+    def connect(self):
+        return http.client.HTTPConnection(self.url.hostname, self.url.port or 80)
+
+    def run(self):
+        connection = self.connect()
+        headers = {"Content-Type": "application/x-www-form-urlencoded"}
+        while time.monotonic() < self.deadline:
+            body = self.body()
+            start = time.perf_counter()
+            try:
+                connection.request("POST", "/api/enrich", body, headers)
+                response = connection.getresponse()
+                response.read()
+                ok = response.status == 200
+            except (OSError, http.client.HTTPException):
+                connection.close()
+                connection = self.connect()
+                ok = False
+            if ok:
+                self.times.append(time.perf_counter() - start)
+            else:
+                self.errors += 1
+        connection.close()
+
+
+def percentile_ms(times, q):
+    if not len(times):
+        return None
+    return round(float(np.percentile(times, q)) * 1000, 2)
+
+
+def run_level(url, concurrency, duration, genes, size, seeds):
+    deadline = time.monotonic() + duration
+    clients = [
+        Client(url, genes, size, seed, deadline) for seed in seeds.spawn(concurrency)
+    ]
+    start = time.perf_counter()
+    for client in clients:
+        client.start()
+    for client in clients:
+        client.join()
+    elapsed = time.perf_counter() - start
+    times = np.concatenate([client.times for client in clients] + [[]])
+    return {
+        "concurrency": concurrency,
+        "requests": len(times),
+        "errors": sum(client.errors for client in clients),
+        "requests_per_s": round(len(times) / elapsed, 2),
+        "p50_ms": percentile_ms(times, 50),
+        "p95_ms": percentile_ms(times, 95),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--url", default="http://127.0.0.1:5000")
+    parser.add_argument(
+        "--concurrency",
+        default="1,2,4,8",
+        help="comma-separated numbers of concurrent clients (default 1,2,4,8)",
+    )
+    parser.add_argument(
+        "--duration", type=float, default=20, help="seconds per level (default 20)"
+    )
+    parser.add_argument(
+        "--genes", type=int, default=200, help="genes per list (default 200)"
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    args = parser.parse_args()
+
+    levels = [int(level) for level in args.concurrency.split(",")]
+    genes = organism_genes()
+    # Every client of every level draws different lists
+    seeds = np.random.SeedSequence(args.seed)
+    results = []
+    for concurrency in levels:
+        result = run_level(
+            args.url, concurrency, args.duration, genes, args.genes, seeds
+        )
+        results.append(result)
+        print(
+            f"{concurrency:3d} clients: {result['requests_per_s']:8.1f} req/s"
+            f"  p50 {result['p50_ms']} ms  p95 {result['p95_ms']} ms"
+            f"  errors {result['errors']}",
+            file=sys.stderr,
+        )
+    report = {"url": args.url, "genes": args.genes, "levels": results}
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+# Plotting of enrichment results. matplotlib is slow to import, so it is
+# only imported once a figure is rendered; the web app runs render_plot() in
+# worker processes and never loads matplotlib itself.
+import io
+
+import numpy as np
+
+PLOT_KINDS = ("both", "barplot", "dotplot")
+PLOT_FORMATS = {"png": "image/png", "svg": "image/svg+xml"}
+
+
+def _cmap():
+    from matplotlib import colormaps
+
+    return colormaps["Blues_r"]
+
+
+def _colorbar(fig, ax):
+    from matplotlib.cm import ScalarMappable
+    from matplotlib.colors import Normalize
+
+    mappable = ScalarMappable(cmap=_cmap(), norm=Normalize(vmin=0.0, vmax=1.0))
+    mappable.set_array([])
+    cbar = fig.colorbar(mappable, ax=ax, orientation="vertical", pad=0.01)
+    cbar.set_label("q-value", fontsize=12)
+
+
+def _barplot(fig, ax, rows):
+    descriptions = [row["Description"] for row in rows]
+    q_values = np.array([row["q-value"] for row in rows])
+    ax.barh(descriptions, -np.log10(q_values), color=_cmap()(q_values))
+    ax.axvline(-np.log10(0.05), color="red", linestyle="--", linewidth=1)
+    ax.set_xlabel("-log(q-value)", fontsize=14)
+    ax.set_title(f"Top {len(rows)} Enriched Terms by q-value", fontsize=16)
+    ax.tick_params(labelsize=12)
+    ax.invert_yaxis()
+    _colorbar(fig, ax)
+
+
+def _dotplot(fig, ax, rows):
+    # Sort by Gene Ratio and cap the Count values at 30 for dot sizes
+    rows = sorted(rows, key=lambda row: row["Gene Ratio"], reverse=True)
+    counts = np.minimum([row["Count"] for row in rows], 30)
+    ax.scatter(
+        [row["Gene Ratio"] for row in rows],
+        [row["Description"] for row in rows],
+        s=counts**0.7 * 23,
+        c=_cmap()(np.array([row["q-value"] for row in rows])),
+        edgecolors="black",
+        linewidth=0.8,
+    )
+    _colorbar(fig, ax)
+    ax.set_xlabel("Gene Ratio (overlap/set length)", fontsize=14)
+    ax.set_title(f"Top {len(rows)} Enriched Terms by Gene Ratio", fontsize=16)
+    ax.tick_params(labelsize=12)
+    ax.invert_yaxis()
+
+    # Adding dot size legend
+    for size in [2, 10, 30]:
+        ax.scatter(
+            [],
+            [],
+            c="k",
+            alpha=0.5,
+            s=size**0.7 * 23,
+            label=f'{size}{"+" if size == 30 else ""}',
+        )
+    ax.legend(
+        scatterpoints=1,
+        frameon=True,
+        labelspacing=1,
+        title="Count",
+        loc="lower right",
+        fontsize=12,
+    )
+
+
+def render_plot(rows, kind="both", output_format="png", dpi=150):
+    """Render the barplot and/or dotplot of enrichment results to bytes.
+
+    rows are result records (only "Description", "q-value", "Count" and
+    "Gene Ratio" are used). The figure is drawn on its own Figure object,
+    never through pyplot's global state, and returned as PNG or SVG data.
+    """
+    import matplotlib
+
+    matplotlib.use("Agg")
+    from matplotlib.figure import Figure
+
+    panels = ["barplot", "dotplot"] if kind == "both" else [kind]
+    fig = Figure(figsize=(12, 6 * len(panels)))
+    axes = fig.subplots(len(panels), 1, squeeze=False)[:, 0]
+    for panel, ax in zip(panels, axes):
+        (_barplot if panel == "barplot" else _dotplot)(fig, ax, rows)
+    fig.tight_layout()
+
+    buffer = io.BytesIO()
+    fig.savefig(buffer, format=output_format, dpi=dpi)
+    return buffer.getvalue()
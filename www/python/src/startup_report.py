@@ -0,0 +1,123 @@
+"""Measure how expensive it is to start a WikiORA worker.
+
+Each measurement runs in a fresh interpreter, the way a gunicorn worker
+starts:
+
+- import time of app.py (python -X importtime), with the slowest modules
+- resident memory after the import and after a first enrichment
+- whether serving an enrichment pulled matplotlib in
+
+    python startup_report.py [--budget-ms 1000] [--json]
+
+Exits with status 1 when the import takes longer than the budget or the
+enrichment path imports matplotlib.
+"""
+
+import argparse
+import json
+import subprocess
+import sys
+from pathlib import Path
+
+HERE = Path(__file__).parent.resolve()
+
+FIRST_REQUEST = """
+import json, os, resource, sys, tempfile
+import app
+after_import = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+# The request is counted in a scratch database, not the server's
+scratch = tempfile.TemporaryDirectory()
+app.usage.database = os.path.join(scratch.name, "startup_report.db")
+client = app.app.test_client()
+response = client.post(
+    "/api/enrich",
+    data={
+        "organism": "human",
+        "analysis_type": "cell_type_markers",
+        "gene_list": "CD3E, CD4, IL7R, CCR7, MS4A1, CD79A",
+    },
+)
+print(json.dumps({
+    "status": response.status_code,
+    "rss_after_import_kb": after_import,
+    "rss_after_request_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    "matplotlib_loaded": "matplotlib" in sys.modules,
+    "seaborn_loaded": "seaborn" in sys.modules,
+}))
+"""
+
+
+# Parse the "import time: self | cumulative | name" lines of -X importtime
+def import_times():
+    completed = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import app"],
+        cwd=HERE,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    modules = []
+    for line in completed.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:") :].split("|")
+        # Nested imports are indented by two spaces per level after the "| "
+        modules.append((name[1:].rstrip(), int(cumulative)))
+    total = sum(us for name, us in modules if not name.startswith(" "))
+    slowest = sorted(modules, key=lambda module: -module[1])[:15]
+    return total, [(name.strip(), us) for name, us in slowest]
+
+
+def first_request():
+    completed = subprocess.run(
+        [sys.executable, "-c", FIRST_REQUEST],
+        cwd=HERE,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    return json.loads(completed.stdout.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--budget-ms", type=float, default=1000)
+    parser.add_argument("--json", action="store_true", help="print JSON only")
+    args = parser.parse_args()
+
+    total_us, slowest = import_times()
+    request = first_request()
+    report = {
+        "import_ms": total_us / 1000,
+        "budget_ms": args.budget_ms,
+        "slowest_imports_ms": {name: us / 1000 for name, us in slowest},
+        **request,
+    }
+    failures = []
+    if report["import_ms"] > args.budget_ms:
+        failures.append(f"import took {report['import_ms']:.0f} ms")
+    if request["matplotlib_loaded"] or request["seaborn_loaded"]:
+        failures.append("the enrichment path imported matplotlib/seaborn")
+    if request["status"] != 200:
+        failures.append(f"/api/enrich answered {request['status']}")
+    report["failures"] = failures
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print(
+            f"import app: {report['import_ms']:.0f} ms (budget {args.budget_ms:.0f} ms)"
+        )
+        for name, ms in report["slowest_imports_ms"].items():
+            print(f"  {ms:8.1f} ms  {name}")
+        print(f"RSS after import: {request['rss_after_import_kb'] / 1024:.1f} MB")
+        print(
+            f"RSS after first request: {request['rss_after_request_kb'] / 1024:.1f} MB"
+        )
+        for failure in failures:
+            print(f"FAIL: {failure}")
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,187 @@
+"""Stand-in for the Wikidata SPARQL endpoint, for testing generate_gmt.py.
+
+Answers the queries of generate_gmt.build_jobs() with the bindings saved in
+fixtures/sparql/<job>.json, and can be told to fail the next requests of a
+job (e.g. with 429) to test the retries and resumed runs:
+
+    with SPARQLStub() as stub:
+        stub.fail("human_cell_type", 429)
+        generate_gmt.main(endpoint=stub.url, output_dir=...)
+
+The committed fixtures hold a few terms of each library of the committed
+gene sets, in the format of the endpoint's answers (their item IRIs are
+placeholders). To replace them with answers of a live endpoint:
+
+    python tests/sparql_stub.py record [--endpoint URL] [--terms 3]
+
+which keeps the first --terms items of each library and the aliases of
+their genes.
+"""
+
+import argparse
+import json
+import sys
+import threading
+import urllib.parse
+from collections import Counter, defaultdict, deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+HERE = Path(__file__).parent.resolve()
+sys.path.insert(0, str(HERE.parent))
+
+import generate_gmt  # noqa: E402
+
+FIXTURES = HERE.joinpath("fixtures", "sparql")
+
+
+def fixture_path(name, fixtures_dir=FIXTURES):
+    return Path(fixtures_dir).joinpath(f"{name}.json")
+
+
+def read_fixture(name, fixtures_dir=FIXTURES):
+    with open(fixture_path(name, fixtures_dir)) as f:
+        return json.load(f)
+
+
+# One binding per line, so fixture changes diff well
+def write_fixture(name, bindings, fixtures_dir=FIXTURES):
+    with open(fixture_path(name, fixtures_dir), "w") as f:
+        f.write("[\n")
+        f.write(",\n".join(json.dumps(row, sort_keys=True) for row in bindings))
+        f.write("\n]\n")
+
+
+class SPARQLStub:
+    """Local HTTP server answering the queries of build_jobs() from fixtures.
+
+    requests counts the requests of each job; fail(job, status, times)
+    makes the next times requests of a job answer status, with a
+    Retry-After of 0 so the client retries at once.
+    """
+
+    def __init__(self, fixtures_dir=FIXTURES):
+        self.jobs = {query: name for name, query in generate_gmt.build_jobs().items()}
+        self.bindings = {
+            name: read_fixture(name, fixtures_dir) for name in self.jobs.values()
+        }
+        self.requests = Counter()
+        self._failures = defaultdict(deque)
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), self._handler())
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address
+        return f"http://{host}:{port}/sparql"
+
+    def fail(self, job, status, times=1):
+        with self._lock:
+            self._failures[job].extend([status] * times)
+
+    # (status, body) of the answer to a query
+    def answer(self, query):
+        name = self.jobs.get(query)
+        if name is None:
+            return 400, {"error": "unknown query"}
+        with self._lock:
+            self.requests[name] += 1
+            failures = self._failures[name]
+            if failures:
+                return failures.popleft(), {"error": "injected failure"}
+        bindings = self.bindings[name]
+        variables = sorted({key for row in bindings for key in row})
+        return 200, {"head": {"vars": variables}, "results": {"bindings": bindings}}
+
+    def _handler(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length", 0))
+                form = urllib.parse.parse_qs(self.rfile.read(length).decode("utf-8"))
+                status, body = stub.answer(form.get("query", [""])[0])
+                data = json.dumps(body).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/sparql-results+json")
+                self.send_header("Content-Length", str(len(data)))
+                if status == 429 or status >= 500:
+                    self.send_header("Retry-After", "0")
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+# Bindings of the first `terms` items of each library job, the Wikipedia
+# links of the molecular functions kept and the aliases of the genes kept
+def trim_bindings(results, terms):
+    trimmed = {}
+    genes = defaultdict(set)
+    functions = set()
+    for name, bindings in results.items():
+        if name.endswith("_gene_aliases") or name == "molecular_functions_wikipedia":
+            continue
+        items = sorted({row["item"]["value"] for row in bindings})[:terms]
+        trimmed[name] = [row for row in bindings if row["item"]["value"] in items]
+        organism = name.split("_")[0]
+        genes[organism].update(row["gene_symbol"]["value"] for row in trimmed[name])
+        if name.endswith("_molecular_functions_genes"):
+            functions.update(items)
+    trimmed["molecular_functions_wikipedia"] = [
+        row
+        for row in results["molecular_functions_wikipedia"]
+        if row["item"]["value"] in functions
+    ]
+    for organism in generate_gmt.ORGANISM_IDS:
+        name = f"{organism}_gene_aliases"
+        trimmed[name] = [
+            row
+            for row in results[name]
+            if row["gene_symbol"]["value"] in genes[organism]
+        ]
+    return trimmed
+
+
+def record(endpoint, terms, fixtures_dir=FIXTURES):
+    results = {
+        name: generate_gmt.fetch_data(query, endpoint)
+        for name, query in generate_gmt.build_jobs().items()
+    }
+    for name, bindings in trim_bindings(results, terms).items():
+        write_fixture(name, bindings, fixtures_dir)
+        print(f"{name}: {len(bindings)} bindings")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    record_parser = subparsers.add_parser(
+        "record", help="record the fixtures from a live endpoint"
+    )
+    record_parser.add_argument("--endpoint", default=generate_gmt.SPARQL_ENDPOINT)
+    record_parser.add_argument(
+        "--terms", type=int, default=3, help="items kept per library (default 3)"
+    )
+    args = parser.parse_args()
+    record(args.endpoint, args.terms)
@@ -0,0 +1,47 @@
+import pytest
+
+from app import app
+
+NOT_OBJECTS = ["[1, 2]", '"x"', "5"]
+
+
+# Valid JSON that is not an object is a client error, not a crash
+@pytest.mark.parametrize("body", NOT_OBJECTS)
+def test_job_rejects_non_object_body(body):
+    response = app.test_client().post(
+        "/api/jobs", data=body, content_type="application/json"
+    )
+    assert response.status_code == 400
+    assert "error" in response.get_json()
+
+
+# Batches must be objects too; parse_batch is shared with the batch jobs
+@pytest.mark.parametrize("body", NOT_OBJECTS)
+def test_batch_rejects_non_object_body(body):
+    response = app.test_client().post(
+        "/api/enrich/batch", data=body, content_type="application/json"
+    )
+    assert response.status_code == 400
+    assert "error" in response.get_json()
+
+
+# So must GSEA requests (form posts are still accepted)
+@pytest.mark.parametrize("body", NOT_OBJECTS)
+def test_gsea_rejects_non_object_body(body):
+    response = app.test_client().post(
+        "/api/gsea", data=body, content_type="application/json"
+    )
+    assert response.status_code == 400
+    assert "error" in response.get_json()
+
+
+# Plots are of one library; several are refused rather than replaced by the
+# default one
+@pytest.mark.parametrize("analysis_type", ["all", "cell_type_markers,molecular_functions"])
+def test_plot_rejects_several_libraries(analysis_type):
+    response = app.test_client().get(
+        "/api/enrich/plot",
+        query_string={"gene_list": "CD3E", "analysis_type": analysis_type},
+    )
+    assert response.status_code == 400
+    assert "error" in response.get_json()
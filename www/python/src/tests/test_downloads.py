@@ -0,0 +1,66 @@
+import gzip
+import os
+
+import pytest
+
+from app import app
+from downloads import compress_download, current_record
+from gene_sets import STATIC
+
+FILE = "gene_sets_human_cell_type.gmt"
+
+
+@pytest.fixture
+def client():
+    return app.test_client()
+
+
+def test_gzip_copy_with_etag(client):
+    response = client.get(f"/static/{FILE}", headers={"Accept-Encoding": "gzip"})
+    assert response.status_code == 200
+    assert response.headers["Content-Encoding"] == "gzip"
+    assert "Accept-Encoding" in response.headers["Vary"]
+    assert gzip.decompress(response.data) == STATIC.joinpath(FILE).read_bytes()
+
+    etag = response.headers["ETag"]
+    response = client.get(
+        f"/static/{FILE}", headers={"Accept-Encoding": "gzip", "If-None-Match": etag}
+    )
+    assert response.status_code == 304
+
+
+def test_identity_without_accept_encoding(client):
+    response = client.get(f"/static/{FILE}")
+    assert "Content-Encoding" not in response.headers
+    assert response.data == STATIC.joinpath(FILE).read_bytes()
+
+
+@pytest.mark.parametrize(
+    "path",
+    [
+        f"/static/js/../{FILE}",
+        f"/static/../static/{FILE}",
+        f"/static/js/../../static/{FILE}",
+        "/static/../app.py",
+    ],
+)
+def test_paths_outside_static_are_not_found(client, path):
+    assert client.get(path).status_code == 404
+
+
+# A hand edit that keeps the size is caught by the hash, while a file only
+# touched since the build (as by a checkout) keeps its record
+def test_same_size_edit_drops_record(tmp_path):
+    path = tmp_path / FILE
+    path.write_text("T1\tdescription\tGENE1\n")
+    record = compress_download(path)
+    index = {FILE: record}
+    assert current_record(index, path, tmp_path) == record
+
+    os.utime(path, ns=(0, record["mtime_ns"] + 10**9))
+    assert current_record(index, path, tmp_path) == record
+
+    path.write_text("T1\tdescription\tGENE2\n")
+    os.utime(path, ns=(0, record["mtime_ns"] + 2 * 10**9))
+    assert path.stat().st_size == record["size"]
+    assert current_record(index, path, tmp_path) is None
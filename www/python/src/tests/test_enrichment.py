@@ -0,0 +1,187 @@
+import numpy as np
+import pytest
+from scipy.stats import hypergeom
+
+import app as wikiora
+from app import app
+from enrichment import (
+    Background,
+    benjamini_hochberg,
+    collapse_terms,
+    enrichment_statistics,
+    term_similarity,
+)
+from gene_sets import GeneSetLibrary, LibraryGroup, compile_library_arrays
+
+TERMS = {
+    "T1": ["A", "B", "C", "D"],
+    "T2": ["C", "D", "E", "F", "G"],
+    "T3": ["F", "G", "H"],
+    "T4": ["A", "B", "C", "E"],
+    "T5": ["I", "J"],
+}
+LIBRARY = GeneSetLibrary(
+    "human",
+    "cell_type_markers",
+    compile_library_arrays(
+        {
+            term: {"description": term, "wikipedia_url": "", "genes": genes}
+            for term, genes in TERMS.items()
+        }
+    ),
+)
+# A second library sharing some genes, with a larger universe
+OTHER_TERMS = {
+    "M1": ["A", "K", "L"],
+    "M2": ["C", "G", "M", "N", "O"],
+    "M3": ["P", "Q"],
+}
+OTHER = GeneSetLibrary(
+    "human",
+    "molecular_functions",
+    compile_library_arrays(
+        {
+            term: {"description": term, "wikipedia_url": "", "genes": genes}
+            for term, genes in OTHER_TERMS.items()
+        }
+    ),
+)
+
+
+# With a background, M, n and N are all counted within it and the p-values
+# are the hypergeometric tails of those counts
+def test_background_recounts_universe():
+    universe = {"A", "B", "C", "E", "F", "H", "I", "OTHER"}
+    genes = ["A", "C", "C", "G", "F", "OTHER", "UNKNOWN"]
+    background = Background(LIBRARY, universe)
+    statistics = enrichment_statistics(LIBRARY, [genes], background)
+
+    M = len(universe & set(LIBRARY.genes))
+    N = len(set(genes) & universe & set(LIBRARY.genes))
+    assert background.M == M == 7 and N == 3
+    for j, term in enumerate(LIBRARY.terms):
+        members = set(TERMS[term]) & universe
+        x = len(members & set(genes))
+        assert statistics["Gene Set Size"][0, j] == len(members)
+        assert statistics["Count"][0, j] == x
+        expected = hypergeom.sf(x - 1, M, len(members), N) if x else 1.0
+        assert statistics["p-value"][0, j] == pytest.approx(expected, rel=1e-9)
+
+
+# Without one, M is the library and N the submitted list, as before
+def test_no_background_keeps_library_universe():
+    genes = ["A", "C", "C", "G"]
+    statistics = enrichment_statistics(LIBRARY, [genes])
+    sizes = [len(genes) for genes in TERMS.values()]
+    np.testing.assert_array_equal(statistics["Gene Set Size"][0], sizes)
+    expected = hypergeom.sf(1, len(LIBRARY.genes), 4, len(genes))
+    assert statistics["p-value"][0, 0] == pytest.approx(expected, rel=1e-9)
+
+
+# A background without a single library gene is a client error
+def test_background_outside_library_is_rejected():
+    response = app.test_client().get(
+        "/api/enrich",
+        query_string={
+            "organism": "human",
+            "gene_list": "CD3E\nCD4",
+            "background": "NOTAGENE1\nNOTAGENE2",
+        },
+    )
+    assert response.status_code == 400
+    assert "background" in response.get_json()["error"]
+
+
+# A group of libraries gives every term the statistics of its own library,
+# with or without a background
+@pytest.mark.parametrize("universe", [None, {"A", "C", "G", "K", "M", "P", "Z"}])
+def test_group_matches_separate_libraries(universe):
+    genes = ["A", "C", "G", "K", "Z"]
+    group = LibraryGroup([LIBRARY, OTHER])
+    separate = []
+    for library in (group, LIBRARY, OTHER):
+        background = None if universe is None else Background(library, universe)
+        separate.append(enrichment_statistics(library, [genes], background))
+    grouped, *libraries = separate
+    for column, values in grouped.items():
+        expected = np.concatenate([statistics[column] for statistics in libraries], 1)
+        np.testing.assert_allclose(values, expected, rtol=1e-12)
+
+
+# q-values are corrected within each library, global ones across all of them
+def test_library_and_global_q_values():
+    genes = ["A", "C", "G", "K"]
+    group = LibraryGroup([LIBRARY, OTHER])
+    view = dict(wikiora.DEFAULT_VIEW, limit=None, min_count=0)
+    libraries, _ = wikiora.multi_library_results(group, genes, view)
+    records = {
+        record["Term"]: record
+        for library in libraries.values()
+        for record in library["results"]
+    }
+    assert len(records) == len(group)
+    p_values = {term: record["p-value"] for term, record in records.items()}
+    global_q = benjamini_hochberg(list(p_values.values()))
+    for term, q in zip(p_values, global_q):
+        assert records[term]["global q-value"] == pytest.approx(q)
+    for terms in (TERMS, OTHER_TERMS):
+        library_q = benjamini_hochberg([p_values[term] for term in terms])
+        for term, q in zip(terms, library_q):
+            assert records[term]["q-value"] == pytest.approx(q)
+
+
+# Cohen's kappa of two terms' membership over the library genes
+def kappa(a, b, genes):
+    both = len(a & b)
+    neither = len(genes) - len(a | b)
+    observed = (both + neither) / len(genes)
+    expected = (len(a) * len(b) + (len(genes) - len(a)) * (len(genes) - len(b))) / len(
+        genes
+    ) ** 2
+    return (observed - expected) / (1 - expected)
+
+
+# Similarities of the pairs that share genes, from the overlap index, match
+# the ones computed from the gene sets
+@pytest.mark.parametrize("measure", ["jaccard", "kappa"])
+def test_term_similarity(measure):
+    terms = [3, 0, 1]
+    similarity = term_similarity(LIBRARY, terms, measure).toarray()
+    sets = [set(TERMS[LIBRARY.terms[j]]) for j in terms]
+    for i, a in enumerate(sets):
+        for k, b in enumerate(sets):
+            if not a & b:
+                expected = 0
+            elif measure == "jaccard":
+                expected = len(a & b) / len(a | b)
+            else:
+                expected = kappa(a, b, set(LIBRARY.genes))
+            assert similarity[i, k] == pytest.approx(expected)
+
+
+# Going down the ranking, each ungrouped term takes the remaining terms
+# similar enough to it; grouped terms never start or join another cluster
+# (T2 is grouped with T1 at 0.25, so T3 is left on its own); members are in
+# ranking order
+@pytest.mark.parametrize(
+    "threshold, expected",
+    [
+        (0.3, [("T1", {"T4": 3 / 5}), ("T2", {"T3": 2 / 6}), ("T5", {})]),
+        (0.25, [("T1", {"T2": 2 / 7, "T4": 3 / 5}), ("T3", {}), ("T5", {})]),
+    ],
+)
+def test_collapse_terms(threshold, expected):
+    index = {term: j for j, term in enumerate(LIBRARY.terms)}
+    ranking = [index[term] for term in ("T1", "T2", "T4", "T3", "T5")]
+    clusters = collapse_terms(LIBRARY, ranking, threshold=threshold)
+    named = [
+        (
+            LIBRARY.terms[representative],
+            [(LIBRARY.terms[m], value) for m, value in zip(members, values)],
+        )
+        for representative, members, values in clusters
+    ]
+    assert named == [
+        (term, [(m, pytest.approx(v)) for m, v in members.items()])
+        for term, members in expected
+    ]
@@ -0,0 +1,58 @@
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+import fetch_wikipedia_genes
+
+TSV = (
+    "?gene\t?geneLabel\t?pageStatus\t?wikipediaLink\n"
+    '<http://www.wikidata.org/entity/Q1>\t"CD4"\t"blue"\t'
+    "<https://en.wikipedia.org/wiki/CD4>\n"
+    '<http://www.wikidata.org/entity/Q2>\t"CD8A"\t"red"\t'
+    "<https://en.wikipedia.org/wiki/CD8A>\n"
+).encode("utf-8")
+
+
+# Answers with TSV, dropping the connection in the middle of the first
+# response's body
+@pytest.fixture
+def endpoint():
+    requests_seen = []
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_GET(self):
+            requests_seen.append(self.path)
+            self.send_response(200)
+            self.send_header("Content-Type", "text/tab-separated-values")
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+            if len(requests_seen) == 1:
+                # A chunk announced longer than what is sent before closing
+                self.wfile.write(b"%x\r\n%s" % (len(TSV), TSV[:60]))
+                self.wfile.flush()
+                self.close_connection = True
+                return
+            self.wfile.write(b"%x\r\n%s\r\n0\r\n\r\n" % (len(TSV), TSV))
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    host, port = server.server_address
+    yield f"http://{host}:{port}/sparql", requests_seen
+    server.shutdown()
+    server.server_close()
+
+
+def test_dropped_stream_is_retried(endpoint, monkeypatch):
+    monkeypatch.setattr(fetch_wikipedia_genes, "RETRY_DELAY", 0)
+    url, requests_seen = endpoint
+    rows = list(fetch_wikipedia_genes.stream_sparql_rows(url, "SELECT"))
+    assert len(requests_seen) == 2
+    assert [row["geneLabel"] for row in rows][-2:] == ["CD4", "CD8A"]
+    assert rows[-1]["wikipediaLink"] == "https://en.wikipedia.org/wiki/CD8A"
@@ -0,0 +1,47 @@
+import os
+import shutil
+
+from gene_sets import (
+    MANIFEST_NAME,
+    STATIC,
+    GeneSetLibrary,
+    binary_path,
+    gmt_path,
+)
+
+KEY = ("human", "cell_type_markers")
+
+
+# A static directory with the GMT, binary and manifest of one library
+def copy_library(tmp_path, manifest=True):
+    for path in (gmt_path(*KEY), binary_path(*KEY)):
+        shutil.copy(path, tmp_path)
+    if manifest:
+        shutil.copy(STATIC / MANIFEST_NAME, tmp_path)
+
+
+# The binary is used whatever the file dates, as long as the GMT is the one
+# recorded in the manifest
+def test_binary_loaded_when_gmt_matches_manifest(tmp_path):
+    copy_library(tmp_path)
+    os.utime(binary_path(*KEY, tmp_path), (0, 0))
+    library = GeneSetLibrary.load(*KEY, tmp_path)
+    assert library.source == binary_path(*KEY, tmp_path)
+
+
+# A GMT edited by hand is compiled, even when the binary looks newer
+def test_edited_gmt_is_compiled(tmp_path):
+    copy_library(tmp_path)
+    gmt = gmt_path(*KEY, tmp_path)
+    lines = gmt.read_text().splitlines(keepends=True)
+    gmt.write_text("".join(lines[1:]))
+    os.utime(gmt, (0, 0))
+    library = GeneSetLibrary.load(*KEY, tmp_path)
+    assert library.source == gmt
+    assert len(library) == len(lines) - 1
+
+
+# Without a manifest there is nothing to check the binary against
+def test_gmt_compiled_without_manifest(tmp_path):
+    copy_library(tmp_path, manifest=False)
+    assert GeneSetLibrary.load(*KEY, tmp_path).source == gmt_path(*KEY, tmp_path)
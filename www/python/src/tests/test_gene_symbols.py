@@ -0,0 +1,44 @@
+from gene_symbols import SymbolIndex, compile_symbol_index
+
+ROWS = [
+    ("CD4", "T4"),
+    ("CD8A", "CD8"),
+    ("MS4A1", "CD20"),
+    ("MS4A1", "B1"),
+    ("CD19", "B1"),
+    ("IL2", "il2"),
+    ("Cd4", None),
+]
+
+
+# Aliases shared by several genes, or equal to a symbol up to case, are left
+# out of the index
+def test_compile_symbol_index():
+    index = compile_symbol_index(ROWS)
+    assert index["symbols"] == ["CD19", "CD4", "CD8A", "Cd4", "IL2", "MS4A1"]
+    assert index["aliases"] == {"cd20": "MS4A1", "cd8": "CD8A", "t4": "CD4"}
+
+
+# Exact symbols first, then an unambiguous case-folded symbol, then aliases
+def test_resolve_by_case_and_alias():
+    index = SymbolIndex(["CD4", "CD8A", "MS4A1", "IL2"], {"cd20": "MS4A1"})
+    resolved, report = index.resolve(["CD4", "il2", "Cd20", "FOO", "il2"])
+    assert resolved == ["CD4", "IL2", "MS4A1", "FOO", "IL2"]
+    assert report == {
+        "mapped": ["CD4"],
+        "remapped": [
+            {"input": "il2", "symbol": "IL2", "match": "case"},
+            {"input": "Cd20", "symbol": "MS4A1", "match": "alias"},
+        ],
+        "unrecognized": ["FOO"],
+    }
+
+
+# A case-folded input matching several symbols is not guessed
+def test_ambiguous_case_is_unrecognized():
+    index = compile_symbol_index(ROWS)
+    index = SymbolIndex(index["symbols"], index["aliases"])
+    assert index.resolve(["cd4", "Cd4"]) == (
+        ["cd4", "Cd4"],
+        {"mapped": ["Cd4"], "remapped": [], "unrecognized": ["cd4"]},
+    )
@@ -0,0 +1,124 @@
+import json
+import os
+import time
+
+import pytest
+
+import generate_gmt
+from gene_sets import (
+    ANALYSIS_TYPES,
+    ORGANISMS,
+    gmt_path,
+    library_name,
+    load_gmt,
+    read_manifest,
+)
+from gene_symbols import symbol_index_path
+from sparql_stub import SPARQLStub, read_fixture, trim_bindings
+
+
+def build(stub, tmp_path):
+    generate_gmt.main(
+        endpoint=stub.url,
+        output_dir=tmp_path / "static",
+        checkpoint_dir=tmp_path / "checkpoints",
+        min_interval=0,
+    )
+
+
+# A 429 is retried; a job that keeps failing fails the run, and the next run
+# only queries that job again and builds every output
+def test_build_retries_and_resumes(tmp_path):
+    (tmp_path / "static").mkdir()
+    with SPARQLStub() as stub:
+        stub.fail("human_cell_type", 429)
+        stub.fail("mouse_gene_aliases", 503, times=5)
+        with pytest.raises(generate_gmt.SPARQLError, match="mouse_gene_aliases"):
+            build(stub, tmp_path)
+        assert stub.requests["human_cell_type"] == 2
+        assert stub.requests["mouse_gene_aliases"] == 5
+        assert not read_manifest(tmp_path / "static")
+        first_run = stub.requests.copy()
+
+        build(stub, tmp_path)
+        assert stub.requests - first_run == {"mouse_gene_aliases": 1}
+
+    manifest = read_manifest(tmp_path / "static")
+    for organism in ORGANISMS:
+        assert f"{organism}_gene_symbols" in manifest
+        assert symbol_index_path(organism, tmp_path / "static").exists()
+        for analysis_type in ANALYSIS_TYPES:
+            assert library_name(organism, analysis_type) in manifest
+            gene_sets = load_gmt(gmt_path(organism, analysis_type, tmp_path / "static"))
+            assert gene_sets
+    # The checkpoints only serve one refresh
+    assert not list((tmp_path / "checkpoints").glob("*.json"))
+
+
+def test_cell_type_library_from_fixture(tmp_path):
+    (tmp_path / "static").mkdir()
+    with SPARQLStub() as stub:
+        build(stub, tmp_path)
+    gene_sets = load_gmt(gmt_path("human", "cell_type_markers", tmp_path / "static"))
+    expected = {}
+    for row in read_fixture("human_cell_type"):
+        expected.setdefault(row["itemLabel"]["value"], set()).add(
+            row["gene_symbol"]["value"]
+        )
+    assert {term: set(d["genes"]) for term, d in gene_sets.items()} == expected
+    with open(symbol_index_path("human", tmp_path / "static")) as f:
+        assert json.load(f)["aliases"]["cd20"] == "MS4A1"
+
+
+# A rerun with unchanged answers rebuilds nothing
+def test_unchanged_rebuild_is_skipped(tmp_path):
+    (tmp_path / "static").mkdir()
+    with SPARQLStub() as stub:
+        build(stub, tmp_path)
+        before = (tmp_path / "static" / "gene_sets_manifest.json").read_text()
+        build(stub, tmp_path)
+    assert (tmp_path / "static" / "gene_sets_manifest.json").read_text() == before
+
+
+def test_trim_bindings_keeps_consistent_subset():
+    with SPARQLStub() as stub:
+        results = stub.bindings
+    trimmed = trim_bindings(results, terms=1)
+    for name in ("human_cell_type", "mouse_biological_processes"):
+        assert len({row["item"]["value"] for row in trimmed[name]}) == 1
+    genes = {row["gene_symbol"]["value"] for row in trimmed["human_cell_type"]}
+    assert genes <= {
+        row["gene_symbol"]["value"] for row in trimmed["human_gene_aliases"]
+    }
+
+
+# Checkpoints of a failed run are resumed for a day; older ones, or any with
+# fresh=True, are queried again
+def test_stale_checkpoints_are_queried_again(tmp_path):
+    (tmp_path / "static").mkdir()
+    jobs = len(generate_gmt.build_jobs())
+    with SPARQLStub() as stub:
+        stub.fail("mouse_gene_aliases", 503, times=5)
+        with pytest.raises(generate_gmt.SPARQLError):
+            build(stub, tmp_path)
+        checkpoints = list((tmp_path / "checkpoints").glob("*.json"))
+        assert len(checkpoints) == jobs - 1
+        stale = time.time() - generate_gmt.CHECKPOINT_MAX_AGE - 60
+        for path in checkpoints[:2]:
+            os.utime(path, (stale, stale))
+        first_run = stub.requests.copy()
+        build(stub, tmp_path)
+        assert sum((stub.requests - first_run).values()) == 3
+
+        stub.fail("mouse_gene_aliases", 503, times=5)
+        with pytest.raises(generate_gmt.SPARQLError):
+            build(stub, tmp_path)
+        second_run = stub.requests.copy()
+        generate_gmt.main(
+            endpoint=stub.url,
+            output_dir=tmp_path / "static",
+            checkpoint_dir=tmp_path / "checkpoints",
+            min_interval=0,
+            fresh=True,
+        )
+        assert sum((stub.requests - second_run).values()) == jobs
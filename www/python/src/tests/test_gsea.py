@@ -0,0 +1,142 @@
+import time
+
+import numpy as np
+import pytest
+
+import app
+from gene_sets import GeneSetLibrary, compile_library_arrays
+from gsea import gsea, leading_edge, ranked_list
+
+GENES = [f"G{i}" for i in range(300)]
+# Terms of 5 to 60 genes, some of them outside the ranked list
+TERMS = {
+    f"T{j}": {
+        "description": f"term {j}",
+        "wikipedia_url": "",
+        "genes": [f"G{i}" for i in range(3 * j, 3 * j + 5 + 5 * j)],
+    }
+    for j in range(12)
+}
+LIBRARY = GeneSetLibrary("human", "cell_type_markers", compile_library_arrays(TERMS))
+
+
+def ranked(seed=0, n=250):
+    rng = np.random.default_rng(seed)
+    return ranked_list(GENES[:n], rng.normal(size=n))
+
+
+# Running sum walked gene by gene: the ES and the rank where it is reached
+def brute_force_es(genes, scores, members, weight=1.0):
+    hits = [gene in members for gene in genes]
+    total = sum(abs(s) ** weight for s, hit in zip(scores, hits) if hit)
+    miss = 1 / (len(genes) - sum(hits))
+    running, es, peak = 0.0, 0.0, -1
+    for rank, (score, hit) in enumerate(zip(scores, hits)):
+        running += abs(score) ** weight / total if hit else -miss
+        if abs(running) > abs(es):
+            es, peak = running, rank
+    return es, peak
+
+
+# Vectorized enrichment scores agree with the running sum for every weight
+@pytest.mark.parametrize("weight", [0.0, 1.0, 2.0])
+def test_es_matches_running_sum(weight):
+    genes, scores = ranked()
+    statistics = gsea(
+        LIBRARY, genes, scores, permutations=10, weight=weight, min_size=1
+    )
+    for j, term in enumerate(LIBRARY.terms):
+        es, _ = brute_force_es(genes, scores, set(TERMS[term]["genes"]), weight)
+        assert statistics["ES"][j] == pytest.approx(es, abs=1e-12)
+
+
+# The permutations only depend on the seed
+def test_same_seed_same_statistics():
+    genes, scores = ranked()
+    first = gsea(LIBRARY, genes, scores, permutations=250, seed=7, min_size=1)
+    second = gsea(LIBRARY, genes, scores, permutations=250, seed=7, min_size=1)
+    other = gsea(LIBRARY, genes, scores, permutations=250, seed=8, min_size=1)
+    for column in ("NES", "p-value"):
+        np.testing.assert_array_equal(first[column], second[column])
+    assert not np.array_equal(first["p-value"], other["p-value"])
+
+
+# Only terms with min_size to max_size genes in the list are tested
+def test_size_filter():
+    genes, scores = ranked(n=100)
+    statistics = gsea(LIBRARY, genes, scores, permutations=10, min_size=8, max_size=30)
+    sizes = [len(set(TERMS[term]["genes"]) & set(genes)) for term in LIBRARY.terms]
+    np.testing.assert_array_equal(statistics["Gene Set Size"], sizes)
+    expected = [8 <= size <= 30 for size in sizes]
+    np.testing.assert_array_equal(statistics["tested"], expected)
+    assert np.isnan(statistics["p-value"][~statistics["tested"]]).all()
+    assert not np.isnan(statistics["p-value"][statistics["tested"]]).any()
+
+
+# The leading edge is the members up to the peak of a positive ES, and from
+# it on for a negative one
+def test_leading_edge_members():
+    genes, scores = ranked(seed=3)
+    statistics = gsea(LIBRARY, genes, scores, permutations=10, min_size=1)
+    signs = set()
+    for j, term in enumerate(LIBRARY.terms):
+        members = set(TERMS[term]["genes"])
+        es, peak = brute_force_es(genes, scores, members)
+        edge = [
+            gene
+            for rank, gene in enumerate(genes)
+            if gene in members and (rank <= peak if es >= 0 else rank >= peak)
+        ]
+        assert leading_edge(LIBRARY, genes, statistics, j) == edge
+        signs.add(es >= 0)
+    assert signs == {True, False}
+
+
+# Ranked lists as an object, as pairs and as .rnk text
+def test_parse_ranked_list_formats():
+    expected = (["A", "B", "C"], [2.0, -1.5, 0.0])
+    assert app.parse_ranked_list({"A": 2, "B": -1.5, "C": 0}) == expected
+    assert app.parse_ranked_list([["A", "2"], ("B", -1.5), ["C", 0]]) == expected
+    text = "# gene\tscore\nA\t2\nB -1.5\n\nC,0\n"
+    assert app.parse_ranked_list(text) == expected
+
+
+# Other types, malformed pairs, non-finite scores and empty lists
+@pytest.mark.parametrize(
+    "ranked_list",
+    [
+        None,
+        5,
+        [],
+        "",
+        [["A"]],
+        [["A", 1, 2]],
+        ["A"],
+        {"A": "x"},
+        {"A": "nan"},
+        [["A", float("inf")]],
+        "A\n",
+    ],
+)
+def test_parse_ranked_list_rejects(ranked_list):
+    with pytest.raises(ValueError):
+        app.parse_ranked_list(ranked_list)
+
+
+# A request past its timeout leaves the shared pool to the other requests
+def test_timeout_keeps_shared_pool(monkeypatch):
+    monkeypatch.setattr(app, "GSEA_WORKERS", 1)
+    pool = app.get_gsea_pool()
+    try:
+        other = pool.submit(abs, -1)
+        results = app.gsea_map(time.sleep, [1, 1, 1], timeout=0.2)
+        start = time.monotonic()
+        with pytest.raises(app.TimeoutError):
+            list(results)
+        assert time.monotonic() - start < 1
+        assert other.result(timeout=5) == 1
+        assert app.get_gsea_pool() is pool
+        # Only the batch already running is left before the next request
+        assert list(app.gsea_map(abs, [-2, 3], timeout=5)) == [2, 3]
+    finally:
+        app.reset_gsea_pool(pool)
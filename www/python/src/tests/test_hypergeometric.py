@@ -0,0 +1,75 @@
+import math
+
+import numpy as np
+import pytest
+from scipy.stats import hypergeom
+
+import hypergeometric
+
+
+# log P(X >= x) from exact integer binomial coefficients
+def exact_log_sf(x, M, n, N):
+    numerator = sum(
+        math.comb(n, k) * math.comb(M - n, N - k) for k in range(x, min(n, N) + 1)
+    )
+    if numerator == 0:
+        return -math.inf
+    return math.log(numerator) - math.log(math.comb(M, N))
+
+
+# Random parameters of the sizes the libraries have
+def test_sf_matches_scipy():
+    rng = np.random.default_rng(0)
+    M = rng.integers(1, 25000, 20000)
+    n = rng.integers(0, np.minimum(M, 3000) + 1)
+    N = rng.integers(0, np.minimum(M, 10000) + 1)
+    x = rng.integers(0, np.minimum(n, N) + 2)
+    ours = hypergeometric.sf(x, M, n, N)
+    theirs = hypergeom.sf(x - 1, M, n, N)
+    comparable = theirs > 1e-250
+    error = np.abs(ours - theirs)[comparable] / theirs[comparable]
+    assert error.max() <= 1e-9
+
+
+# Certain, impossible and invalid tails
+def test_edge_cases():
+    edge = hypergeometric.sf(
+        [0, 1, 5, 4, 2], [10, 10, 10, 10, 5], [3, 3, 3, 3, 3], [4, 4, 4, 11, 4]
+    )
+    expected = np.array([1.0, hypergeom.sf(0, 10, 3, 4), 0.0, np.nan, 1.0])
+    np.testing.assert_allclose(edge, expected, rtol=1e-12, equal_nan=True)
+    assert hypergeometric.log_sf(0, 10, 3, 4) == 0.0
+    assert hypergeometric.log_sf(5, 10, 3, 4) == -np.inf
+
+
+def test_broadcasts_and_keeps_shape():
+    x = np.arange(6).reshape(2, 3)
+    result = hypergeometric.sf(x, 100, 20, 10)
+    assert result.shape == (2, 3)
+    np.testing.assert_allclose(result, hypergeom.sf(x - 1, 100, 20, 10), rtol=1e-9)
+
+
+# Extreme tails, far below the smallest double, against exact arithmetic
+@pytest.mark.parametrize(
+    "M, n, N, x",
+    [
+        (20000, 1000, 1000, 1000),
+        (20000, 2000, 5000, 1500),
+        (18000, 300, 10000, 290),
+        (3500, 150, 3400, 150),
+        (12000, 50, 200, 40),
+        (12000, 50, 200, 3),
+    ],
+)
+def test_extreme_tails_match_exact_arithmetic(M, n, N, x):
+    ours = hypergeometric.log_sf(x, M, n, N)
+    exact = exact_log_sf(x, M, n, N)
+    assert np.isfinite(ours)
+    assert abs(ours - exact) <= 1e-9 * max(abs(exact), 1)
+
+
+def test_log_factorials_grow():
+    table = hypergeometric.log_factorials(50)
+    assert len(table) > 50
+    np.testing.assert_allclose(table[:51], [math.lgamma(k + 1) for k in range(51)])
+    assert len(hypergeometric.log_factorials(len(table) + 10)) > len(table) + 10
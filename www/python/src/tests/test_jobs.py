@@ -0,0 +1,122 @@
+import json
+import sqlite3
+import subprocess
+import sys
+import threading
+import time
+
+import pytest
+
+from jobs import ABANDONED_ERROR, JobQueue, TooManyJobs
+
+
+# Poll a job until it has one of the statuses
+def wait_for(queue, job_id, *statuses):
+    deadline = time.monotonic() + 10
+    while time.monotonic() < deadline:
+        job = queue.get(job_id)
+        if job["status"] in statuses:
+            return job
+        time.sleep(0.01)
+    raise AssertionError(f"job {job_id} is still {job['status']}")
+
+
+# Job function that waits for an event, reporting progress while it does
+def blocked(job, event):
+    while not event.wait(0.01):
+        job.progress(0, 1)
+    return "released"
+
+
+# Status, progress and result of a job that runs to its end
+def test_submit_poll_result(tmp_path):
+    queue = JobQueue(tmp_path / "jobs.db")
+    job = queue.submit("client", "sum", lambda job, a, b: {"sum": a + b}, 2, 3)
+    assert job["status"] in ("queued", "running", "done")
+    job = wait_for(queue, job["id"], "done")
+    assert job["progress"] == 1
+    status, result = queue.result(job["id"])
+    assert status == "done" and json.loads(result) == {"sum": 5}
+    assert queue.get("unknown") is None and queue.result("unknown") is None
+
+
+# Queued jobs are cancelled at once, running ones at their next progress()
+def test_cancel(tmp_path):
+    queue = JobQueue(tmp_path / "jobs.db", workers=1)
+    event = threading.Event()
+    try:
+        running = queue.submit("client", "wait", blocked, event)
+        queued = queue.submit("client", "wait", blocked, event)
+        wait_for(queue, running["id"], "running")
+        assert queue.cancel(queued["id"])["status"] == "cancelled"
+        assert queue.cancel(running["id"])["cancel_requested"]
+        wait_for(queue, running["id"], "cancelled")
+        assert queue.result(running["id"]) == ("cancelled", None)
+    finally:
+        event.set()
+
+
+# A client cannot have more than per_client unfinished jobs; others can
+def test_per_client_limit(tmp_path):
+    queue = JobQueue(tmp_path / "jobs.db", per_client=1)
+    event = threading.Event()
+    try:
+        job = queue.submit("client", "wait", blocked, event)
+        with pytest.raises(TooManyJobs):
+            queue.submit("client", "wait", blocked, event)
+        queue.submit("other", "wait", blocked, event)
+        event.set()
+        wait_for(queue, job["id"], "done")
+        queue.submit("client", "sum", lambda job: 1)
+    finally:
+        event.set()
+
+
+# Jobs past their lease read as failed without any write; jobs of a process
+# that is gone fail on the next submission, and stop counting for the limit
+def test_abandoned_jobs(tmp_path):
+    database = tmp_path / "jobs.db"
+    queue = JobQueue(database, per_client=1, ttl=100)
+    queue.counts()
+    dead = subprocess.Popen([sys.executable, "-c", ""])
+    dead.wait()
+    now = time.time()
+    with sqlite3.connect(database) as conn:
+        conn.executemany(
+            """INSERT INTO jobs (id, client, kind, status, owner, created_at,
+            expires_at) VALUES (?, ?, 'sum', 'running', ?, ?, ?)""",
+            [
+                ("expired", "a", 1, now - 20, now - 10),
+                ("dead", "b", dead.pid, now, now + 60),
+            ],
+        )
+
+    job = queue.get("expired")
+    assert job["status"] == "failed" and job["error"] == ABANDONED_ERROR
+    assert job["expires_at"] == pytest.approx(now + 90)
+    assert queue.get("dead")["status"] == "running"
+    assert queue.counts() == {"failed": 1, "running": 1}
+    with sqlite3.connect(database) as conn:
+        assert conn.execute(
+            "SELECT status FROM jobs WHERE id = 'expired'"
+        ).fetchone() == ("running",)
+
+    queue.submit("b", "sum", lambda job: 1)
+    with sqlite3.connect(database) as conn:
+        rows = dict(
+            conn.execute("SELECT id, status FROM jobs WHERE id IN ('expired', 'dead')")
+        )
+    assert rows == {"expired": "failed", "dead": "failed"}
+    assert queue.get("dead")["error"] == ABANDONED_ERROR
+    assert queue.get("expired")["expires_at"] == pytest.approx(now + 90)
+
+
+# Results are read from the database, so another queue (a restarted or
+# another worker process) serves them
+def test_results_survive_new_queue(tmp_path):
+    queue = JobQueue(tmp_path / "jobs.db")
+    job = queue.submit("client", "sum", lambda job: [1, 2])
+    wait_for(queue, job["id"], "done")
+    other = JobQueue(tmp_path / "jobs.db")
+    assert other.get(job["id"])["status"] == "done"
+    assert json.loads(other.result(job["id"])[1]) == [1, 2]
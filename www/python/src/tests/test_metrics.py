@@ -0,0 +1,50 @@
+from app import app
+from metrics import MetricsRegistry
+
+
+# Counters, cumulative histogram buckets and gauges in the text format, with
+# escaped label values
+def test_render():
+    registry = MetricsRegistry()
+    counter = registry.counter("requests_total", "Requests", ("path",))
+    histogram = registry.histogram("duration_seconds", "Durations", buckets=(0.1, 1))
+    registry.gauge("queue", "Queued jobs", lambda: {("a",): 2}, ("kind",))
+    counter.inc(path='say "hi"\n')
+    counter.inc(2, path='say "hi"\n')
+    for value in (0.05, 0.5, 0.5, 3):
+        histogram.observe(value)
+    assert registry.render() == (
+        "# HELP requests_total Requests\n"
+        "# TYPE requests_total counter\n"
+        'requests_total{path="say \\"hi\\"\\n"} 3\n'
+        "# HELP duration_seconds Durations\n"
+        "# TYPE duration_seconds histogram\n"
+        'duration_seconds_bucket{le="0.1"} 1\n'
+        'duration_seconds_bucket{le="1"} 3\n'
+        'duration_seconds_bucket{le="+Inf"} 4\n'
+        "duration_seconds_sum 4.05\n"
+        "duration_seconds_count 4\n"
+        "# HELP queue Queued jobs\n"
+        "# TYPE queue gauge\n"
+        'queue{kind="a"} 2\n'
+    )
+
+
+# The endpoint exposes the requests answered and the cache and job gauges
+def test_metrics_endpoint():
+    client = app.test_client()
+    client.get("/api/cache_stats")
+    response = client.get("/metrics")
+    assert response.status_code == 200
+    assert response.mimetype == "text/plain"
+    lines = response.get_data(as_text=True).splitlines()
+    assert "# TYPE wikiora_requests_total counter" in lines
+    assert any(
+        line.startswith('wikiora_requests_total{endpoint="cache_stats",status="200"}')
+        for line in lines
+    )
+    assert 'wikiora_cache_entries{cache="result"}' in "\n".join(lines)
+    for status in ("queued", "running", "done", "failed", "cancelled"):
+        assert any(
+            line.startswith(f'wikiora_jobs{{status="{status}"}}') for line in lines
+        )
@@ -0,0 +1,21 @@
+import hashlib
+from pathlib import Path
+
+import startup_report
+
+DATABASE = Path(startup_report.HERE, "database.db")
+
+
+def digest(path):
+    return hashlib.sha256(path.read_bytes()).hexdigest() if path.exists() else None
+
+
+# The enrichment path must not import matplotlib (plots are rendered in
+# separate processes), nor count its request in the server's database
+def test_enrichment_does_not_import_matplotlib():
+    before = digest(DATABASE)
+    request = startup_report.first_request()
+    assert request["status"] == 200
+    assert not request["matplotlib_loaded"]
+    assert not request["seaborn_loaded"]
+    assert digest(DATABASE) == before
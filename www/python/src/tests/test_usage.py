@@ -0,0 +1,75 @@
+import sqlite3
+
+import pytest
+
+from usage import UsageCounter
+
+
+# Rows of the usage table, without their day
+def usage_rows(database):
+    with sqlite3.connect(database) as conn:
+        return conn.execute(
+            "SELECT organism, analysis_type, endpoint, lists FROM usage ORDER BY 1, 2, 3"
+        ).fetchall()
+
+
+# The database is switched to write-ahead logging
+def test_wal_mode(tmp_path):
+    counter = UsageCounter(tmp_path / "usage.db")
+    counter.init_db()
+    with sqlite3.connect(tmp_path / "usage.db") as conn:
+        assert conn.execute("PRAGMA journal_mode").fetchone() == ("wal",)
+
+
+# Records stay in memory until a flush writes them all at once; the total
+# includes them meanwhile
+def test_batched_flush(tmp_path):
+    database = tmp_path / "usage.db"
+    counter = UsageCounter(database, flush_interval=3600, cache_ttl=0)
+    counter.init_db()
+    counter.record("human", "cell_type_markers", "form", counted=True)
+    counter.record("human", "cell_type_markers", "form", counted=True)
+    counter.record("mouse", "biological_processes", "batch", lists=5)
+    assert usage_rows(database) == []
+    assert counter.pending() == 7
+    assert counter.total() == 2
+
+    counter.flush()
+    assert counter.pending() == 0
+    assert usage_rows(database) == [
+        ("human", "cell_type_markers", "form", 2),
+        ("mouse", "biological_processes", "batch", 5),
+    ]
+    counter.record("mouse", "biological_processes", "batch")
+    counter.flush()
+    assert usage_rows(database)[-1] == ("mouse", "biological_processes", "batch", 6)
+    assert counter.total() == 2
+    statistics = counter.statistics()
+    assert statistics["organisms"] == {"human": 2, "mouse": 6}
+
+
+# With flush_interval 0 every record is written at once
+def test_immediate_flush(tmp_path):
+    counter = UsageCounter(tmp_path / "usage.db", flush_interval=0)
+    counter.record("human", "cell_type_markers", "api")
+    assert usage_rows(tmp_path / "usage.db") == [
+        ("human", "cell_type_markers", "api", 1)
+    ]
+
+
+# Counts of a failed flush are kept for the next one
+def test_failed_flush_keeps_counts(tmp_path):
+    database = tmp_path / "usage.db"
+    counter = UsageCounter(database, flush_interval=3600, cache_ttl=0)
+    counter.init_db()
+    counter.record("human", "cell_type_markers", "form", counted=True)
+    with sqlite3.connect(database) as conn:
+        conn.execute("ALTER TABLE usage RENAME TO moved")
+    with pytest.raises(sqlite3.Error):
+        counter.flush()
+    assert counter.pending() == 1
+    with sqlite3.connect(database) as conn:
+        conn.execute("ALTER TABLE moved RENAME TO usage")
+    counter.flush()
+    assert usage_rows(database) == [("human", "cell_type_markers", "form", 1)]
+    assert counter.total() == 1
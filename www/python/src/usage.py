@@ -0,0 +1,205 @@
+# Usage statistics: how many gene lists were enriched, in total and per
+# library, endpoint and day. Requests only add to in-memory counts; a
+# background thread of each web worker flushes them to the SQLite database
+# in one transaction every few seconds, so requests never wait for the
+# database write lock or an fsync.
+import atexit
+import os
+import sqlite3
+import threading
+import time
+from contextlib import closing
+
+from cache import LRUCache
+
+
+class UsageCounter:
+    """Per-process usage counts, flushed to a SQLite database in batches.
+
+    record() is called by the requests. The "counter" table keeps the
+    total of lists enriched through the web form (the number shown on the
+    home page), and the "usage" table the lists of every endpoint by day,
+    organism, analysis type and endpoint. Reads are cached for cache_ttl
+    seconds; the total also includes the counts this process has not
+    flushed yet. With flush_interval 0, every record() is written at once.
+    """
+
+    def __init__(self, database, flush_interval=10, cache_ttl=5):
+        self.database = database
+        self.flush_interval = flush_interval
+        self.cache_ttl = cache_ttl
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._pending = {}
+        self._pending_total = 0
+        # Part of the total being written by flush()
+        self._flushing_total = 0
+        self._cache = LRUCache(maxsize=64, ttl=cache_ttl)
+        self._thread = None
+        self._pid = None
+        self._ready = False
+
+    def _connect(self):
+        conn = sqlite3.connect(self.database, timeout=30)
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    # Create the tables and switch the database to write-ahead logging, so
+    # readers never block the writer and commits do not fsync the database
+    def init_db(self):
+        with closing(sqlite3.connect(self.database, timeout=30)) as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            with conn:
+                conn.execute("""
+                    CREATE TABLE IF NOT EXISTS counter (
+                        id INTEGER PRIMARY KEY,
+                        count INTEGER NOT NULL
+                    )
+                """)
+                conn.execute("""
+                    INSERT INTO counter (count)
+                    SELECT 0 WHERE NOT EXISTS (SELECT 1 FROM counter)
+                """)
+                conn.execute("""
+                    CREATE TABLE IF NOT EXISTS usage (
+                        day TEXT NOT NULL,
+                        organism TEXT NOT NULL,
+                        analysis_type TEXT NOT NULL,
+                        endpoint TEXT NOT NULL,
+                        lists INTEGER NOT NULL,
+                        PRIMARY KEY (day, organism, analysis_type, endpoint)
+                    )
+                """)
+        self._ready = True
+
+    # Count lists enriched against a library. Only lists from the web form
+    # (counted=True) add to the home page counter.
+    def record(self, organism, analysis_type, endpoint, lists=1, counted=False):
+        key = (time.strftime("%Y-%m-%d"), organism, analysis_type, endpoint)
+        with self._lock:
+            self._pending[key] = self._pending.get(key, 0) + lists
+            if counted:
+                self._pending_total += lists
+        if self.flush_interval <= 0:
+            self.flush()
+        else:
+            self._start()
+
+    # The flush thread is started by the first record() of each process, so
+    # worker processes forked from a preloaded app get their own
+    def _start(self):
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._thread = threading.Thread(
+                target=self._flush_loop, name="usage-flush", daemon=True
+            )
+            self._thread.start()
+        atexit.register(self.flush)
+
+    def _flush_loop(self):
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                self.flush()
+            except sqlite3.Error as e:
+                print(f"Could not flush usage counts: {e}")
+
+    # Write the pending counts in one transaction. On failure they are put
+    # back and written with the next flush.
+    def flush(self):
+        with self._flush_lock:
+            with self._lock:
+                pending, self._pending = self._pending, {}
+                total, self._pending_total = self._pending_total, 0
+                self._flushing_total = total
+            if not pending and not total:
+                return
+            try:
+                if not self._ready:
+                    self.init_db()
+                with closing(self._connect()) as conn, conn:
+                    if total:
+                        conn.execute("UPDATE counter SET count = count + ?", (total,))
+                    conn.executemany(
+                        """INSERT INTO usage
+                        (day, organism, analysis_type, endpoint, lists)
+                        VALUES (?, ?, ?, ?, ?)
+                        ON CONFLICT (day, organism, analysis_type, endpoint)
+                        DO UPDATE SET lists = lists + excluded.lists""",
+                        [(*key, lists) for key, lists in pending.items()],
+                    )
+                # The flushed counts are no longer pending, so cached reads
+                # would miss them
+                self._cache.clear()
+            except sqlite3.Error:
+                with self._lock:
+                    self._flushing_total = 0
+                    for key, lists in pending.items():
+                        self._pending[key] = self._pending.get(key, 0) + lists
+                    self._pending_total += total
+                raise
+            with self._lock:
+                self._flushing_total = 0
+
+    # Lists recorded by this process that are not in the database yet
+    def pending(self):
+        with self._lock:
+            return sum(self._pending.values())
+
+    # Value of a query, computed at most once every cache_ttl seconds
+    def _cached_query(self, key, query):
+        value = self._cache.get(key)
+        if value is None:
+            if not self._ready:
+                self.init_db()
+            with closing(self._connect()) as conn:
+                value = query(conn)
+            self._cache.set(key, value)
+        return value
+
+    # Lists enriched through the web form
+    def total(self):
+        count = self._cached_query(
+            "total",
+            lambda conn: conn.execute("SELECT count FROM counter").fetchone()[0],
+        )
+        with self._lock:
+            return count + self._pending_total + self._flushing_total
+
+    def statistics(self, since=None):
+        """Lists enriched since a day (YYYY-MM-DD, default ever).
+
+        Returns {"lists_enriched", "organisms": {organism: lists},
+        "libraries": [{"organism", "analysis_type", "endpoint", "lists"}]}
+        from the flushed counts.
+        """
+        rows = self._cached_query(
+            ("statistics", since),
+            lambda conn: conn.execute(
+                """SELECT organism, analysis_type, endpoint, SUM(lists)
+                FROM usage WHERE day >= ?
+                GROUP BY organism, analysis_type, endpoint
+                ORDER BY organism, analysis_type, endpoint""",
+                (since or "",),
+            ).fetchall(),
+        )
+        organisms = {}
+        for organism, _, _, lists in rows:
+            organisms[organism] = organisms.get(organism, 0) + lists
+        return {
+            "lists_enriched": self.total(),
+            "organisms": organisms,
+            "libraries": [
+                {
+                    "organism": organism,
+                    "analysis_type": analysis_type,
+                    "endpoint": endpoint,
+                    "lists": lists,
+                }
+                for organism, analysis_type, endpoint, lists in rows
+            ],
+        }
@@ -0,0 +1,7 @@
+# WSGI entry point of the production server (see gunicorn.conf.py). The
+# shared data is loaded at import, so a server that preloads the app loads it
+# once, in the master, before it forks the workers.
+from app import app, preload
+
+preload()
+application = app